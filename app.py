@@ -92,7 +92,7 @@ def gpu_wrapped_execute_video_bypath(*args, **kwargs):
     list_args = list(args)
     driving_path = AppFile.get_drive_file_path(drive_video_path)
     list_args[3] = driving_path
-    if driving_path and driving_path.endswith('pkl'):
+    if driving_path and driving_path.endswith(('pkl', 'npz')):
         list_args[2] = driving_path
         list_args[20] = "Pickle"
     else:
@@ -115,6 +115,8 @@ def gpu_wrapped_execute_image_retargeting_bypath(*args, **kwargs):
         list_args[19] = demo_image
     else:
         list_args[19] = AppFile.get_user_image_file_path(retargeting_input_image_path)
+    # the prepared source state is kept across the slider updates, keyed by the uploaded file name and the image content
+    kwargs.setdefault('session_key', retargeting_input_image_path)
     return gradio_pipeline.execute_image_retargeting(*list_args, **kwargs)
 
 
@@ -250,7 +252,7 @@ with gr.Blocks(theme=gr.themes.Soft(font=[gr.themes.GoogleFont("Plus Jakarta San
                         )
                 with gr.TabItem("📁 Driving Pickle") as v_tab_pickle:
                     with gr.Accordion(open=True, label="Driving Pickle"):
-                        driving_video_pickle_input = gr.File(type="filepath", file_types=[".pkl"])
+                        driving_video_pickle_input = gr.File(type="filepath", file_types=[".pkl", ".npz"])
                         gr.Examples(
                             examples=[
                                 [osp.join(example_video_dir, "d1.pkl")],
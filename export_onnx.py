@@ -0,0 +1,36 @@
+# coding: utf-8
+
+"""
+Export the LivePortrait networks (F, M, W, G and the stitching and retargeting MLPs) to ONNX, with dynamic batch axes.
+Run the inference with `--backend onnx` afterwards.
+"""
+
+import tyro
+import yaml
+from typing import Optional
+
+from src.config.inference_config import InferenceConfig
+from src.utils.onnx_export import export_models
+
+
+def main(flag_animal: bool = False, onnx_dir: Optional[str] = None, opset_version: int = 20):
+    """
+    flag_animal: export the animal models instead of the human ones
+    onnx_dir: where the onnx models are written, defaults to onnx_dir or onnx_dir_animal of InferenceConfig
+    opset_version: at least 20, which supports the 5-D grid_sample of the warping module
+    """
+    cfg = InferenceConfig()
+    suffix = '_animal' if flag_animal else ''
+    checkpoint_dct = {
+        'appearance_feature_extractor': getattr(cfg, f'checkpoint_F{suffix}'),
+        'motion_extractor': getattr(cfg, f'checkpoint_M{suffix}'),
+        'warping_module': getattr(cfg, f'checkpoint_W{suffix}'),
+        'spade_generator': getattr(cfg, f'checkpoint_G{suffix}'),
+        'stitching_retargeting_module': getattr(cfg, f'checkpoint_S{suffix}'),
+    }
+    model_config = yaml.load(open(cfg.models_config, 'r'), Loader=yaml.SafeLoader)
+    export_models(model_config, checkpoint_dct, onnx_dir or getattr(cfg, f'onnx_dir{suffix}'), opset_version=opset_version)
+
+
+if __name__ == "__main__":
+    tyro.cli(main)
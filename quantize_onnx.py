@@ -0,0 +1,94 @@
+# coding: utf-8
+
+"""
+INT8 post-training quantization of the exported onnx models for the cpu serving, calibrated on the frames of assets/examples,
+with a quality report of the animated example pairs against float32.
+Run export_onnx.py first, then use the quantized models by `--backend onnx --onnx-int8-models spade_generator motion_extractor`.
+"""
+
+import glob
+import os.path as osp
+import numpy as np
+import tyro
+from typing import Literal, Optional, Tuple
+
+from src.config.crop_config import CropConfig
+from src.config.inference_config import InferenceConfig
+from src.live_portrait_wrapper import LivePortraitWrapper, LivePortraitWrapperAnimal
+from src.utils.cropper import Cropper
+from src.utils.io import VideoReader, load_image_rgb
+from src.utils.onnx_quantize import QUANTIZABLE_MODELS, collect_calibration_feeds, quality_report, quantize_model
+from src.utils.rprint import rlog as log
+
+
+def load_example_pairs(wrapper, cropper, example_dir, n_sources=8, n_driving_frames=4):
+    """ pair the cropped source images with the frames sampled evenly from the driving videos, which are already cropped
+    return: list of (I_s, I_d), 1x3x256x256 tensors normalized to 0~1
+    """
+    I_s_lst = []
+    for source_path in sorted(glob.glob(osp.join(example_dir, 'source', '*.jpg')))[:n_sources]:
+        crop_info = cropper.crop_source_image(load_image_rgb(source_path), cropper.crop_cfg)
+        if crop_info is not None:
+            I_s_lst.append(wrapper.prepare_source(crop_info['img_crop_256x256']))
+    if len(I_s_lst) == 0:
+        raise Exception(f"No face detected in the source images of {example_dir}")
+
+    I_d_lst = []
+    for driving_path in sorted(glob.glob(osp.join(example_dir, 'driving', '*.mp4'))):
+        frames = list(VideoReader(driving_path))
+        for i in np.linspace(0, len(frames) - 1, n_driving_frames).astype(int):
+            I_d_lst.append(wrapper.prepare_source(frames[i]))
+
+    return [(I_s_lst[j % len(I_s_lst)], I_d) for j, I_d in enumerate(I_d_lst)]
+
+
+def main(
+    mode: Literal['quantize', 'report', 'both'] = 'both',
+    models: Tuple[str, ...] = QUANTIZABLE_MODELS,
+    flag_animal: bool = False,
+    onnx_dir: Optional[str] = None,
+    example_dir: str = osp.join(osp.dirname(osp.realpath(__file__)), 'assets/examples'),
+    n_sources: int = 8,
+    n_driving_frames: int = 4,
+    calibrate_method: Literal['minmax', 'entropy', 'percentile'] = 'minmax',
+    onnx_backend_num_threads: int = 0,
+    flag_lpips: bool = False,
+):
+    """
+    mode: quantize the models, report the quality of the quantized models, or both
+    models: the models to quantize, spade_generator and / or motion_extractor
+    onnx_dir: where the float32 models are exported and the int8 variants are written, defaults to onnx_dir or onnx_dir_animal of InferenceConfig
+    n_sources / n_driving_frames: number of source images, and of frames sampled from each driving video, for the calibration and the report
+    flag_lpips: also report the LPIPS distance, it needs `pip install lpips`
+    """
+    unknown_models = set(models) - set(QUANTIZABLE_MODELS)
+    if len(unknown_models) > 0:
+        raise Exception(f"Unknown models to quantize: {sorted(unknown_models)}, expect some of {list(QUANTIZABLE_MODELS)}")
+
+    inference_cfg = InferenceConfig(backend='onnx', flag_force_cpu=True, flag_use_half_precision=False, onnx_backend_num_threads=onnx_backend_num_threads)
+    onnx_dir_attr = 'onnx_dir_animal' if flag_animal else 'onnx_dir'
+    if onnx_dir is not None:
+        setattr(inference_cfg, onnx_dir_attr, onnx_dir)
+    onnx_dir = getattr(inference_cfg, onnx_dir_attr)
+
+    # the float32 models are the reference of the calibration and the report
+    wrapper = LivePortraitWrapperAnimal(inference_cfg) if flag_animal else LivePortraitWrapper(inference_cfg)
+    cropper = Cropper(
+        crop_cfg=CropConfig(flag_force_cpu=True),
+        image_type='animal_face' if flag_animal else 'human_face',
+        flag_force_cpu=True,
+        flag_use_half_precision=False,
+    )
+    pairs = load_example_pairs(wrapper, cropper, example_dir, n_sources=n_sources, n_driving_frames=n_driving_frames)
+    log(f'Load {len(pairs)} example pairs from {example_dir}')
+    feeds_dct = collect_calibration_feeds(wrapper, pairs, models)
+
+    if mode in ('quantize', 'both'):
+        for model_type in models:
+            quantize_model(onnx_dir, model_type, feeds_dct[model_type], calibrate_method=calibrate_method)
+    if mode in ('report', 'both'):
+        quality_report(wrapper, onnx_dir, pairs, feeds_dct, flag_lpips=flag_lpips, intra_op_num_threads=onnx_backend_num_threads)
+
+
+if __name__ == "__main__":
+    tyro.cli(main)
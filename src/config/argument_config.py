@@ -6,7 +6,7 @@ All configs for user
 from dataclasses import dataclass
 import tyro
 from typing_extensions import Annotated
-from typing import Optional, Literal
+from typing import Optional, Literal, Tuple
 from .base_config import PrintableConfig, make_abs_path
 
 
@@ -14,7 +14,7 @@ from .base_config import PrintableConfig, make_abs_path
 class ArgumentConfig(PrintableConfig):
     ########## input arguments ##########
     source: Annotated[str, tyro.conf.arg(aliases=["-s"])] = make_abs_path('../../assets/examples/source/s0.jpg')  # path to the source portrait (human/animal) or video (human)
-    driving:  Annotated[str, tyro.conf.arg(aliases=["-d"])] = make_abs_path('../../assets/examples/driving/d0.mp4')  # path to driving video or template (.pkl format)
+    driving:  Annotated[str, tyro.conf.arg(aliases=["-d"])] = make_abs_path('../../assets/examples/driving/d0.mp4')  # path to driving video or template (.npz, a directory of .npy columns, or the legacy .pkl format)
     output_dir: Annotated[str, tyro.conf.arg(aliases=["-o"])] = 'animations/'  # directory to save output video
 
     ########## inference arguments ##########
@@ -30,13 +30,24 @@ class ArgumentConfig(PrintableConfig):
     flag_stitching: bool = True  # recommend to True if head movement is small, False if head movement is large or the source image is an animal
     flag_relative_motion: bool = True # whether to use relative motion
     flag_pasteback: bool = True  # whether to paste-back/stitch the animated face cropping from the face-cropping space to the original image space
+    flag_pasteback_on_device: bool = True  # whether to paste back on the device (GPU) with grid_sample, cv2 is always used on the cpu
     flag_do_crop: bool = True  # whether to crop the source portrait or video to the face-cropping space
     driving_option: Literal["expression-friendly", "pose-friendly"] = "expression-friendly" # "expression-friendly" or "pose-friendly"; "expression-friendly" would adapt the driving motion with the global multiplier, and could be used when the source is a human image
     driving_multiplier: float = 1.0 # be used only when driving_option is "expression-friendly"
     driving_smooth_observation_variance: float = 3e-7  # smooth strength scalar for the animated video when the input is a source video, the larger the number, the smoother the animated video; too much smoothness would result in loss of motion accuracy
+    driving_smooth_lag: int = -1  # lag of the online smoothing of a source video, -1 means smoothing it all first
     audio_priority: Literal['source', 'driving'] = 'driving'  # whether to use the audio from source or driving video
+    animation_batch_size: int = 1  # frames warped and decoded at once, the larger the faster but the more memory
+    template_batch_size: int = 16  # frames per motion extractor call when making the motion template
+    postprocess_num_workers: int = 4  # paste-back threads, 0 means in the animation loop
+    source_cache_max_mb: int = 512  # host memory budget (MB) of the source feature cache, 0 means no cache
+    flag_source_cache_fp16: bool = False  # whether to keep the cached appearance feature in float16
     ########## source crop arguments ##########
     det_thresh: float = 0.15 # detection threshold
+    onnx_intra_op_num_threads: int = 4  # threads of the onnx face detector and landmark sessions, 0 means the default
+    onnx_graph_optimization_level: str = "all"  # onnx graph optimization level: disable, basic, extended or all
+    onnx_optimized_model_dir: str = ""  # if given, the optimized onnx models are cached there
+    det_max_dim: int = 0  # if > 0, detect the faces on a copy downscaled to this max dim
     scale: float = 2.3  # the ratio of face area is smaller if scale is larger
     vx_ratio: float = 0  # the ratio to move the face to left or right in cropping space
     vy_ratio: float = -0.125  # the ratio to move the face to up or down in cropping space
@@ -48,10 +59,23 @@ class ArgumentConfig(PrintableConfig):
     scale_crop_driving_video: float = 2.2  # scale factor for cropping driving video
     vx_ratio_crop_driving_video: float = 0.  # adjust y offset
     vy_ratio_crop_driving_video: float = -0.1  # adjust x offset
+    landmark_batch_size: int = 8  # frames per landmark model call, 1 means frame by frame
+    redetect_interval: int = 30  # re-detect every K tracked frames, 0 disables it
+    redetect_iou_thresh: float = 0.5  # re-detect when the IoU of two consecutive tracked boxes drops below it, 0 disables it
+    reseed_iou_thresh: float = 0.5  # re-track when the re-detected box overlaps the tracked one less than it
+    landmark_score_thresh: float = 0.  # re-detect when the landmark score drops below it, 0 disables it
+    max_interp_frames: int = 12  # max run of frames with no face to interpolate
+    crop_num_workers: int = 4  # crop threads, 0 means cropping in the tracking loop
+    crop_smooth_window: int = 0  # smoothing window of the source video crops, 0 disables it
+    flag_crop_driving_video_follow: bool = False  # crop each driving frame by its own smoothed box
 
     ########## gradio arguments ##########
     server_port: Annotated[int, tyro.conf.arg(aliases=["-p"])] = 8890  # port for gradio server
     share: bool = False  # whether to share the server to public
     server_name: Optional[str] = "127.0.0.1"  # set the local server name, "0.0.0.0" to broadcast all
     flag_do_torch_compile: bool = False  # whether to use torch.compile to accelerate generation
+    flag_optimize_2d_modules: bool = False  # fuse the conv-norm blocks and run the 2D modules in channels_last
+    backend: Literal['torch', 'onnx'] = 'torch'  # run the networks on pytorch, or on onnx runtime with the models exported by export_onnx.py
+    onnx_backend_num_threads: int = 0  # number of threads of the onnx sessions of the networks if backend is onnx, 0 means the default of onnx runtime
+    onnx_int8_models: Tuple[str, ...] = ()  # the networks run in the int8 variant made by quantize_onnx.py if backend is onnx, e.g., spade_generator motion_extractor
     gradio_temp_dir: Optional[str] = None  # directory to save gradio temp files
@@ -20,6 +20,11 @@ class CropConfig(PrintableConfig):
     device_id: int = 0  # gpu device id
     flag_force_cpu: bool = False  # force cpu inference, WIP
     det_thresh: float = 0.1 # detection threshold
+    ########## onnx runtime option, the sessions are shared in one process ##########
+    onnx_intra_op_num_threads: int = 4  # number of threads of an onnx session, 0 means the default of onnx runtime
+    onnx_graph_optimization_level: str = "all"  # disable, basic, extended or all
+    onnx_optimized_model_dir: str = ""  # if given, the optimized onnx models are serialized there and loaded on the next startup
+    det_max_dim: int = 0  # if > 0, the face detector runs on a copy of the image halved until its max dim is not larger than it, the landmarks are still refined on the full resolution
     ########## source image or video cropping option ##########
     dsize: int = 512  # crop size
     scale: float = 2.3  # scale factor
@@ -33,3 +38,16 @@ class CropConfig(PrintableConfig):
     vx_ratio_crop_driving_video: float = 0.0  # adjust y offset
     vy_ratio_crop_driving_video: float = -0.1  # adjust x offset
     direction: str = "large-small"  # direction of cropping
+    ########## video tracking option ##########
+    landmark_batch_size: int = 8  # frames per landmark model call, 1 means frame by frame
+    redetect_interval: int = 30  # re-detect every K tracked frames, 0 disables it
+    redetect_iou_thresh: float = 0.5  # re-detect when the IoU of two consecutive tracked boxes drops below it, 0 disables it
+    reseed_iou_thresh: float = 0.5  # re-track when the re-detected box overlaps the tracked one less than it
+    landmark_score_thresh: float = 0.  # re-detect when the landmark score drops below it, 0 disables it
+    landmark_score_output: str = ""  # score output of the landmark model, "" means the one named *score*
+    max_interp_frames: int = 12  # max run of frames with no face to interpolate
+    crop_num_workers: int = 4  # crop threads, 0 means cropping in the tracking loop
+    crop_smooth_window: int = 0  # Savitzky-Golay window of the source video crops, 0 disables it
+    crop_driving_smooth_window: int = 9  # the same for the following driving crops
+    crop_smooth_polyorder: int = 2  # polynomial order of the Savitzky-Golay filter
+    flag_crop_driving_video_follow: bool = False  # crop each driving frame by its own smoothed box
@@ -28,6 +28,10 @@ class InferenceConfig(PrintableConfig):
     checkpoint_W_animal: str = make_abs_path('../../pretrained_weights/liveportrait_animals/base_models/warping_module.pth')  # path to checkpoint of W
     checkpoint_S_animal: str = make_abs_path('../../pretrained_weights/liveportrait/retargeting_models/stitching_retargeting_module.pth')  # path to checkpoint to S and R_eyes, R_lip, NOTE: use human temporarily!
 
+    # ONNX MODEL CONFIG, NOT EXPORTED PARAMS
+    onnx_dir: str = make_abs_path('../../pretrained_weights/liveportrait/onnx')  # the human models exported by export_onnx.py, used if backend is onnx
+    onnx_dir_animal: str = make_abs_path('../../pretrained_weights/liveportrait_animals/onnx')  # the animal models exported by export_onnx.py --flag-animal
+
     # EXPORTED PARAMS
     flag_use_half_precision: bool = True
     flag_crop_driving_video: bool = False
@@ -40,15 +44,28 @@ class InferenceConfig(PrintableConfig):
     flag_stitching: bool = True
     flag_relative_motion: bool = True
     flag_pasteback: bool = True
+    flag_pasteback_on_device: bool = True # paste back with grid_sample on the device, cv2 is used when running on the cpu
     flag_do_crop: bool = True
     flag_do_rot: bool = True
     flag_force_cpu: bool = False
     flag_do_torch_compile: bool = False
+    flag_optimize_2d_modules: bool = False # fold the spectral norm and BatchNorm into the convs and run the 2D modules of F, W and G in channels_last, if backend is torch
+    backend: Literal['torch', 'onnx'] = 'torch' # run F, M, W, G and S on pytorch, or on onnx runtime with the models exported by export_onnx.py
+    onnx_backend_num_threads: int = 0 # number of threads of the onnx sessions of the backend, 0 means the default of onnx runtime
+    onnx_int8_models: Tuple[str, ...] = () # the models run in the int8 variant made by quantize_onnx.py if backend is onnx, e.g., spade_generator motion_extractor
+    onnx_graph_optimization_level: str = "all" # graph optimization level of the onnx sessions, shared with the cropper
+    onnx_optimized_model_dir: str = "" # if given, the optimized onnx models are serialized there, shared with the cropper
     driving_option: str = "pose-friendly" # "expression-friendly" or "pose-friendly"
     driving_multiplier: float = 1.0
     driving_smooth_observation_variance: float = 3e-7 # smooth strength scalar for the animated video when the input is a source video, the larger the number, the smoother the animated video; too much smoothness would result in loss of motion accuracy
+    driving_smooth_lag: int = -1  # lag of the online smoothing of a source video, -1 means smoothing it all first
     source_max_dim: int = 1280 # the max dim of height and width of source image or video
     source_division: int = 2 # make sure the height and width of source image or video can be divided by this number
+    animation_batch_size: int = 1 # frames warped and decoded at once
+    template_batch_size: int = 16 # frames per motion extractor call
+    postprocess_num_workers: int = 4 # paste-back threads, 0 means in the animation loop
+    source_cache_max_mb: int = 512 # host memory budget of the source image feature cache, 0 means no cache
+    flag_source_cache_fp16: bool = False # whether to keep the cached appearance feature in float16
 
     # NOT EXPORTED PARAMS
     lip_normalize_threshold: float = 0.03 # threshold for flag_normalize_lip
@@ -6,22 +6,27 @@ Pipeline for gradio
 
 import os.path as osp
 import os
+import threading
 import cv2
 from rich.progress import track
 import gradio as gr
 import numpy as np
 import torch
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any
 
 from .config.argument_config import ArgumentConfig
 from .live_portrait_pipeline import LivePortraitPipeline
 from .live_portrait_pipeline_animal import LivePortraitPipelineAnimal
-from .utils.io import load_img_online, load_video, resize_to_limit
+from .utils.io import load_img_online, VideoReader, resize_to_limit
 from .utils.filter import smooth
+from .utils.feature_cache import _hash_array
 from .utils.rprint import rlog as log
 from .utils.crop import prepare_paste_back, paste_back
 from .utils.camera import get_rotation_matrix
-from .utils.video import get_fps, has_audio_stream, concat_frames, images2video, add_audio_to_video
-from .utils.helper import is_square_video, mkdir, dct2device, basename
+from .utils.video import VideoSink, get_fps, has_audio_stream, concat_frame, add_audio_to_video
+from .utils.helper import is_square_video, mkdir, motion2device, basename
 from .utils.retargeting_utils import calc_eye_close_ratio, calc_lip_close_ratio
 
 
@@ -34,14 +39,56 @@ def update_args(args, user_args):
     return args
 
 
+@dataclass
+class RetargetingSession:
+    """the prepared state of a retargeting source image, kept on the device while the sliders are moved"""
+    retargeting_source_scale: float
+    flag_do_crop: bool
+    f_s_user: torch.Tensor
+    x_s_user: torch.Tensor
+    R_s_user: torch.Tensor
+    x_s_info: dict
+    source_lmk_user: np.ndarray
+    crop_M_c2o: Any
+    mask_ori: Any
+    img_rgb: np.ndarray
+
+
 class GradioPipeline(LivePortraitPipeline):
     """gradio for human
     """
 
-    def __init__(self, inference_cfg, crop_cfg, args: ArgumentConfig):
+    def __init__(self, inference_cfg, crop_cfg, args: ArgumentConfig, max_retargeting_sessions=8):
         super().__init__(inference_cfg, crop_cfg)
         # self.live_portrait_wrapper = self.live_portrait_wrapper
         self.args = args
+        # (the uploaded file name, the content hash, the shape) -> RetargetingSession, in the LRU order
+        self.retargeting_sessions = OrderedDict()
+        self.max_retargeting_sessions = max_retargeting_sessions
+        self.retargeting_sessions_lock = threading.Lock()
+
+    def get_retargeting_session(self, session_key, input_image, retargeting_source_scale, flag_do_crop=True) -> RetargetingSession:
+        """ get the prepared state of the source image, it is only prepared when the image or the crop options change
+        session_key: the uploaded file name, e.g., tracked by AppFile, the sessions are keyed by it and the content hash of the image
+        """
+        if input_image is None:
+            return self.prepare_retargeting_source(input_image, retargeting_source_scale, flag_do_crop=flag_do_crop)  # raises
+        img_rgb = load_img_online(input_image, mode='rgb', max_dim=1280, n=2)
+        session_key = (session_key, _hash_array(img_rgb), img_rgb.shape)  # a file uploaded again under the same name is a new session
+        with self.retargeting_sessions_lock:
+            session = self.retargeting_sessions.get(session_key)
+            if session is not None:
+                self.retargeting_sessions.move_to_end(session_key)
+        if session is not None and session.retargeting_source_scale == retargeting_source_scale and session.flag_do_crop == flag_do_crop:
+            return session
+
+        session = self.prepare_retargeting_source(input_image, retargeting_source_scale, flag_do_crop=flag_do_crop, img_rgb=img_rgb)
+        with self.retargeting_sessions_lock:
+            self.retargeting_sessions[session_key] = session
+            self.retargeting_sessions.move_to_end(session_key)
+            while len(self.retargeting_sessions) > self.max_retargeting_sessions:
+                self.retargeting_sessions.popitem(last=False)
+        return session
 
     @torch.no_grad()
     def update_delta_new_eyeball_direction(self, eyeball_direction_x, eyeball_direction_y, delta_new, **kwargs):
@@ -243,15 +290,27 @@ class GradioPipeline(LivePortraitPipeline):
         input_image,
         retargeting_source_scale: float,
         flag_stitching_retargeting_input=True,
-        flag_do_crop_input_retargeting_image=True):
+        flag_do_crop_input_retargeting_image=True,
+        session_key=None):
         """ for single image retargeting
+        session_key: the uploaded file name, the prepared source state is kept across the slider updates, defaults to the image path
         """
         if input_head_pitch_variation is None or input_head_yaw_variation is None or input_head_roll_variation is None:
             raise gr.Error("Invalid relative pose input 💥!", duration=5)
-        # disposable feature
-        f_s_user, x_s_user, R_s_user, R_d_user, x_s_info, source_lmk_user, crop_M_c2o, mask_ori, img_rgb = \
-            self.prepare_retargeting_image(
-                input_image, input_head_pitch_variation, input_head_yaw_variation, input_head_roll_variation, retargeting_source_scale, flag_do_crop=flag_do_crop_input_retargeting_image)
+        if session_key is None and isinstance(input_image, str):
+            session_key = input_image
+        if session_key is not None:
+            # only the keypoint edits, the stitching and the warping/decoding run for a slider update
+            session = self.get_retargeting_session(session_key, input_image, retargeting_source_scale, flag_do_crop=flag_do_crop_input_retargeting_image)
+            f_s_user, x_s_user, R_s_user, x_s_info = session.f_s_user, session.x_s_user, session.R_s_user, session.x_s_info
+            source_lmk_user, crop_M_c2o, mask_ori, img_rgb = session.source_lmk_user, session.crop_M_c2o, session.mask_ori, session.img_rgb
+            R_d_user = get_rotation_matrix(
+                x_s_info['pitch'] + input_head_pitch_variation, x_s_info['yaw'] + input_head_yaw_variation, x_s_info['roll'] + input_head_roll_variation)
+        else:
+            # disposable feature
+            f_s_user, x_s_user, R_s_user, R_d_user, x_s_info, source_lmk_user, crop_M_c2o, mask_ori, img_rgb = \
+                self.prepare_retargeting_image(
+                    input_image, input_head_pitch_variation, input_head_yaw_variation, input_head_roll_variation, retargeting_source_scale, flag_do_crop=flag_do_crop_input_retargeting_image)
 
         if input_eye_ratio is None or input_lip_ratio is None:
             raise gr.Error("Invalid ratio input 💥!", duration=5)
@@ -276,7 +335,7 @@ class GradioPipeline(LivePortraitPipeline):
             lip_variation_three = torch.tensor(lip_variation_three).to(device)
 
             x_c_s = x_s_info['kp'].to(device)
-            delta_new = x_s_info['exp'].to(device)
+            delta_new = x_s_info['exp'].to(device).clone()  # edited in place below, the source state is kept intact
             scale_new = x_s_info['scale'].to(device)
             t_new = x_s_info['t'].to(device)
             R_d_new = (R_d_user @ R_s_user.permute(0, 2, 1)) @ R_s_user
@@ -324,6 +383,35 @@ class GradioPipeline(LivePortraitPipeline):
                 out_to_ori_blend = out
             return out, out_to_ori_blend
 
+    @torch.no_grad()
+    def prepare_retargeting_source(self, input_image, retargeting_source_scale, flag_do_crop=True, img_rgb=None) -> RetargetingSession:
+        """ prepare the source state of single image retargeting, independent of the pose sliders
+        img_rgb: input_image already loaded by `load_img_online`, if given
+        """
+        if input_image is None:
+            raise gr.Error("Please upload a source portrait as the retargeting input 🤗🤗🤗", duration=5)
+        # gr.Info("Upload successfully!", duration=2)
+        args_user = {'scale': retargeting_source_scale}
+        self.args = update_args(self.args, args_user)
+        self.cropper.update_config(self.args.__dict__)
+        ######## process source portrait ########
+        if img_rgb is None:
+            img_rgb = load_img_online(input_image, mode='rgb', max_dim=1280, n=2)
+        # the cropping and the features are cached, moving the sliders does not recompute them
+        source_dct = self.prepare_source_image(img_rgb, self.cropper.crop_cfg, flag_do_crop=flag_do_crop)
+        return RetargetingSession(
+            retargeting_source_scale=retargeting_source_scale,
+            flag_do_crop=flag_do_crop,
+            f_s_user=source_dct['f_s'],
+            x_s_user=source_dct['x_s'],
+            R_s_user=source_dct['R_s'],
+            x_s_info=source_dct['x_s_info'],
+            source_lmk_user=source_dct['source_lmk'],
+            crop_M_c2o=source_dct['M_c2o'],
+            mask_ori=source_dct['mask_ori'],
+            img_rgb=img_rgb,
+        )
+
     @torch.no_grad()
     def prepare_retargeting_image(
         self,
@@ -333,37 +421,14 @@ class GradioPipeline(LivePortraitPipeline):
         flag_do_crop=True):
         """ for single image retargeting
         """
-        if input_image is not None:
-            # gr.Info("Upload successfully!", duration=2)
-            args_user = {'scale': retargeting_source_scale}
-            self.args = update_args(self.args, args_user)
-            self.cropper.update_config(self.args.__dict__)
-            inference_cfg = self.live_portrait_wrapper.inference_cfg
-            ######## process source portrait ########
-            img_rgb = load_img_online(input_image, mode='rgb', max_dim=1280, n=2)
-            if flag_do_crop:
-                crop_info = self.cropper.crop_source_image(img_rgb, self.cropper.crop_cfg)
-                I_s = self.live_portrait_wrapper.prepare_source(crop_info['img_crop_256x256'])
-                source_lmk_user = crop_info['lmk_crop']
-                crop_M_c2o = crop_info['M_c2o']
-                mask_ori = prepare_paste_back(inference_cfg.mask_crop, crop_info['M_c2o'], dsize=(img_rgb.shape[1], img_rgb.shape[0]))
-            else:
-                I_s = self.live_portrait_wrapper.prepare_source(img_rgb)
-                source_lmk_user = self.cropper.calc_lmk_from_cropped_image(img_rgb)
-                crop_M_c2o = None
-                mask_ori = None
-            x_s_info = self.live_portrait_wrapper.get_kp_info(I_s)
-            x_d_info_user_pitch = x_s_info['pitch'] + input_head_pitch_variation
-            x_d_info_user_yaw = x_s_info['yaw'] + input_head_yaw_variation
-            x_d_info_user_roll = x_s_info['roll'] + input_head_roll_variation
-            R_s_user = get_rotation_matrix(x_s_info['pitch'], x_s_info['yaw'], x_s_info['roll'])
-            R_d_user = get_rotation_matrix(x_d_info_user_pitch, x_d_info_user_yaw, x_d_info_user_roll)
-            ############################################
-            f_s_user = self.live_portrait_wrapper.extract_feature_3d(I_s)
-            x_s_user = self.live_portrait_wrapper.transform_keypoint(x_s_info)
-            return f_s_user, x_s_user, R_s_user, R_d_user, x_s_info, source_lmk_user, crop_M_c2o, mask_ori, img_rgb
-        else:
-            raise gr.Error("Please upload a source portrait as the retargeting input 🤗🤗🤗", duration=5)
+        session = self.prepare_retargeting_source(input_image, retargeting_source_scale, flag_do_crop=flag_do_crop)
+        x_s_info = session.x_s_info
+        x_d_info_user_pitch = x_s_info['pitch'] + input_head_pitch_variation
+        x_d_info_user_yaw = x_s_info['yaw'] + input_head_yaw_variation
+        x_d_info_user_roll = x_s_info['roll'] + input_head_roll_variation
+        R_d_user = get_rotation_matrix(x_d_info_user_pitch, x_d_info_user_yaw, x_d_info_user_roll)
+        return session.f_s_user, session.x_s_user, session.R_s_user, R_d_user, x_s_info, \
+            session.source_lmk_user, session.crop_M_c2o, session.mask_ori, session.img_rgb
 
     @torch.no_grad()
     def init_retargeting_image(self, retargeting_source_scale: float, source_eye_ratio: float, source_lip_ratio:float, input_image = None):
@@ -395,7 +460,7 @@ class GradioPipeline(LivePortraitPipeline):
         """
         # disposable feature
         device = self.live_portrait_wrapper.device
-        f_s_user_lst, x_s_user_lst, source_lmk_crop_lst, source_M_c2o_lst, mask_ori_lst, source_rgb_lst, img_crop_256x256_lst, lip_delta_retargeting_lst_smooth, source_fps, n_frames = \
+        x_s_user_lst, source_M_c2o_lst, source_rgb_lst, img_crop_256x256_lst, lip_delta_retargeting_lst_smooth, source_fps, n_frames, source_valid_lst = \
             self.prepare_retargeting_video(input_video, retargeting_source_scale, device, input_lip_ratio, driving_smooth_observation_variance_retargeting, flag_do_crop=flag_do_crop_input_retargeting_video)
 
         if input_lip_ratio is None:
@@ -403,33 +468,45 @@ class GradioPipeline(LivePortraitPipeline):
         else:
             inference_cfg = self.live_portrait_wrapper.inference_cfg
 
-            I_p_pstbk_lst = None
-            if flag_do_crop_input_retargeting_video:
-                I_p_pstbk_lst = []
-            I_p_lst = []
-            for i in track(range(n_frames), description='Retargeting video...', total=n_frames):
-                x_s_user_i = x_s_user_lst[i].to(device)
-                f_s_user_i = f_s_user_lst[i].to(device)
-
-                lip_delta_retargeting = lip_delta_retargeting_lst_smooth[i]
-                x_d_i_new = x_s_user_i + lip_delta_retargeting
-                x_d_i_new = self.live_portrait_wrapper.stitching(x_s_user_i, x_d_i_new)
-                out = self.live_portrait_wrapper.warp_decode(f_s_user_i, x_s_user_i, x_d_i_new)
-                I_p_i = self.live_portrait_wrapper.parse_output(out['out'])[0]
-                I_p_lst.append(I_p_i)
-
-                if flag_do_crop_input_retargeting_video:
-                    I_p_pstbk = paste_back(I_p_i, source_M_c2o_lst[i], source_rgb_lst[i], mask_ori_lst[i])
-                    I_p_pstbk_lst.append(I_p_pstbk)
-
             mkdir(self.args.output_dir)
             flag_source_has_audio = has_audio_stream(input_video)
-
-            ######### build the final concatenation result #########
-            # source frame | generation
-            frames_concatenated = concat_frames(driving_image_lst=None, source_image_lst=img_crop_256x256_lst, I_p_lst=I_p_lst)
             wfp_concat = osp.join(self.args.output_dir, f'{basename(input_video)}_retargeting_concat.mp4')
-            images2video(frames_concatenated, wfp=wfp_concat, fps=source_fps)
+            wfp = osp.join(self.args.output_dir, f'{basename(input_video)}_retargeting.mp4')
+            # the frames are encoded in the background while rendering, instead of being collected
+            video_sink = VideoSink(wfp=wfp, fps=source_fps)
+            video_sink_concat = VideoSink(wfp=wfp_concat, fps=source_fps)
+            if flag_do_crop_input_retargeting_video:
+                source_rgb_iter = iter(source_rgb_lst)  # the original frames are decoded again for pasting back
+            try:
+                for i in track(range(n_frames), description='Retargeting video...', total=n_frames):
+                    img_crop_256x256 = img_crop_256x256_lst[i]
+                    source_rgb_i = next(source_rgb_iter) if flag_do_crop_input_retargeting_video else None
+                    if not source_valid_lst[i]:
+                        # no face: pass through
+                        I_p_i = cv2.resize(img_crop_256x256, (512, 512))
+                        I_p_pstbk = source_rgb_i
+                    else:
+                        x_s_user_i = x_s_user_lst[i].to(device)
+                        f_s_user_i = self.live_portrait_wrapper.extract_feature_3d(self.live_portrait_wrapper.prepare_videos([img_crop_256x256])[:, 0])
+
+                        lip_delta_retargeting = lip_delta_retargeting_lst_smooth[i]
+                        x_d_i_new = x_s_user_i + lip_delta_retargeting
+                        x_d_i_new = self.live_portrait_wrapper.stitching(x_s_user_i, x_d_i_new)
+                        out = self.live_portrait_wrapper.warp_decode(f_s_user_i, x_s_user_i, x_d_i_new)
+                        I_p_i = self.live_portrait_wrapper.parse_output(out['out'])[0]
+
+                        if flag_do_crop_input_retargeting_video:
+                            mask_ori = prepare_paste_back(inference_cfg.mask_crop, source_M_c2o_lst[i], dsize=(source_rgb_i.shape[1], source_rgb_i.shape[0]))
+                            I_p_pstbk = paste_back(I_p_i, source_M_c2o_lst[i], source_rgb_i, mask_ori)
+
+                    # source frame | generation
+                    video_sink.write(I_p_pstbk if flag_do_crop_input_retargeting_video else I_p_i)
+                    video_sink_concat.write(concat_frame(None, img_crop_256x256, I_p_i))
+            finally:
+                try:
+                    video_sink.close()
+                finally:
+                    video_sink_concat.close()
 
             if flag_source_has_audio:
                 # final result with concatenation
@@ -438,13 +515,6 @@ class GradioPipeline(LivePortraitPipeline):
                 os.replace(wfp_concat_with_audio, wfp_concat)
                 log(f"Replace {wfp_concat_with_audio} with {wfp_concat}")
 
-            # save the animated result
-            wfp = osp.join(self.args.output_dir, f'{basename(input_video)}_retargeting.mp4')
-            if I_p_pstbk_lst is not None and len(I_p_pstbk_lst) > 0:
-                images2video(I_p_pstbk_lst, wfp=wfp, fps=source_fps)
-            else:
-                images2video(I_p_lst, wfp=wfp, fps=source_fps)
-
             ######### build the final result #########
             if flag_source_has_audio:
                 wfp_with_audio = osp.join(self.args.output_dir, f'{basename(input_video)}_retargeting_with_audio.mp4')
@@ -457,6 +527,7 @@ class GradioPipeline(LivePortraitPipeline):
     @torch.no_grad()
     def prepare_retargeting_video(self, input_video, retargeting_source_scale, device, input_lip_ratio, driving_smooth_observation_variance_retargeting, flag_do_crop=True):
         """ for video retargeting
+        the source video is decoded lazily, only the 256x256 crops and the keypoints of the frames are kept
         """
         if input_video is not None:
             # gr.Info("Upload successfully!", duration=2)
@@ -465,48 +536,36 @@ class GradioPipeline(LivePortraitPipeline):
             self.cropper.update_config(self.args.__dict__)
             inference_cfg = self.live_portrait_wrapper.inference_cfg
             ######## process source video ########
-            source_rgb_lst = load_video(input_video)
-            source_rgb_lst = [resize_to_limit(img, inference_cfg.source_max_dim, inference_cfg.source_division) for img in source_rgb_lst]
+            source_rgb_lst = VideoReader(input_video, transform=lambda img: resize_to_limit(img, inference_cfg.source_max_dim, inference_cfg.source_division))
             source_fps = int(get_fps(input_video))
-            n_frames = len(source_rgb_lst)
             log(f"Load source video from {input_video}. FPS is {source_fps}")
 
             if flag_do_crop:
                 ret_s = self.cropper.crop_source_video(source_rgb_lst, self.cropper.crop_cfg)
                 log(f'Source video is cropped, {len(ret_s["frame_crop_lst"])} frames are processed.')
-                if len(ret_s["frame_crop_lst"]) != n_frames:
-                    n_frames = min(len(source_rgb_lst), len(ret_s["frame_crop_lst"]))
-                img_crop_256x256_lst, source_lmk_crop_lst, source_M_c2o_lst = ret_s['frame_crop_lst'], ret_s['lmk_crop_lst'], ret_s['M_c2o_lst']
-                mask_ori_lst = [prepare_paste_back(inference_cfg.mask_crop, source_M_c2o, dsize=(source_rgb_lst[0].shape[1], source_rgb_lst[0].shape[0])) for source_M_c2o in source_M_c2o_lst]
+                img_crop_256x256_lst, source_M_c2o_lst = ret_s['frame_crop_lst'], ret_s['M_c2o_lst']
             else:
-                source_lmk_crop_lst = self.cropper.calc_lmks_from_cropped_video(source_rgb_lst)
+                ret_s = self.cropper.calc_lmks_from_cropped_video(source_rgb_lst)
                 img_crop_256x256_lst = [cv2.resize(_, (256, 256)) for _ in source_rgb_lst]  # force to resize to 256x256
-                source_M_c2o_lst, mask_ori_lst = None, None
+                source_M_c2o_lst = None
+            n_frames = len(img_crop_256x256_lst)  # the decoded frames
+            source_lmk_crop_lst, source_valid_lst = ret_s['lmk_crop_lst'], ret_s['valid_lst']
 
             c_s_eyes_lst, c_s_lip_lst = self.live_portrait_wrapper.calc_ratio(source_lmk_crop_lst)
             # save the motion template
-            I_s_lst = self.live_portrait_wrapper.prepare_videos(img_crop_256x256_lst)
-            source_template_dct = self.make_motion_template(I_s_lst, c_s_eyes_lst, c_s_lip_lst, output_fps=source_fps)
+            source_template_dct = self.make_motion_template(img_crop_256x256_lst, c_s_eyes_lst, c_s_lip_lst, output_fps=source_fps)
 
             c_d_lip_retargeting = [input_lip_ratio]
-            f_s_user_lst, x_s_user_lst, lip_delta_retargeting_lst = [], [], []
+            x_s_all = motion2device(source_template_dct, device, n_frames, keys=('x_s',))['x_s']
+            x_s_user_lst, lip_delta_retargeting_lst = [], []
             for i in track(range(n_frames), description='Preparing retargeting video...', total=n_frames):
-                x_s_info = source_template_dct['motion'][i]
-                x_s_info = dct2device(x_s_info, device)
-                x_s_user = x_s_info['x_s']
-
-                source_lmk = source_lmk_crop_lst[i]
-                img_crop_256x256 = img_crop_256x256_lst[i]
-                I_s = I_s_lst[i]
-                f_s_user = self.live_portrait_wrapper.extract_feature_3d(I_s)
-
-                combined_lip_ratio_tensor_retargeting = self.live_portrait_wrapper.calc_combined_lip_ratio(c_d_lip_retargeting, source_lmk)
+                x_s_user = x_s_all[i:i + 1]
+                combined_lip_ratio_tensor_retargeting = self.live_portrait_wrapper.calc_combined_lip_ratio(c_d_lip_retargeting, source_lmk_crop_lst[i])
                 lip_delta_retargeting = self.live_portrait_wrapper.retarget_lip(x_s_user, combined_lip_ratio_tensor_retargeting)
-                f_s_user_lst.append(f_s_user); x_s_user_lst.append(x_s_user); lip_delta_retargeting_lst.append(lip_delta_retargeting.cpu().numpy().astype(np.float32))
+                x_s_user_lst.append(x_s_user); lip_delta_retargeting_lst.append(lip_delta_retargeting.cpu().numpy().astype(np.float32))
             lip_delta_retargeting_lst_smooth = smooth(lip_delta_retargeting_lst, lip_delta_retargeting_lst[0].shape, device, driving_smooth_observation_variance_retargeting)
 
-
-            return f_s_user_lst, x_s_user_lst, source_lmk_crop_lst, source_M_c2o_lst, mask_ori_lst, source_rgb_lst, img_crop_256x256_lst, lip_delta_retargeting_lst_smooth, source_fps, n_frames
+            return x_s_user_lst, source_M_c2o_lst, source_rgb_lst, img_crop_256x256_lst, lip_delta_retargeting_lst_smooth, source_fps, n_frames, source_valid_lst
         else:
             # when press the clear button, go here
             raise gr.Error("Please upload a source video as the retargeting input 🤗🤗🤗", duration=5)
@@ -18,11 +18,12 @@ from .config.inference_config import InferenceConfig
 from .config.crop_config import CropConfig
 from .utils.cropper import Cropper
 from .utils.camera import get_rotation_matrix
-from .utils.video import images2video, concat_frames, get_fps, add_audio_to_video, has_audio_stream
-from .utils.crop import prepare_paste_back, paste_back
-from .utils.io import load_image_rgb, load_video, resize_to_limit, dump, load
-from .utils.helper import mkdir, basename, dct2device, is_video, is_template, remove_suffix, is_image, is_square_video, calc_motion_multiplier
-from .utils.filter import smooth
+from .utils.video import VideoSink, FrameWorkerPool, concat_frame, get_fps, add_audio_to_video, has_audio_stream
+from .utils.crop import prepare_paste_back, paste_back, prepare_paste_back_torch, paste_back_torch
+from .utils.io import load_image_rgb, VideoReader, resize_to_limit, load_motion_template, dump_motion_template
+from .utils.helper import mkdir, basename, motion2device, make_motion_template, is_video, is_template, remove_suffix, is_image, is_square_video, calc_motion_multiplier
+from .utils.filter import smooth, OnlineSmoother
+from .utils.feature_cache import SourceFeatureCache
 from .utils.rprint import rlog as log
 # from .utils.viz import viz_lmk
 from .live_portrait_wrapper import LivePortraitWrapper
@@ -37,43 +38,214 @@ class LivePortraitPipeline(object):
     def __init__(self, inference_cfg: InferenceConfig, crop_cfg: CropConfig):
         self.live_portrait_wrapper: LivePortraitWrapper = LivePortraitWrapper(inference_cfg=inference_cfg)
         self.cropper: Cropper = Cropper(crop_cfg=crop_cfg)
+        self.source_feature_cache = SourceFeatureCache(inference_cfg.source_cache_max_mb * 1024 ** 2, flag_fp16=inference_cfg.flag_source_cache_fp16)
 
-    def make_motion_template(self, I_lst, c_eyes_lst, c_lip_lst, **kwargs):
-        n_frames = I_lst.shape[0]
-        template_dct = {
-            'n_frames': n_frames,
-            'output_fps': kwargs.get('output_fps', 25),
-            'motion': [],
-            'c_eyes_lst': [],
-            'c_lip_lst': [],
+    def prepare_source_image(self, img_rgb, crop_cfg: CropConfig, flag_do_crop=True):
+        """ crop the source image and extract its features, the result is cached by the image content and the crop parameters
+        return: a dict of 'img_crop_256x256', 'source_lmk', 'M_c2o', 'mask_ori' (both None if not cropping), 'x_s_info', 'R_s', 'f_s', 'x_s'
+        """
+        device = self.live_portrait_wrapper.device
+        inf_cfg = self.live_portrait_wrapper.inference_cfg
+        cache_key = self.source_feature_cache.make_key(img_rgb, crop_cfg, flag_do_crop=flag_do_crop, mask_crop=inf_cfg.mask_crop if flag_do_crop else None)
+        source_dct = self.source_feature_cache.get(cache_key, device)
+        if source_dct is not None:
+            log("Load the source features from the cache.")
+            return source_dct
+
+        if flag_do_crop:
+            crop_info = self.cropper.crop_source_image(img_rgb, crop_cfg)
+            if crop_info is None:
+                raise Exception("No face detected in the source image!")
+            source_lmk = crop_info['lmk_crop']
+            img_crop_256x256 = crop_info['img_crop_256x256']
+            M_c2o = crop_info['M_c2o']
+            mask_ori = prepare_paste_back(inf_cfg.mask_crop, M_c2o, dsize=(img_rgb.shape[1], img_rgb.shape[0]))
+        else:
+            source_lmk = self.cropper.calc_lmk_from_cropped_image(img_rgb)
+            img_crop_256x256 = cv2.resize(img_rgb, (256, 256))  # force to resize to 256x256
+            M_c2o, mask_ori = None, None
+        I_s = self.live_portrait_wrapper.prepare_source(img_crop_256x256)
+        x_s_info = self.live_portrait_wrapper.get_kp_info(I_s)
+        R_s = get_rotation_matrix(x_s_info['pitch'], x_s_info['yaw'], x_s_info['roll'])
+        f_s = self.live_portrait_wrapper.extract_feature_3d(I_s)
+        x_s = self.live_portrait_wrapper.transform_keypoint(x_s_info)
+
+        source_dct = {
+            'img_crop_256x256': img_crop_256x256,
+            'source_lmk': source_lmk,
+            'M_c2o': M_c2o,
+            'mask_ori': mask_ori,
+            'x_s_info': x_s_info,
+            'R_s': R_s,
+            'f_s': f_s,
+            'x_s': x_s,
         }
+        self.source_feature_cache.put(cache_key, source_dct)
+        return source_dct
 
-        for i in track(range(n_frames), description='Making motion templates...', total=n_frames):
-            # collect s, R, δ and t for inference
-            I_i = I_lst[i]
-            x_i_info = self.live_portrait_wrapper.get_kp_info(I_i)
-            x_s = self.live_portrait_wrapper.transform_keypoint(x_i_info)
-            R_i = get_rotation_matrix(x_i_info['pitch'], x_i_info['yaw'], x_i_info['roll'])
-
-            item_dct = {
-                'scale': x_i_info['scale'].cpu().numpy().astype(np.float32),
-                'R': R_i.cpu().numpy().astype(np.float32),
-                'exp': x_i_info['exp'].cpu().numpy().astype(np.float32),
-                't': x_i_info['t'].cpu().numpy().astype(np.float32),
-                'kp': x_i_info['kp'].cpu().numpy().astype(np.float32),
-                'x_s': x_s.cpu().numpy().astype(np.float32),
-            }
-
-            template_dct['motion'].append(item_dct)
+    def make_motion_template(self, I_lst, c_eyes_lst, c_lip_lst, **kwargs):
+        """see `helper.make_motion_template`, with the 'c_eyes' and 'c_lip' columns"""
+        batch_size = max(kwargs.pop('batch_size', self.live_portrait_wrapper.inference_cfg.template_batch_size), 1)
+        template_dct = make_motion_template(self.live_portrait_wrapper, I_lst, batch_size, **kwargs)
+        n_frames = template_dct['n_frames']
+        template_dct['c_eyes'] = np.concatenate([np.reshape(c_eyes, (1, -1)) for c_eyes in c_eyes_lst[:n_frames]], axis=0).astype(np.float32)
+        template_dct['c_lip'] = np.concatenate([np.reshape(c_lip, (1, -1)) for c_lip in c_lip_lst[:n_frames]], axis=0).astype(np.float32)
+        return template_dct
 
-            c_eyes = c_eyes_lst[i].astype(np.float32)
-            template_dct['c_eyes_lst'].append(c_eyes)
+    def make_driving_keypoints(self, source_motion, driving_motion, n_frames, source_lmk, **kwargs):
+        """ compute the driving keypoints of all the animated frames in a few batched tensor ops, before rendering
+        source_motion: dict of 1x... (source image) or Nx... (source video) tensors, keys: 'kp', 'R', 'exp', 'scale', 't', 'x_s'
+        driving_motion: dict of Nx... tensors stacked from the driving template
+        source_lmk: the landmark of the source image, or the landmark list of the source video
+        i_d_0: the index of the driving frame which the relative motion refers to, i.e., the first frame with a face
+        return: Nxnum_kpx3, which can be consumed in any order or chunk size
+        """
+        inf_cfg = self.live_portrait_wrapper.inference_cfg
+        flag_is_source_video = kwargs.get('flag_is_source_video', False)
+        flag_normalize_lip = inf_cfg.flag_normalize_lip  # not overwrite
+        flag_source_video_eye_retargeting = inf_cfg.flag_source_video_eye_retargeting  # not overwrite
 
-            c_lip = c_lip_lst[i].astype(np.float32)
-            template_dct['c_lip_lst'].append(c_lip)
+        x_c_s, R_s, x_s = source_motion['kp'], source_motion['R'], source_motion['x_s']
+        x_s_batch = x_s.expand(n_frames, -1, -1)  # Nxnum_kpx3, the source image is broadcast over the frames
+        i_d_0 = kwargs.get('i_d_0', 0)
+        R_d = driving_motion['R']
+        R_d_0 = R_d[i_d_0:i_d_0 + 1]
+        x_d_0_info = {k: v[i_d_0:i_d_0 + 1] for k, v in driving_motion.items()}
 
+        lip_delta_before_animation, eye_delta_before_animation = None, None
+        # let lip-open scalar to be 0 at first
+        if flag_normalize_lip and inf_cfg.flag_relative_motion and source_lmk is not None:
+            c_d_lip_before_animation = [0.]
+            combined_lip_ratio_tensor_before_animation = self.live_portrait_wrapper.calc_combined_lip_ratio_batch([c_d_lip_before_animation] * x_s.shape[0], source_lmk)
+            lip_delta_before_animation = self.live_portrait_wrapper.retarget_lip(x_s, combined_lip_ratio_tensor_before_animation)
+            # only the frames whose lip-open scalar reaches the threshold are normalized
+            lip_delta_before_animation[combined_lip_ratio_tensor_before_animation[:, 0] < inf_cfg.lip_normalize_threshold] = 0
+
+        # let eye-open scalar to be the same as the first frame if the latter is eye-open state
+        if flag_is_source_video and flag_source_video_eye_retargeting and source_lmk is not None:
+            combined_eye_ratio_tensor_frame_zero = kwargs['c_s_eyes_lst'][0]
+            c_d_eye_before_animation_frame_zero = [[combined_eye_ratio_tensor_frame_zero[0][:2].mean()]]
+            if c_d_eye_before_animation_frame_zero[0][0] < inf_cfg.source_video_eye_retargeting_threshold:
+                c_d_eye_before_animation_frame_zero = [[0.39]]
+            combined_eye_ratio_tensor_before_animation = self.live_portrait_wrapper.calc_combined_eye_ratio_batch([c_d_eye_before_animation_frame_zero] * n_frames, source_lmk)
+            eye_delta_before_animation = self.live_portrait_wrapper.retarget_eye(x_s, combined_eye_ratio_tensor_before_animation)
 
-        return template_dct
+        if flag_is_source_video:
+            R_new = kwargs['x_d_r_smooth'] if inf_cfg.flag_video_editing_head_rotation else R_s
+            delta_new = kwargs['x_d_exp_smooth']
+            scale_new = source_motion['scale']
+            t_new = source_motion['t'] if inf_cfg.flag_relative_motion else driving_motion['t']
+        elif inf_cfg.flag_relative_motion:
+            R_new = (R_d @ R_d_0.permute(0, 2, 1)) @ R_s
+            delta_new = source_motion['exp'] + (driving_motion['exp'] - x_d_0_info['exp'])
+            scale_new = source_motion['scale'] * (driving_motion['scale'] / x_d_0_info['scale'])
+            t_new = source_motion['t'] + (driving_motion['t'] - x_d_0_info['t'])
+        else:
+            R_new = R_d
+            delta_new = driving_motion['exp']
+            scale_new = source_motion['scale']
+            t_new = driving_motion['t']
+
+        t_new = t_new.clone()
+        t_new[..., 2].fill_(0)  # zero tz
+        x_d_new = scale_new[..., None] * (x_c_s @ R_new + delta_new) + t_new[:, None, :]  # Nxnum_kpx3
+
+        if inf_cfg.driving_option == "expression-friendly" and not flag_is_source_video:
+            x_d_0_new = x_d_new[i_d_0:i_d_0 + 1]
+            motion_multiplier = calc_motion_multiplier(x_s, x_d_0_new)
+            # motion_multiplier *= inf_cfg.driving_multiplier
+            x_d_diff = (x_d_new - x_d_0_new) * motion_multiplier
+            x_d_new = x_d_diff + x_s
+
+        # Algorithm 1:
+        if not inf_cfg.flag_stitching and not inf_cfg.flag_eye_retargeting and not inf_cfg.flag_lip_retargeting:
+            # without stitching or retargeting
+            if flag_normalize_lip and lip_delta_before_animation is not None:
+                x_d_new += lip_delta_before_animation
+            if flag_source_video_eye_retargeting and eye_delta_before_animation is not None:
+                x_d_new += eye_delta_before_animation
+            else:
+                pass
+        elif inf_cfg.flag_stitching and not inf_cfg.flag_eye_retargeting and not inf_cfg.flag_lip_retargeting:
+            # with stitching and without retargeting
+            if flag_normalize_lip and lip_delta_before_animation is not None:
+                x_d_new = self.live_portrait_wrapper.stitching(x_s_batch, x_d_new) + lip_delta_before_animation
+            else:
+                x_d_new = self.live_portrait_wrapper.stitching(x_s_batch, x_d_new)
+            if flag_source_video_eye_retargeting and eye_delta_before_animation is not None:
+                x_d_new += eye_delta_before_animation
+        else:
+            eyes_delta, lip_delta = None, None
+            if inf_cfg.flag_eye_retargeting and source_lmk is not None:
+                combined_eye_ratio_tensor = self.live_portrait_wrapper.calc_combined_eye_ratio_batch(kwargs['c_d_eyes_lst'][:n_frames], source_lmk)
+                # ∆_eyes,i = R_eyes(x_s; c_s,eyes, c_d,eyes,i)
+                eyes_delta = self.live_portrait_wrapper.retarget_eye(x_s_batch, combined_eye_ratio_tensor)
+            if inf_cfg.flag_lip_retargeting and source_lmk is not None:
+                combined_lip_ratio_tensor = self.live_portrait_wrapper.calc_combined_lip_ratio_batch(kwargs['c_d_lip_lst'][:n_frames], source_lmk)
+                # ∆_lip,i = R_lip(x_s; c_s,lip, c_d,lip,i)
+                lip_delta = self.live_portrait_wrapper.retarget_lip(x_s_batch, combined_lip_ratio_tensor)
+
+            if inf_cfg.flag_relative_motion:  # use x_s
+                x_d_new = x_s_batch + \
+                    (eyes_delta if eyes_delta is not None else 0) + \
+                    (lip_delta if lip_delta is not None else 0)
+            else:  # use x_d,i
+                x_d_new = x_d_new + \
+                    (eyes_delta if eyes_delta is not None else 0) + \
+                    (lip_delta if lip_delta is not None else 0)
+
+            if inf_cfg.flag_stitching:
+                x_d_new = self.live_portrait_wrapper.stitching(x_s_batch, x_d_new)
+
+        x_d_new = x_s + (x_d_new - x_s) * inf_cfg.driving_multiplier
+        return x_d_new
+
+    def stream_driving_keypoints(self, source_motion, driving_motion, n_frames, source_lmk, batch_size, x_d_exp_lst, x_d_r_lst=None, **kwargs):
+        """ the driving keypoints of a source video, while its expressions (and rotations) are smoothed online
+        each frame is pushed to `OnlineSmoother` in turn, and a batch is yielded as soon as the smoother has released its frames,
+        i.e., the frame i is ready once the frame i + driving_smooth_lag is pushed, instead of after the whole sequence
+        x_d_exp_lst / x_d_r_lst: Nxnum_kpx3 / Nx3x3, the expressions and rotations before the smoothing, x_d_r_lst is None if the source rotation is kept
+        kwargs: see `make_driving_keypoints`
+        yield: (i_start, i_end, Bxnum_kpx3), the batches of batch_size frames in order
+        """
+        inf_cfg = self.live_portrait_wrapper.inference_cfg
+        device = self.live_portrait_wrapper.device
+        raw_dct = {'exp': x_d_exp_lst} if x_d_r_lst is None else {'exp': x_d_exp_lst, 'R': x_d_r_lst}
+        smoother_dct = {key: OnlineSmoother(inf_cfg.driving_smooth_observation_variance, lag=inf_cfg.driving_smooth_lag) for key in raw_dct}
+        ready_dct = {key: [] for key in raw_dct}  # the smoothed frames not yielded yet, from i_start on
+
+        i_start = 0
+        for i in range(n_frames + 1):
+            for key, smoother in smoother_dct.items():
+                if i < n_frames:
+                    x = smoother.push(np.asarray(raw_dct[key][i]).reshape(-1))
+                    ready_dct[key] += [] if x is None else [x]
+                else:
+                    ready_dct[key] += smoother.flush()
+
+            # the smoothers share the lag, so they release the same frames
+            while len(ready_dct['exp']) >= batch_size or (i == n_frames and len(ready_dct['exp']) > 0):
+                bs = min(batch_size, len(ready_dct['exp']))
+                i_end = i_start + bs
+                smoothed_dct = {}
+                for key, ready in ready_dct.items():
+                    smoothed_dct[key] = torch.tensor(np.stack(ready[:bs]).reshape(bs, *np.shape(raw_dct[key])[-2:]), dtype=torch.float32, device=device)
+                    ready_dct[key] = ready[bs:]
+
+                # the frames of a source video are independent, the relative motion is already in x_d_exp_lst and x_d_r_lst
+                x_d_new_batch = self.make_driving_keypoints(
+                    {k: v[i_start:i_end] for k, v in source_motion.items()},
+                    {k: v[i_start:i_end] for k, v in driving_motion.items()},
+                    bs, source_lmk[i_start:i_end],
+                    flag_is_source_video=True,
+                    c_s_eyes_lst=kwargs['c_s_eyes_lst'],  # only its first frame is referred to
+                    c_d_eyes_lst=kwargs['c_d_eyes_lst'][i_start:i_end],
+                    c_d_lip_lst=kwargs['c_d_lip_lst'][i_start:i_end],
+                    x_d_exp_smooth=smoothed_dct['exp'],
+                    x_d_r_smooth=smoothed_dct.get('R'),
+                )
+                yield i_start, i_end, x_d_new_batch
+                i_start = i_end
 
     def execute(self, args: ArgumentConfig):
         # for convenience
@@ -92,8 +264,8 @@ class LivePortraitPipeline(object):
             source_rgb_lst = [img_rgb]
         elif is_video(args.source):
             flag_is_source_video = True
-            source_rgb_lst = load_video(args.source)
-            source_rgb_lst = [resize_to_limit(img, inf_cfg.source_max_dim, inf_cfg.source_division) for img in source_rgb_lst]
+            # the frames are decoded lazily, each pass over the video decodes it again instead of holding all the frames
+            source_rgb_lst = VideoReader(args.source, transform=lambda img: resize_to_limit(img, inf_cfg.source_max_dim, inf_cfg.source_division))
             source_fps = int(get_fps(args.source))
             log(f"Load source video from {args.source}, FPS is {source_fps}")
         else:  # source input is an unknown format
@@ -107,9 +279,9 @@ class LivePortraitPipeline(object):
         if flag_load_from_template:
             # NOTE: load from template, it is fast, but the cropping video is None
             log(f"Load from template: {args.driving}, NOT the video, so the cropping video and audio are both NULL.", style='bold green')
-            driving_template_dct = load(args.driving)
-            c_d_eyes_lst = driving_template_dct['c_eyes_lst'] if 'c_eyes_lst' in driving_template_dct.keys() else driving_template_dct['c_d_eyes_lst'] # compatible with previous keys
-            c_d_lip_lst = driving_template_dct['c_lip_lst'] if 'c_lip_lst' in driving_template_dct.keys() else driving_template_dct['c_d_lip_lst']
+            driving_template_dct = load_motion_template(args.driving)  # the legacy .pkl template is converted on loading
+            c_d_eyes_lst = driving_template_dct['c_eyes']
+            c_d_lip_lst = driving_template_dct['c_lip']
             driving_n_frames = driving_template_dct['n_frames']
             if flag_is_source_video:
                 n_frames = min(len(source_rgb_lst), driving_n_frames)  # minimum number as the number of the animated frames
@@ -128,53 +300,51 @@ class LivePortraitPipeline(object):
             output_fps = int(get_fps(args.driving))
             log(f"Load driving video from: {args.driving}, FPS is {output_fps}")
 
-            driving_rgb_lst = load_video(args.driving)
-            driving_n_frames = len(driving_rgb_lst)
+            driving_rgb_lst = VideoReader(args.driving)  # decoded lazily
 
             ######## make motion template ########
             log("Start making driving motion template...")
             if flag_is_source_video:
-                n_frames = min(len(source_rgb_lst), driving_n_frames)  # minimum number as the number of the animated frames
+                n_frames = min(len(source_rgb_lst), len(driving_rgb_lst))  # minimum number as the number of the animated frames
                 driving_rgb_lst = driving_rgb_lst[:n_frames]
-            else:
-                n_frames = driving_n_frames
+            # every frame is kept, the frames with no face are marked in `valid_lst`
             if inf_cfg.flag_crop_driving_video or (not is_square_video(args.driving)):
-                ret_d = self.cropper.crop_driving_video(driving_rgb_lst)
+                ret_d = self.cropper.crop_driving_video(driving_rgb_lst, dsize_resize=256)  # only the 256x256 crops are kept
                 log(f'Driving video is cropped, {len(ret_d["frame_crop_lst"])} frames are processed.')
-                if len(ret_d["frame_crop_lst"]) is not n_frames:
-                    n_frames = min(n_frames, len(ret_d["frame_crop_lst"]))
-                driving_rgb_crop_lst, driving_lmk_crop_lst = ret_d['frame_crop_lst'], ret_d['lmk_crop_lst']
-                driving_rgb_crop_256x256_lst = [cv2.resize(_, (256, 256)) for _ in driving_rgb_crop_lst]
+                driving_rgb_crop_256x256_lst = ret_d['frame_crop_lst']
             else:
-                driving_lmk_crop_lst = self.cropper.calc_lmks_from_cropped_video(driving_rgb_lst)
+                ret_d = self.cropper.calc_lmks_from_cropped_video(driving_rgb_lst)
                 driving_rgb_crop_256x256_lst = [cv2.resize(_, (256, 256)) for _ in driving_rgb_lst]  # force to resize to 256x256
+            driving_lmk_crop_lst, driving_valid_lst = ret_d['lmk_crop_lst'], ret_d['valid_lst']
+            n_frames = len(driving_rgb_crop_256x256_lst)  # the frames which are actually decoded
             #######################################
 
             c_d_eyes_lst, c_d_lip_lst = self.live_portrait_wrapper.calc_ratio(driving_lmk_crop_lst)
             # save the motion template
-            I_d_lst = self.live_portrait_wrapper.prepare_videos(driving_rgb_crop_256x256_lst)
-            driving_template_dct = self.make_motion_template(I_d_lst, c_d_eyes_lst, c_d_lip_lst, output_fps=output_fps)
+            driving_template_dct = self.make_motion_template(driving_rgb_crop_256x256_lst, c_d_eyes_lst, c_d_lip_lst, output_fps=output_fps, valid_lst=driving_valid_lst)
 
-            wfp_template = remove_suffix(args.driving) + '.pkl'
-            dump(wfp_template, driving_template_dct)
+            wfp_template = remove_suffix(args.driving) + '.npz'
+            dump_motion_template(wfp_template, driving_template_dct)
             log(f"Dump motion template to {wfp_template}")
 
         else:
             raise Exception(f"{args.driving} not exists or unsupported driving info types!")
 
+        # the legacy template has no 'valid' column
+        frame_valid = np.array(driving_template_dct['valid'][:n_frames], dtype=bool) if 'valid' in driving_template_dct else np.ones(n_frames, dtype=bool)
+        if not frame_valid.any():
+            raise Exception("No face detected in the driving frames.")
+        i_d_0 = int(np.argmax(frame_valid))  # the relative motion refers to the first driving frame with a face
+
         ######## prepare for pasteback ########
-        I_p_pstbk_lst = None
-        if inf_cfg.flag_pasteback and inf_cfg.flag_do_crop and inf_cfg.flag_stitching:
-            I_p_pstbk_lst = []
+        flag_pasteback = inf_cfg.flag_pasteback and inf_cfg.flag_do_crop and inf_cfg.flag_stitching
+        flag_pasteback_on_device = flag_pasteback and inf_cfg.flag_pasteback_on_device and str(device) != 'cpu'  # cv2 is faster on the cpu
+        if flag_pasteback:
             log("Prepared pasteback mask done.")
 
-        I_p_lst = []
-        R_d_0, x_d_0_info = None, None
-        flag_normalize_lip = inf_cfg.flag_normalize_lip  # not overwrite
-        flag_source_video_eye_retargeting = inf_cfg.flag_source_video_eye_retargeting  # not overwrite
-        lip_delta_before_animation, eye_delta_before_animation = None, None
-
         ######## process source info ########
+        # the motion of a source video is smoothed online while rendering, or as a whole before it
+        flag_smooth_online = flag_is_source_video and inf_cfg.driving_smooth_lag >= 0
         if flag_is_source_video:
             log(f"Start making source motion template...")
 
@@ -182,212 +352,162 @@ class LivePortraitPipeline(object):
             if inf_cfg.flag_do_crop:
                 ret_s = self.cropper.crop_source_video(source_rgb_lst, crop_cfg)
                 log(f'Source video is cropped, {len(ret_s["frame_crop_lst"])} frames are processed.')
-                if len(ret_s["frame_crop_lst"]) is not n_frames:
-                    n_frames = min(n_frames, len(ret_s["frame_crop_lst"]))
-                img_crop_256x256_lst, source_lmk_crop_lst, source_M_c2o_lst = ret_s['frame_crop_lst'], ret_s['lmk_crop_lst'], ret_s['M_c2o_lst']
+                img_crop_256x256_lst, source_M_c2o_lst = ret_s['frame_crop_lst'], ret_s['M_c2o_lst']
             else:
-                source_lmk_crop_lst = self.cropper.calc_lmks_from_cropped_video(source_rgb_lst)
+                ret_s = self.cropper.calc_lmks_from_cropped_video(source_rgb_lst)
                 img_crop_256x256_lst = [cv2.resize(_, (256, 256)) for _ in source_rgb_lst]  # force to resize to 256x256
+            source_lmk_crop_lst = ret_s['lmk_crop_lst']
+            n_frames = min(n_frames, len(img_crop_256x256_lst))  # the frames which are actually decoded
+            frame_valid = frame_valid[:n_frames] & np.asarray(ret_s['valid_lst'][:n_frames], dtype=bool)
 
             c_s_eyes_lst, c_s_lip_lst = self.live_portrait_wrapper.calc_ratio(source_lmk_crop_lst)
             # save the motion template
-            I_s_lst = self.live_portrait_wrapper.prepare_videos(img_crop_256x256_lst)
-            source_template_dct = self.make_motion_template(I_s_lst, c_s_eyes_lst, c_s_lip_lst, output_fps=source_fps)
+            source_template_dct = self.make_motion_template(img_crop_256x256_lst, c_s_eyes_lst, c_s_lip_lst, output_fps=source_fps, valid_lst=ret_s['valid_lst'])
 
-            key_r = 'R' if 'R' in driving_template_dct['motion'][0].keys() else 'R_d'  # compatible with previous keys
+            # the smoothing inputs are computed on whole columns
             if inf_cfg.flag_relative_motion:
-                x_d_exp_lst = [source_template_dct['motion'][i]['exp'] + driving_template_dct['motion'][i]['exp'] - driving_template_dct['motion'][0]['exp'] for i in range(n_frames)]
-                x_d_exp_lst_smooth = smooth(x_d_exp_lst, source_template_dct['motion'][0]['exp'].shape, device, inf_cfg.driving_smooth_observation_variance)
-                if inf_cfg.flag_video_editing_head_rotation:
-                    x_d_r_lst = [(np.dot(driving_template_dct['motion'][i][key_r], driving_template_dct['motion'][0][key_r].transpose(0, 2, 1))) @ source_template_dct['motion'][i]['R'] for i in range(n_frames)]
-                    x_d_r_lst_smooth = smooth(x_d_r_lst, source_template_dct['motion'][0]['R'].shape, device, inf_cfg.driving_smooth_observation_variance)
+                x_d_exp_lst = source_template_dct['exp'][:n_frames] + driving_template_dct['exp'][:n_frames] - driving_template_dct['exp'][i_d_0:i_d_0 + 1]
+                x_d_r_lst = driving_template_dct['R'][:n_frames] @ driving_template_dct['R'][i_d_0:i_d_0 + 1].transpose(0, 2, 1) @ source_template_dct['R'][:n_frames] if inf_cfg.flag_video_editing_head_rotation else None
             else:
-                x_d_exp_lst = [driving_template_dct['motion'][i]['exp'] for i in range(n_frames)]
-                x_d_exp_lst_smooth = smooth(x_d_exp_lst, source_template_dct['motion'][0]['exp'].shape, device, inf_cfg.driving_smooth_observation_variance)
-                if inf_cfg.flag_video_editing_head_rotation:
-                    x_d_r_lst = [driving_template_dct['motion'][i][key_r] for i in range(n_frames)]
-                    x_d_r_lst_smooth = smooth(x_d_r_lst, source_template_dct['motion'][0]['R'].shape, device, inf_cfg.driving_smooth_observation_variance)
+                x_d_exp_lst = driving_template_dct['exp'][:n_frames]
+                x_d_r_lst = driving_template_dct['R'][:n_frames] if inf_cfg.flag_video_editing_head_rotation else None
+
+            source_motion = motion2device(source_template_dct, device, n_frames)
+            source_lmk = source_lmk_crop_lst[:n_frames]
+            keypoint_kwargs = {'c_s_eyes_lst': c_s_eyes_lst}
+            if not flag_smooth_online:
+                # the whole sequence is smoothed before rendering
+                x_d_exp_lst_smooth = smooth(x_d_exp_lst, source_template_dct['exp'].shape, device, inf_cfg.driving_smooth_observation_variance)
+                keypoint_kwargs['x_d_exp_smooth'] = torch.stack(x_d_exp_lst_smooth)
+                if x_d_r_lst is not None:
+                    x_d_r_lst_smooth = smooth(x_d_r_lst, source_template_dct['R'].shape, device, inf_cfg.driving_smooth_observation_variance)
+                    keypoint_kwargs['x_d_r_smooth'] = torch.stack(x_d_r_lst_smooth)
+            warp_source = None  # the source features differ per frame
 
         else:  # if the input is a source image, process it only once
-            if inf_cfg.flag_do_crop:
-                crop_info = self.cropper.crop_source_image(source_rgb_lst[0], crop_cfg)
-                if crop_info is None:
-                    raise Exception("No face detected in the source image!")
-                source_lmk = crop_info['lmk_crop']
-                img_crop_256x256 = crop_info['img_crop_256x256']
-            else:
-                source_lmk = self.cropper.calc_lmk_from_cropped_image(source_rgb_lst[0])
-                img_crop_256x256 = cv2.resize(source_rgb_lst[0], (256, 256))  # force to resize to 256x256
-            I_s = self.live_portrait_wrapper.prepare_source(img_crop_256x256)
-            x_s_info = self.live_portrait_wrapper.get_kp_info(I_s)
-            x_c_s = x_s_info['kp']
-            R_s = get_rotation_matrix(x_s_info['pitch'], x_s_info['yaw'], x_s_info['roll'])
-            f_s = self.live_portrait_wrapper.extract_feature_3d(I_s)
-            x_s = self.live_portrait_wrapper.transform_keypoint(x_s_info)
-
-            # let lip-open scalar to be 0 at first
-            if flag_normalize_lip and inf_cfg.flag_relative_motion and source_lmk is not None:
-                c_d_lip_before_animation = [0.]
-                combined_lip_ratio_tensor_before_animation = self.live_portrait_wrapper.calc_combined_lip_ratio(c_d_lip_before_animation, source_lmk)
-                if combined_lip_ratio_tensor_before_animation[0][0] >= inf_cfg.lip_normalize_threshold:
-                    lip_delta_before_animation = self.live_portrait_wrapper.retarget_lip(x_s, combined_lip_ratio_tensor_before_animation)
-
-            if inf_cfg.flag_pasteback and inf_cfg.flag_do_crop and inf_cfg.flag_stitching:
-                mask_ori_float = prepare_paste_back(inf_cfg.mask_crop, crop_info['M_c2o'], dsize=(source_rgb_lst[0].shape[1], source_rgb_lst[0].shape[0]))
+            source_dct = self.prepare_source_image(source_rgb_lst[0], crop_cfg, flag_do_crop=inf_cfg.flag_do_crop)
+            source_lmk, img_crop_256x256, source_M_c2o = source_dct['source_lmk'], source_dct['img_crop_256x256'], source_dct['M_c2o']
+            x_s_info, R_s, f_s, x_s = source_dct['x_s_info'], source_dct['R_s'], source_dct['f_s'], source_dct['x_s']
+
+            source_motion = {
+                'kp': x_s_info['kp'],
+                'R': R_s,
+                'exp': x_s_info['exp'],
+                'scale': x_s_info['scale'],
+                't': x_s_info['t'],
+                'x_s': x_s,
+            }
+            keypoint_kwargs = {}
+            warp_source = self.live_portrait_wrapper.prepare_warp_source(f_s, x_s)  # the source image is fixed over the frames
+
+            if flag_pasteback_on_device:
+                # the grid, the mask and the source image stay on the device
+                pstbk_dct = prepare_paste_back_torch(inf_cfg.mask_crop, source_M_c2o, source_rgb_lst[0], device)
+            elif flag_pasteback:
+                mask_ori_float = source_dct['mask_ori']
+
+        ######## make driving keypoints ########
+        # the whole driving template is moved to the device at once
+        driving_motion = motion2device(driving_template_dct, device, n_frames)
+        batch_size = max(inf_cfg.animation_batch_size, 1)
+        if flag_smooth_online:
+            # a batch is rendered as soon as the smoother has released its frames
+            keypoint_batches = self.stream_driving_keypoints(
+                source_motion, driving_motion, n_frames, source_lmk, batch_size, x_d_exp_lst, x_d_r_lst,
+                c_d_eyes_lst=c_d_eyes_lst,
+                c_d_lip_lst=c_d_lip_lst,
+                **keypoint_kwargs
+            )
+        else:
+            x_d_new_all = self.make_driving_keypoints(
+                source_motion, driving_motion, n_frames, source_lmk,
+                flag_is_source_video=flag_is_source_video,
+                i_d_0=i_d_0,
+                c_d_eyes_lst=c_d_eyes_lst,
+                c_d_lip_lst=c_d_lip_lst,
+                **keypoint_kwargs
+            )  # Nxnum_kpx3
+            keypoint_batches = ((i_start, min(i_start + batch_size, n_frames), x_d_new_all[i_start:i_start + batch_size]) for i_start in range(0, n_frames, batch_size))
 
         ######## animate ########
-        log(f"The animated video consists of {n_frames} frames.")
-        for i in track(range(n_frames), description='🚀Animating...', total=n_frames):
-            if flag_is_source_video:  # source video
-                x_s_info = source_template_dct['motion'][i]
-                x_s_info = dct2device(x_s_info, device)
-
-                source_lmk = source_lmk_crop_lst[i]
-                img_crop_256x256 = img_crop_256x256_lst[i]
-                I_s = I_s_lst[i]
-                f_s = self.live_portrait_wrapper.extract_feature_3d(I_s)
-
-                x_c_s = x_s_info['kp']
-                R_s = x_s_info['R']
-                x_s =x_s_info['x_s']
-
-                # let lip-open scalar to be 0 at first if the input is a video
-                if flag_normalize_lip and inf_cfg.flag_relative_motion and source_lmk is not None:
-                    c_d_lip_before_animation = [0.]
-                    combined_lip_ratio_tensor_before_animation = self.live_portrait_wrapper.calc_combined_lip_ratio(c_d_lip_before_animation, source_lmk)
-                    if combined_lip_ratio_tensor_before_animation[0][0] >= inf_cfg.lip_normalize_threshold:
-                        lip_delta_before_animation = self.live_portrait_wrapper.retarget_lip(x_s, combined_lip_ratio_tensor_before_animation)
-                    else:
-                        lip_delta_before_animation = None
-
-                # let eye-open scalar to be the same as the first frame if the latter is eye-open state
-                if flag_source_video_eye_retargeting and source_lmk is not None:
-                    if i == 0:
-                        combined_eye_ratio_tensor_frame_zero = c_s_eyes_lst[0]
-                        c_d_eye_before_animation_frame_zero = [[combined_eye_ratio_tensor_frame_zero[0][:2].mean()]]
-                        if c_d_eye_before_animation_frame_zero[0][0] < inf_cfg.source_video_eye_retargeting_threshold:
-                            c_d_eye_before_animation_frame_zero = [[0.39]]
-                    combined_eye_ratio_tensor_before_animation = self.live_portrait_wrapper.calc_combined_eye_ratio(c_d_eye_before_animation_frame_zero, source_lmk)
-                    eye_delta_before_animation = self.live_portrait_wrapper.retarget_eye(x_s, combined_eye_ratio_tensor_before_animation)
-
-                if inf_cfg.flag_pasteback and inf_cfg.flag_do_crop and inf_cfg.flag_stitching:  # prepare for paste back
-                    mask_ori_float = prepare_paste_back(inf_cfg.mask_crop, source_M_c2o_lst[i], dsize=(source_rgb_lst[i].shape[1], source_rgb_lst[i].shape[0]))
-
-            x_d_i_info = driving_template_dct['motion'][i]
-            x_d_i_info = dct2device(x_d_i_info, device)
-            R_d_i = x_d_i_info['R'] if 'R' in x_d_i_info.keys() else x_d_i_info['R_d']  # compatible with previous keys
-
-            if i == 0:  # cache the first frame
-                R_d_0 = R_d_i
-                x_d_0_info = x_d_i_info
-
-            if inf_cfg.flag_relative_motion:
+        mkdir(args.output_dir)
+        # NOTE: update output fps
+        output_fps = source_fps if flag_is_source_video else output_fps
+        wfp_concat = osp.join(args.output_dir, f'{basename(args.source)}--{basename(args.driving)}_concat.mp4')
+        wfp = osp.join(args.output_dir, f'{basename(args.source)}--{basename(args.driving)}.mp4')
+        # the animated result and the concatenation result are encoded concurrently in the background while rendering
+        video_sink = VideoSink(wfp=wfp, fps=output_fps)
+        video_sink_concat = VideoSink(wfp=wfp_concat, fps=output_fps)
+
+        def postprocess(i, I_p_i, I_p_pstbk, source_rgb_i):
+            """paste back (on the cpu) and concatenate the frame #i, it runs in the worker threads"""
+            # driving frame | source frame | generation, or source frame | generation
+            driving_image = None if driving_rgb_crop_256x256_lst is None else driving_rgb_crop_256x256_lst[i]
+            source_image = img_crop_256x256_lst[i] if flag_is_source_video else img_crop_256x256
+            if not frame_valid[i]:
+                # no face: pass through
+                I_p_i = cv2.resize(source_image, (I_p_i.shape[1], I_p_i.shape[0]))
+                if flag_pasteback:
+                    return (source_rgb_i if flag_is_source_video else source_rgb_lst[0]), concat_frame(driving_image, source_image, I_p_i)
+                return I_p_i, concat_frame(driving_image, source_image, I_p_i)
+
+            if flag_pasteback and I_p_pstbk is None:
                 if flag_is_source_video:
-                    if inf_cfg.flag_video_editing_head_rotation:
-                        R_new = x_d_r_lst_smooth[i]
-                    else:
-                        R_new = R_s
+                    mask_ori_float_i = prepare_paste_back(inf_cfg.mask_crop, source_M_c2o_lst[i], dsize=(source_rgb_i.shape[1], source_rgb_i.shape[0]))
+                    I_p_pstbk = paste_back(I_p_i, source_M_c2o_lst[i], source_rgb_i, mask_ori_float_i)
                 else:
-                    R_new = (R_d_i @ R_d_0.permute(0, 2, 1)) @ R_s
+                    I_p_pstbk = paste_back(I_p_i, source_M_c2o, source_rgb_lst[0], mask_ori_float)
 
-                delta_new = x_d_exp_lst_smooth[i] if flag_is_source_video else x_s_info['exp'] + (x_d_i_info['exp'] - x_d_0_info['exp'])
-                scale_new = x_s_info['scale'] if flag_is_source_video else x_s_info['scale'] * (x_d_i_info['scale'] / x_d_0_info['scale'])
-                t_new = x_s_info['t'] if flag_is_source_video else x_s_info['t'] + (x_d_i_info['t'] - x_d_0_info['t'])
-            else:
-                if flag_is_source_video:
-                    if inf_cfg.flag_video_editing_head_rotation:
-                        R_new = x_d_r_lst_smooth[i]
-                    else:
-                        R_new = R_s
-                else:
-                    R_new = R_d_i
-                delta_new = x_d_exp_lst_smooth[i] if flag_is_source_video else x_d_i_info['exp']
-                scale_new = x_s_info['scale']
-                t_new = x_d_i_info['t']
-
-            t_new[..., 2].fill_(0)  # zero tz
-            x_d_i_new = scale_new * (x_c_s @ R_new + delta_new) + t_new
-
-            if inf_cfg.driving_option == "expression-friendly" and not flag_is_source_video:
-                if i == 0:
-                    x_d_0_new = x_d_i_new
-                    motion_multiplier = calc_motion_multiplier(x_s, x_d_0_new)
-                    # motion_multiplier *= inf_cfg.driving_multiplier
-                x_d_diff = (x_d_i_new - x_d_0_new) * motion_multiplier
-                x_d_i_new = x_d_diff + x_s
-
-            # Algorithm 1:
-            if not inf_cfg.flag_stitching and not inf_cfg.flag_eye_retargeting and not inf_cfg.flag_lip_retargeting:
-                # without stitching or retargeting
-                if flag_normalize_lip and lip_delta_before_animation is not None:
-                    x_d_i_new += lip_delta_before_animation
-                if flag_source_video_eye_retargeting and eye_delta_before_animation is not None:
-                    x_d_i_new += eye_delta_before_animation
-                else:
-                    pass
-            elif inf_cfg.flag_stitching and not inf_cfg.flag_eye_retargeting and not inf_cfg.flag_lip_retargeting:
-                # with stitching and without retargeting
-                if flag_normalize_lip and lip_delta_before_animation is not None:
-                    x_d_i_new = self.live_portrait_wrapper.stitching(x_s, x_d_i_new) + lip_delta_before_animation
-                else:
-                    x_d_i_new = self.live_portrait_wrapper.stitching(x_s, x_d_i_new)
-                if flag_source_video_eye_retargeting and eye_delta_before_animation is not None:
-                    x_d_i_new += eye_delta_before_animation
-            else:
-                eyes_delta, lip_delta = None, None
-                if inf_cfg.flag_eye_retargeting and source_lmk is not None:
-                    c_d_eyes_i = c_d_eyes_lst[i]
-                    combined_eye_ratio_tensor = self.live_portrait_wrapper.calc_combined_eye_ratio(c_d_eyes_i, source_lmk)
-                    # ∆_eyes,i = R_eyes(x_s; c_s,eyes, c_d,eyes,i)
-                    eyes_delta = self.live_portrait_wrapper.retarget_eye(x_s, combined_eye_ratio_tensor)
-                if inf_cfg.flag_lip_retargeting and source_lmk is not None:
-                    c_d_lip_i = c_d_lip_lst[i]
-                    combined_lip_ratio_tensor = self.live_portrait_wrapper.calc_combined_lip_ratio(c_d_lip_i, source_lmk)
-                    # ∆_lip,i = R_lip(x_s; c_s,lip, c_d,lip,i)
-                    lip_delta = self.live_portrait_wrapper.retarget_lip(x_s, combined_lip_ratio_tensor)
-
-                if inf_cfg.flag_relative_motion:  # use x_s
-                    x_d_i_new = x_s + \
-                        (eyes_delta if eyes_delta is not None else 0) + \
-                        (lip_delta if lip_delta is not None else 0)
-                else:  # use x_d,i
-                    x_d_i_new = x_d_i_new + \
-                        (eyes_delta if eyes_delta is not None else 0) + \
-                        (lip_delta if lip_delta is not None else 0)
-
-                if inf_cfg.flag_stitching:
-                    x_d_i_new = self.live_portrait_wrapper.stitching(x_s, x_d_i_new)
-
-            x_d_i_new = x_s + (x_d_i_new - x_s) * inf_cfg.driving_multiplier
-            out = self.live_portrait_wrapper.warp_decode(f_s, x_s, x_d_i_new)
-            I_p_i = self.live_portrait_wrapper.parse_output(out['out'])[0]
-            I_p_lst.append(I_p_i)
-
-            if inf_cfg.flag_pasteback and inf_cfg.flag_do_crop and inf_cfg.flag_stitching:
-                # TODO: the paste back procedure is slow, considering optimize it using multi-threading or GPU
-                if flag_is_source_video:
-                    I_p_pstbk = paste_back(I_p_i, source_M_c2o_lst[i], source_rgb_lst[i], mask_ori_float)
+            return (I_p_pstbk if flag_pasteback else I_p_i), concat_frame(driving_image, source_image, I_p_i)
+
+        def write_frame(ret):
+            video_sink.write(ret[0])
+            video_sink_concat.write(ret[1])
+
+        # the post-processing of a frame overlaps with the rendering of the next ones, the results are written in the frame order
+        frame_pool = FrameWorkerPool(inf_cfg.postprocess_num_workers, write_frame)
+
+        log(f"The animated video consists of {n_frames} frames.")
+        if flag_is_source_video and flag_pasteback:
+            source_rgb_iter = iter(source_rgb_lst)  # the original frames are decoded again for pasting back
+        try:
+            for i_start, i_end, x_d_new_batch in track(keypoint_batches, description='🚀Animating...', total=(n_frames + batch_size - 1) // batch_size):
+                # the frames [i_start, i_end) are animated in one pass
+                bs = i_end - i_start
+
+                if flag_is_source_video:  # source video
+                    I_s_batch = self.live_portrait_wrapper.prepare_videos(img_crop_256x256_lst[i_start:i_end])[:, 0]  # Bx3xHxW, only the batch is on the device
+                    f_s = self.live_portrait_wrapper.extract_feature_3d(I_s_batch)
+                    x_s_batch = source_motion['x_s'][i_start:i_end]
                 else:
-                    I_p_pstbk = paste_back(I_p_i, crop_info['M_c2o'], source_rgb_lst[0], mask_ori_float)
-                I_p_pstbk_lst.append(I_p_pstbk)
+                    x_s_batch = x_s.expand(bs, -1, -1)  # BxNx3, the source image is broadcast over the batch
+
+                out = self.live_portrait_wrapper.warp_decode(f_s.expand(bs, -1, -1, -1, -1), x_s_batch, x_d_new_batch, warp_source=warp_source)
+                I_p_batch = self.live_portrait_wrapper.parse_output(out['out'])  # BxHxWx3
+                if flag_pasteback_on_device and not flag_is_source_video:
+                    I_p_pstbk_batch = paste_back_torch(out['out'], pstbk_dct)  # the whole batch is pasted back at once
+
+                for i, I_p_i in zip(range(i_start, i_end), I_p_batch):
+                    I_p_pstbk, source_rgb_i = None, None
+                    if flag_is_source_video and flag_pasteback:
+                        source_rgb_i = next(source_rgb_iter)
+                        if flag_pasteback_on_device and frame_valid[i]:
+                            pstbk_dct = prepare_paste_back_torch(inf_cfg.mask_crop, source_M_c2o_lst[i], source_rgb_i, device)
+                            I_p_pstbk = paste_back_torch(out['out'][i - i_start:i - i_start + 1], pstbk_dct)[0]
+                    elif flag_pasteback_on_device:
+                        I_p_pstbk = I_p_pstbk_batch[i - i_start]
+                    frame_pool.submit(i, postprocess, i, I_p_i, I_p_pstbk, source_rgb_i)
+        finally:
+            try:
+                frame_pool.close()
+            finally:
+                video_sink.close()
+                video_sink_concat.close()
 
-        mkdir(args.output_dir)
-        wfp_concat = None
         flag_source_has_audio = flag_is_source_video and has_audio_stream(args.source)
         flag_driving_has_audio = (not flag_load_from_template) and has_audio_stream(args.driving)
 
         ######### build the final concatenation result #########
-        # driving frame | source frame | generation, or source frame | generation
-        if flag_is_source_video:
-            frames_concatenated = concat_frames(driving_rgb_crop_256x256_lst, img_crop_256x256_lst, I_p_lst)
-        else:
-            frames_concatenated = concat_frames(driving_rgb_crop_256x256_lst, [img_crop_256x256], I_p_lst)
-        wfp_concat = osp.join(args.output_dir, f'{basename(args.source)}--{basename(args.driving)}_concat.mp4')
-
-        # NOTE: update output fps
-        output_fps = source_fps if flag_is_source_video else output_fps
-        images2video(frames_concatenated, wfp=wfp_concat, fps=output_fps)
-
         if flag_source_has_audio or flag_driving_has_audio:
             # final result with concatenation
             wfp_concat_with_audio = osp.join(args.output_dir, f'{basename(args.source)}--{basename(args.driving)}_concat_with_audio.mp4')
@@ -397,13 +517,6 @@ class LivePortraitPipeline(object):
             os.replace(wfp_concat_with_audio, wfp_concat)
             log(f"Replace {wfp_concat_with_audio} with {wfp_concat}")
 
-        # save the animated result
-        wfp = osp.join(args.output_dir, f'{basename(args.source)}--{basename(args.driving)}.mp4')
-        if I_p_pstbk_lst is not None and len(I_p_pstbk_lst) > 0:
-            images2video(I_p_pstbk_lst, wfp=wfp, fps=output_fps)
-        else:
-            images2video(I_p_lst, wfp=wfp, fps=output_fps)
-
         ######### build the final result #########
         if flag_source_has_audio or flag_driving_has_audio:
             wfp_with_audio = osp.join(args.output_dir, f'{basename(args.source)}--{basename(args.driving)}_with_audio.mp4')
@@ -23,10 +23,10 @@ from .config.inference_config import InferenceConfig
 from .config.crop_config import CropConfig
 from .utils.cropper import Cropper
 from .utils.camera import get_rotation_matrix
-from .utils.video import images2video, concat_frames, get_fps, add_audio_to_video, has_audio_stream, video2gif
-from .utils.crop import _transform_img, prepare_paste_back, paste_back
-from .utils.io import load_image_rgb, load_video, resize_to_limit, dump, load
-from .utils.helper import mkdir, basename, dct2device, is_video, is_template, remove_suffix, is_image, calc_motion_multiplier
+from .utils.video import VideoSink, FrameWorkerPool, concat_frame, get_fps, add_audio_to_video, has_audio_stream, video2gif
+from .utils.crop import _transform_img, prepare_paste_back, paste_back, prepare_paste_back_torch, paste_back_torch
+from .utils.io import load_image_rgb, VideoReader, resize_to_limit, load_motion_template, dump_motion_template
+from .utils.helper import mkdir, basename, motion2device, make_motion_template, is_video, is_template, remove_suffix, is_image, calc_motion_multiplier
 from .utils.rprint import rlog as log
 # from .utils.viz import viz_lmk
 from .live_portrait_wrapper import LivePortraitWrapperAnimal
@@ -42,29 +42,9 @@ class LivePortraitPipelineAnimal(object):
         self.cropper: Cropper = Cropper(crop_cfg=crop_cfg, image_type='animal_face', flag_use_half_precision=inference_cfg.flag_use_half_precision)
 
     def make_motion_template(self, I_lst, **kwargs):
-        n_frames = I_lst.shape[0]
-        template_dct = {
-            'n_frames': n_frames,
-            'output_fps': kwargs.get('output_fps', 25),
-            'motion': [],
-        }
-
-        for i in track(range(n_frames), description='Making driving motion templates...', total=n_frames):
-            # collect s, R, δ and t for inference
-            I_i = I_lst[i]
-            x_i_info = self.live_portrait_wrapper_animal.get_kp_info(I_i)
-            R_i = get_rotation_matrix(x_i_info['pitch'], x_i_info['yaw'], x_i_info['roll'])
-
-            item_dct = {
-                'scale': x_i_info['scale'].cpu().numpy().astype(np.float32),
-                'R': R_i.cpu().numpy().astype(np.float32),
-                'exp': x_i_info['exp'].cpu().numpy().astype(np.float32),
-                't': x_i_info['t'].cpu().numpy().astype(np.float32),
-            }
-
-            template_dct['motion'].append(item_dct)
-
-        return template_dct
+        """see `helper.make_motion_template`, without the keypoints"""
+        batch_size = max(kwargs.pop('batch_size', self.live_portrait_wrapper_animal.inference_cfg.template_batch_size), 1)
+        return make_motion_template(self.live_portrait_wrapper_animal, I_lst, batch_size, flag_keypoints=False, description='Making driving motion templates...', **kwargs)
 
     def execute(self, args: ArgumentConfig):
         # for convenience
@@ -88,7 +68,7 @@ class LivePortraitPipelineAnimal(object):
         if flag_load_from_template:
             # NOTE: load from template, it is fast, but the cropping video is None
             log(f"Load from template: {args.driving}, NOT the video, so the cropping video and audio are both NULL.", style='bold green')
-            driving_template_dct = load(args.driving)
+            driving_template_dct = load_motion_template(args.driving)  # the legacy .pkl template is converted on loading
             n_frames = driving_template_dct['n_frames']
 
             # set output_fps
@@ -103,37 +83,40 @@ class LivePortraitPipelineAnimal(object):
             output_fps = int(get_fps(args.driving))
             log(f"Load driving video from: {args.driving}, FPS is {output_fps}")
 
-            driving_rgb_lst = load_video(args.driving)
-            n_frames = len(driving_rgb_lst)
+            driving_rgb_lst = VideoReader(args.driving)  # decoded lazily
 
             ######## make motion template ########
             log("Start making driving motion template...")
+            driving_valid_lst = None
             if inf_cfg.flag_crop_driving_video:
-                ret_d = self.cropper.crop_driving_video(driving_rgb_lst)
+                # every frame is kept, the frames with no face are marked in `valid_lst`
+                ret_d = self.cropper.crop_driving_video(driving_rgb_lst, dsize_resize=256)  # only the 256x256 crops are kept
                 log(f'Driving video is cropped, {len(ret_d["frame_crop_lst"])} frames are processed.')
-                if len(ret_d["frame_crop_lst"]) is not n_frames:
-                    n_frames = min(n_frames, len(ret_d["frame_crop_lst"]))
-                driving_rgb_crop_lst = ret_d['frame_crop_lst']
-                driving_rgb_crop_256x256_lst = [cv2.resize(_, (256, 256)) for _ in driving_rgb_crop_lst]
+                driving_rgb_crop_256x256_lst, driving_valid_lst = ret_d['frame_crop_lst'], ret_d['valid_lst']
             else:
                 driving_rgb_crop_256x256_lst = [cv2.resize(_, (256, 256)) for _ in driving_rgb_lst]  # force to resize to 256x256
+            n_frames = len(driving_rgb_crop_256x256_lst)  # the frames which are actually decoded
             #######################################
 
             # save the motion template
-            I_d_lst = self.live_portrait_wrapper_animal.prepare_videos(driving_rgb_crop_256x256_lst)
-            driving_template_dct = self.make_motion_template(I_d_lst, output_fps=output_fps)
+            driving_template_dct = self.make_motion_template(driving_rgb_crop_256x256_lst, output_fps=output_fps, valid_lst=driving_valid_lst)
 
-            wfp_template = remove_suffix(args.driving) + '.pkl'
-            dump(wfp_template, driving_template_dct)
+            wfp_template = remove_suffix(args.driving) + '.npz'
+            dump_motion_template(wfp_template, driving_template_dct)
             log(f"Dump motion template to {wfp_template}")
 
         else:
             raise Exception(f"{args.driving} not exists or unsupported driving info types!")
 
+        # the legacy template has no 'valid' column
+        frame_valid = np.array(driving_template_dct['valid'][:n_frames], dtype=bool) if 'valid' in driving_template_dct else np.ones(n_frames, dtype=bool)
+        if not frame_valid.any():
+            raise Exception("No face detected in the driving frames.")
+
         ######## prepare for pasteback ########
-        I_p_pstbk_lst = None
-        if inf_cfg.flag_pasteback and inf_cfg.flag_do_crop and inf_cfg.flag_stitching:
-            I_p_pstbk_lst = []
+        flag_pasteback = inf_cfg.flag_pasteback and inf_cfg.flag_do_crop and inf_cfg.flag_stitching
+        flag_pasteback_on_device = flag_pasteback and inf_cfg.flag_pasteback_on_device and str(device) != 'cpu'  # cv2 is faster on the cpu
+        if flag_pasteback:
             log("Prepared pasteback mask done.")
 
         ######## process source info ########
@@ -151,55 +134,88 @@ class LivePortraitPipelineAnimal(object):
         f_s = self.live_portrait_wrapper_animal.extract_feature_3d(I_s)
         x_s = self.live_portrait_wrapper_animal.transform_keypoint(x_s_info)
 
-        if inf_cfg.flag_pasteback and inf_cfg.flag_do_crop and inf_cfg.flag_stitching:
+        if flag_pasteback_on_device:
+            # the grid, the mask and the source image stay on the device
+            pstbk_dct = prepare_paste_back_torch(inf_cfg.mask_crop, crop_info['M_c2o'], img_rgb, device)
+        elif flag_pasteback:
             mask_ori_float = prepare_paste_back(inf_cfg.mask_crop, crop_info['M_c2o'], dsize=(img_rgb.shape[1], img_rgb.shape[0]))
 
         ######## animate ########
-        I_p_lst = []
-        for i in track(range(n_frames), description='🚀Animating...', total=n_frames):
+        mkdir(args.output_dir)
+        wfp_concat = osp.join(args.output_dir, f'{basename(args.source)}--{basename(args.driving)}_concat.mp4')
+        wfp = osp.join(args.output_dir, f'{basename(args.source)}--{basename(args.driving)}.mp4')
+        # the animated result and the concatenation result are encoded concurrently in the background while rendering
+        video_sink = VideoSink(wfp=wfp, fps=output_fps)
+        video_sink_concat = VideoSink(wfp=wfp_concat, fps=output_fps)
+
+        def postprocess(i, I_p_i, I_p_pstbk):
+            """paste back (on the cpu) and concatenate the frame #i, it runs in the worker threads"""
+            driving_image = None if driving_rgb_crop_256x256_lst is None else driving_rgb_crop_256x256_lst[i]
+            if not frame_valid[i]:
+                # no face: pass through
+                I_p_i = cv2.resize(img_crop_256x256, (512, 512))
+                return (img_rgb if flag_pasteback else I_p_i), concat_frame(driving_image, img_crop_256x256, I_p_i)
+
+            if flag_pasteback and I_p_pstbk is None:
+                I_p_pstbk = paste_back(I_p_i, crop_info['M_c2o'], img_rgb, mask_ori_float)
 
-            x_d_i_info = driving_template_dct['motion'][i]
-            x_d_i_info = dct2device(x_d_i_info, device)
+            # driving frame | source image | generation
+            return (I_p_pstbk if flag_pasteback else I_p_i), concat_frame(driving_image, img_crop_256x256, I_p_i)
 
-            R_d_i = x_d_i_info['R'] if 'R' in x_d_i_info.keys() else x_d_i_info['R_d']  # compatible with previous keys
-            delta_new = x_d_i_info['exp']
-            t_new = x_d_i_info['t']
-            t_new[..., 2].fill_(0)  # zero tz
-            scale_new = x_s_info['scale']
+        def write_frame(ret):
+            video_sink.write(ret[0])
+            video_sink_concat.write(ret[1])
 
-            x_d_i = scale_new * (x_c_s @ R_d_i + delta_new) + t_new
+        # the post-processing of a frame overlaps with the rendering of the next ones, the results are written in the frame order
+        frame_pool = FrameWorkerPool(inf_cfg.postprocess_num_workers, write_frame)
 
-            if i == 0:
-                x_d_0 = x_d_i
-                motion_multiplier = calc_motion_multiplier(x_s, x_d_0)
+        driving_motion = motion2device(driving_template_dct, device, n_frames, keys=('scale', 'R', 'exp', 't'))
+        warp_source = self.live_portrait_wrapper_animal.prepare_warp_source(f_s, x_s)  # the source image is fixed over the frames
+        try:
+            x_d_0 = None
+            for i in track(range(n_frames), description='🚀Animating...', total=n_frames):
+                if not frame_valid[i]:
+                    frame_pool.submit(i, postprocess, i, None, None)  # nothing to animate
+                    continue
 
-            x_d_diff = (x_d_i - x_d_0) * motion_multiplier
-            x_d_i = x_d_diff + x_s
+                x_d_i_info = {key: value[i:i + 1] for key, value in driving_motion.items()}
 
-            if not inf_cfg.flag_stitching:
-                pass
-            else:
-                x_d_i = self.live_portrait_wrapper_animal.stitching(x_s, x_d_i)
+                R_d_i = x_d_i_info['R']
+                delta_new = x_d_i_info['exp']
+                t_new = x_d_i_info['t']
+                t_new[..., 2].fill_(0)  # zero tz
+                scale_new = x_s_info['scale']
 
-            x_d_i = x_s + (x_d_i - x_s) * inf_cfg.driving_multiplier
-            out = self.live_portrait_wrapper_animal.warp_decode(f_s, x_s, x_d_i)
-            I_p_i = self.live_portrait_wrapper_animal.parse_output(out['out'])[0]
-            I_p_lst.append(I_p_i)
+                x_d_i = scale_new * (x_c_s @ R_d_i + delta_new) + t_new
 
-            if inf_cfg.flag_pasteback and inf_cfg.flag_do_crop and inf_cfg.flag_stitching:
-                I_p_pstbk = paste_back(I_p_i, crop_info['M_c2o'], img_rgb, mask_ori_float)
-                I_p_pstbk_lst.append(I_p_pstbk)
+                if x_d_0 is None:  # the first driving frame with a face
+                    x_d_0 = x_d_i
+                    motion_multiplier = calc_motion_multiplier(x_s, x_d_0)
+
+                x_d_diff = (x_d_i - x_d_0) * motion_multiplier
+                x_d_i = x_d_diff + x_s
+
+                if not inf_cfg.flag_stitching:
+                    pass
+                else:
+                    x_d_i = self.live_portrait_wrapper_animal.stitching(x_s, x_d_i)
+
+                x_d_i = x_s + (x_d_i - x_s) * inf_cfg.driving_multiplier
+                out = self.live_portrait_wrapper_animal.warp_decode(f_s, x_s, x_d_i, warp_source=warp_source)
+                I_p_i = self.live_portrait_wrapper_animal.parse_output(out['out'])[0]
+
+                I_p_pstbk = paste_back_torch(out['out'], pstbk_dct)[0] if flag_pasteback_on_device else None
+                frame_pool.submit(i, postprocess, i, I_p_i, I_p_pstbk)
+        finally:
+            try:
+                frame_pool.close()
+            finally:
+                video_sink.close()
+                video_sink_concat.close()
 
-        mkdir(args.output_dir)
-        wfp_concat = None
         flag_driving_has_audio = (not flag_load_from_template) and has_audio_stream(args.driving)
 
         ######### build the final concatenation result #########
-        # driving frame | source image | generation
-        frames_concatenated = concat_frames(driving_rgb_crop_256x256_lst, [img_crop_256x256], I_p_lst)
-        wfp_concat = osp.join(args.output_dir, f'{basename(args.source)}--{basename(args.driving)}_concat.mp4')
-        images2video(frames_concatenated, wfp=wfp_concat, fps=output_fps)
-
         if flag_driving_has_audio:
             # final result with concatenation
             wfp_concat_with_audio = osp.join(args.output_dir, f'{basename(args.source)}--{basename(args.driving)}_concat_with_audio.mp4')
@@ -208,13 +224,6 @@ class LivePortraitPipelineAnimal(object):
             os.replace(wfp_concat_with_audio, wfp_concat)
             log(f"Replace {wfp_concat_with_audio} with {wfp_concat}")
 
-        # save the animated result
-        wfp = osp.join(args.output_dir, f'{basename(args.source)}--{basename(args.driving)}.mp4')
-        if I_p_pstbk_lst is not None and len(I_p_pstbk_lst) > 0:
-            images2video(I_p_pstbk_lst, wfp=wfp, fps=output_fps)
-        else:
-            images2video(I_p_lst, wfp=wfp, fps=output_fps)
-
         ######### build the final result #########
         if flag_driving_has_audio:
             wfp_with_audio = osp.join(args.output_dir, f'{basename(args.source)}--{basename(args.driving)}_with_audio.mp4')
@@ -13,6 +13,8 @@ import yaml
 
 from .utils.timer import Timer
 from .utils.helper import load_model, concat_feat
+from .utils.onnx_session import load_onnx_model, onnx_model_path
+from .utils.module_fusion import optimize_2d_modules
 from .utils.camera import headpose_pred_to_degree, get_rotation_matrix
 from .utils.retargeting_utils import calc_eye_close_ratio, calc_lip_close_ratio
 from .config.inference_config import InferenceConfig
@@ -28,7 +30,7 @@ class LivePortraitWrapper(object):
 
         self.inference_cfg = inference_cfg
         self.device_id = inference_cfg.device_id
-        self.compile = inference_cfg.flag_do_torch_compile
+        self.compile = inference_cfg.flag_do_torch_compile and inference_cfg.backend == 'torch'
         if inference_cfg.flag_force_cpu:
             self.device = 'cpu'
         else:
@@ -41,22 +43,18 @@ class LivePortraitWrapper(object):
                 self.device = 'cuda:' + str(self.device_id)
 
         model_config = yaml.load(open(inference_cfg.models_config, 'r'), Loader=yaml.SafeLoader)
+        onnx_dir = inference_cfg.onnx_dir
         # init F
-        self.appearance_feature_extractor = load_model(inference_cfg.checkpoint_F, model_config, self.device, 'appearance_feature_extractor')
-        log(f'Load appearance_feature_extractor from {osp.realpath(inference_cfg.checkpoint_F)} done.')
+        self.appearance_feature_extractor = self.load_network(inference_cfg.checkpoint_F, model_config, 'appearance_feature_extractor', onnx_dir)
         # init M
-        self.motion_extractor = load_model(inference_cfg.checkpoint_M, model_config, self.device, 'motion_extractor')
-        log(f'Load motion_extractor from {osp.realpath(inference_cfg.checkpoint_M)} done.')
+        self.motion_extractor = self.load_network(inference_cfg.checkpoint_M, model_config, 'motion_extractor', onnx_dir)
         # init W
-        self.warping_module = load_model(inference_cfg.checkpoint_W, model_config, self.device, 'warping_module')
-        log(f'Load warping_module from {osp.realpath(inference_cfg.checkpoint_W)} done.')
+        self.warping_module = self.load_network(inference_cfg.checkpoint_W, model_config, 'warping_module', onnx_dir)
         # init G
-        self.spade_generator = load_model(inference_cfg.checkpoint_G, model_config, self.device, 'spade_generator')
-        log(f'Load spade_generator from {osp.realpath(inference_cfg.checkpoint_G)} done.')
+        self.spade_generator = self.load_network(inference_cfg.checkpoint_G, model_config, 'spade_generator', onnx_dir)
         # init S and R
-        if inference_cfg.checkpoint_S is not None and osp.exists(inference_cfg.checkpoint_S):
-            self.stitching_retargeting_module = load_model(inference_cfg.checkpoint_S, model_config, self.device, 'stitching_retargeting_module')
-            log(f'Load stitching_retargeting_module from {osp.realpath(inference_cfg.checkpoint_S)} done.')
+        if self.network_exists(inference_cfg.checkpoint_S, 'stitching_retargeting_module', onnx_dir):
+            self.stitching_retargeting_module = self.load_network(inference_cfg.checkpoint_S, model_config, 'stitching_retargeting_module', onnx_dir)
         else:
             self.stitching_retargeting_module = None
         # Optimize for inference
@@ -67,6 +65,30 @@ class LivePortraitWrapper(object):
 
         self.timer = Timer()
 
+    def load_network(self, ckpt_path, model_config, model_type, onnx_dir):
+        """load a network from the torch checkpoint, or from the model exported by export_onnx.py if the backend is onnx"""
+        if self.inference_cfg.backend == 'onnx':
+            model = load_onnx_model(
+                onnx_dir, model_type, self.device,
+                variant='int8' if model_type in self.inference_cfg.onnx_int8_models else None,
+                intra_op_num_threads=self.inference_cfg.onnx_backend_num_threads,
+                graph_optimization_level=self.inference_cfg.onnx_graph_optimization_level,
+                optimized_model_dir=self.inference_cfg.onnx_optimized_model_dir,
+            )
+            log(f'Load {model_type} from {osp.realpath(onnx_dir)} done.')
+        else:
+            model = load_model(ckpt_path, model_config, self.device, model_type)
+            log(f'Load {model_type} from {osp.realpath(ckpt_path)} done.')
+            if self.inference_cfg.flag_optimize_2d_modules:
+                model = optimize_2d_modules(model, model_type)
+        return model
+
+    def network_exists(self, ckpt_path, model_type, onnx_dir):
+        if self.inference_cfg.backend == 'onnx':
+            key = 'stitching' if model_type == 'stitching_retargeting_module' else None
+            return osp.exists(onnx_model_path(onnx_dir, model_type, key))
+        return ckpt_path is not None and osp.exists(ckpt_path)
+
     def inference_ctx(self):
         if self.device == "mps":
             ctx = contextlib.nullcontext()
@@ -273,11 +295,23 @@ class LivePortraitWrapper(object):
 
         return kp_driving
 
-    def warp_decode(self, feature_3d: torch.Tensor, kp_source: torch.Tensor, kp_driving: torch.Tensor) -> torch.Tensor:
+    def prepare_warp_source(self, feature_3d: torch.Tensor, kp_source: torch.Tensor):
+        """ precompute the source-only part of the warping once, e.g., for a source image, and pass it to `warp_decode` as warp_source
+        feature_3d: 1x32x16x64x64 or Bx32x16x64x64
+        kp_source: 1xNx3 or BxNx3
+        return None when the warping module is compiled, which is traced for the whole forward, or runs on onnx runtime
+        """
+        if self.compile or self.inference_cfg.backend != 'torch':
+            return None
+        with torch.no_grad(), self.inference_ctx():
+            return self.warping_module.prepare_source(feature_3d, kp_source)
+
+    def warp_decode(self, feature_3d: torch.Tensor, kp_source: torch.Tensor, kp_driving: torch.Tensor, warp_source=None) -> torch.Tensor:
         """ get the image after the warping of the implicit keypoints
         feature_3d: Bx32x16x64x64, feature volume
         kp_source: BxNx3
         kp_driving: BxNx3
+        warp_source: from `prepare_warp_source`, if given, feature_3d and kp_source are not used, and a prepared source of batch size 1 is broadcast over kp_driving
         """
         # The line 18 in Algorithm 1: D(W(f_s; x_s, x′_d,i)）
         with torch.no_grad(), self.inference_ctx():
@@ -285,7 +319,10 @@ class LivePortraitWrapper(object):
                 # Mark the beginning of a new CUDA Graph step
                 torch.compiler.cudagraph_mark_step_begin()
             # get decoder input
-            ret_dct = self.warping_module(feature_3d, kp_source=kp_source, kp_driving=kp_driving)
+            if warp_source is not None:
+                ret_dct = self.warping_module.forward_prepared(warp_source, kp_driving)
+            else:
+                ret_dct = self.warping_module(feature_3d, kp_source=kp_source, kp_driving=kp_driving)
             # decode
             ret_dct['out'] = self.spade_generator(feature=ret_dct['out'])
 
@@ -333,6 +370,36 @@ class LivePortraitWrapper(object):
         combined_lip_ratio_tensor = torch.cat([c_s_lip_tensor, c_d_lip_i_tensor], dim=1) # 1x2
         return combined_lip_ratio_tensor
 
+    def calc_combined_eye_ratio_batch(self, c_d_eyes_lst, source_lmk):
+        """ batched version of calc_combined_eye_ratio
+        c_d_eyes_lst: B driving eye-open ratios, the first value of each one is used
+        source_lmk: Nx2 shared by the batch, or B source landmarks
+        return: Bx3
+        """
+        c_d_eyes = np.array([np.reshape(c_d_eyes_i, -1)[0] for c_d_eyes_i in c_d_eyes_lst], dtype=np.float32).reshape(-1, 1)  # Bx1
+        source_lmk = np.asarray(source_lmk)
+        if source_lmk.ndim == 2:
+            source_lmk = np.repeat(source_lmk[None], c_d_eyes.shape[0], axis=0)
+        c_s_eyes = calc_eye_close_ratio(source_lmk).astype(np.float32)  # Bx2
+        # [c_s,eyes, c_d,eyes,i]
+        combined_eye_ratio_tensor = torch.from_numpy(np.concatenate([c_s_eyes, c_d_eyes], axis=1)).to(self.device)
+        return combined_eye_ratio_tensor
+
+    def calc_combined_lip_ratio_batch(self, c_d_lip_lst, source_lmk):
+        """ batched version of calc_combined_lip_ratio
+        c_d_lip_lst: B driving lip-open ratios
+        source_lmk: Nx2 shared by the batch, or B source landmarks
+        return: Bx2
+        """
+        c_d_lip = np.array([np.reshape(c_d_lip_i, -1)[0] for c_d_lip_i in c_d_lip_lst], dtype=np.float32).reshape(-1, 1)  # Bx1
+        source_lmk = np.asarray(source_lmk)
+        if source_lmk.ndim == 2:
+            source_lmk = np.repeat(source_lmk[None], c_d_lip.shape[0], axis=0)
+        c_s_lip = calc_lip_close_ratio(source_lmk).astype(np.float32)  # Bx1
+        # [c_s,lip, c_d,lip,i]
+        combined_lip_ratio_tensor = torch.from_numpy(np.concatenate([c_s_lip, c_d_lip], axis=1)).to(self.device)
+        return combined_lip_ratio_tensor
+
 
 class LivePortraitWrapperAnimal(LivePortraitWrapper):
     """
@@ -343,7 +410,7 @@ class LivePortraitWrapperAnimal(LivePortraitWrapper):
 
         self.inference_cfg = inference_cfg
         self.device_id = inference_cfg.device_id
-        self.compile = inference_cfg.flag_do_torch_compile
+        self.compile = inference_cfg.flag_do_torch_compile and inference_cfg.backend == 'torch'
         if inference_cfg.flag_force_cpu:
             self.device = 'cpu'
         else:
@@ -356,22 +423,18 @@ class LivePortraitWrapperAnimal(LivePortraitWrapper):
                     self.device = 'cuda:' + str(self.device_id)
 
         model_config = yaml.load(open(inference_cfg.models_config, 'r'), Loader=yaml.SafeLoader)
+        onnx_dir = inference_cfg.onnx_dir_animal
         # init F
-        self.appearance_feature_extractor = load_model(inference_cfg.checkpoint_F_animal, model_config, self.device, 'appearance_feature_extractor')
-        log(f'Load appearance_feature_extractor from {osp.realpath(inference_cfg.checkpoint_F_animal)} done.')
+        self.appearance_feature_extractor = self.load_network(inference_cfg.checkpoint_F_animal, model_config, 'appearance_feature_extractor', onnx_dir)
         # init M
-        self.motion_extractor = load_model(inference_cfg.checkpoint_M_animal, model_config, self.device, 'motion_extractor')
-        log(f'Load motion_extractor from {osp.realpath(inference_cfg.checkpoint_M_animal)} done.')
+        self.motion_extractor = self.load_network(inference_cfg.checkpoint_M_animal, model_config, 'motion_extractor', onnx_dir)
         # init W
-        self.warping_module = load_model(inference_cfg.checkpoint_W_animal, model_config, self.device, 'warping_module')
-        log(f'Load warping_module from {osp.realpath(inference_cfg.checkpoint_W_animal)} done.')
+        self.warping_module = self.load_network(inference_cfg.checkpoint_W_animal, model_config, 'warping_module', onnx_dir)
         # init G
-        self.spade_generator = load_model(inference_cfg.checkpoint_G_animal, model_config, self.device, 'spade_generator')
-        log(f'Load spade_generator from {osp.realpath(inference_cfg.checkpoint_G_animal)} done.')
+        self.spade_generator = self.load_network(inference_cfg.checkpoint_G_animal, model_config, 'spade_generator', onnx_dir)
         # init S and R
-        if inference_cfg.checkpoint_S_animal is not None and osp.exists(inference_cfg.checkpoint_S_animal):
-            self.stitching_retargeting_module = load_model(inference_cfg.checkpoint_S_animal, model_config, self.device, 'stitching_retargeting_module')
-            log(f'Load stitching_retargeting_module from {osp.realpath(inference_cfg.checkpoint_S_animal)} done.')
+        if self.network_exists(inference_cfg.checkpoint_S_animal, 'stitching_retargeting_module', onnx_dir):
+            self.stitching_retargeting_module = self.load_network(inference_cfg.checkpoint_S_animal, model_config, 'stitching_retargeting_module', onnx_dir)
         else:
             self.stitching_retargeting_module = None
 
@@ -26,36 +26,53 @@ class DenseMotionNetwork(nn.Module):
         else:
             self.occlusion = None
 
+        # the identity grid of the feature, made on the first call, it moves with the module and is not saved
+        self.register_buffer('identity_grid', torch.zeros(0), persistent=False)
+
+    def get_identity_grid(self, spatial_size, ref):
+        """the identity grid (d, h, w, 3) in the dtype and on the device of ref, remade only if they change"""
+        grid = self.identity_grid
+        if tuple(grid.shape[:3]) != tuple(spatial_size) or grid.dtype != ref.dtype or grid.device != ref.device:
+            with torch.inference_mode(False), torch.no_grad():  # a normal tensor even if made in the inference mode, so that autograd can still use it
+                grid = self.identity_grid = make_coordinate_grid(spatial_size, ref)
+        return grid
+
+    def get_coordinate_axes(self, spatial_size, ref):
+        """the z, y, x axes of the identity grid"""
+        grid = self.get_identity_grid(spatial_size, ref)
+        return grid[:, 0, 0, 2], grid[0, :, 0, 1], grid[0, 0, :, 0]
+
     def create_sparse_motions(self, feature, kp_driving, kp_source):
         bs, _, d, h, w = feature.shape  # (bs, 4, 16, 64, 64)
-        identity_grid = make_coordinate_grid((d, h, w), ref=kp_source)  # (16, 64, 64, 3)
+        identity_grid = self.get_identity_grid((d, h, w), ref=kp_source)  # (16, 64, 64, 3)
         identity_grid = identity_grid.view(1, 1, d, h, w, 3)  # (1, 1, d=16, h=64, w=64, 3)
         coordinate_grid = identity_grid - kp_driving.view(bs, self.num_kp, 1, 1, 1, 3)
 
         k = coordinate_grid.shape[1]
 
         # NOTE: there lacks an one-order flow
-        driving_to_source = coordinate_grid + kp_source.view(bs, self.num_kp, 1, 1, 1, 3)    # (bs, num_kp, d, h, w, 3)
+        driving_to_source = coordinate_grid + kp_source.view(-1, self.num_kp, 1, 1, 1, 3)    # (bs, num_kp, d, h, w, 3), a single source is broadcast
 
         # adding background feature
-        identity_grid = identity_grid.repeat(bs, 1, 1, 1, 1, 1)
+        identity_grid = identity_grid.expand(bs, 1, d, h, w, 3)
         sparse_motions = torch.cat([identity_grid, driving_to_source], dim=1)  # (bs, 1+num_kp, d, h, w, 3)
         return sparse_motions
 
     def create_deformed_feature(self, feature, sparse_motions):
-        bs, _, d, h, w = feature.shape
-        feature_repeat = feature.unsqueeze(1).unsqueeze(1).repeat(1, self.num_kp+1, 1, 1, 1, 1, 1)      # (bs, num_kp+1, 1, c, d, h, w)
-        feature_repeat = feature_repeat.view(bs * (self.num_kp+1), -1, d, h, w)                         # (bs*(num_kp+1), c, d, h, w)
-        sparse_motions = sparse_motions.view((bs * (self.num_kp+1), d, h, w, -1))                       # (bs*(num_kp+1), d, h, w, 3)
-        sparse_deformed = F.grid_sample(feature_repeat, sparse_motions, align_corners=False)
-        sparse_deformed = sparse_deformed.view((bs, self.num_kp+1, -1, d, h, w))                        # (bs, num_kp+1, c, d, h, w)
+        # the num_kp+1 motions are stacked along the output depth and sampled from the same feature in one pass, instead of repeating the feature num_kp+1 times
+        bs, c, d, h, w = feature.shape
+        sparse_motions = sparse_motions.reshape(bs, (self.num_kp+1) * d, h, w, 3)                      # (bs, (num_kp+1)*d, h, w, 3)
+        sparse_deformed = F.grid_sample(feature, sparse_motions, align_corners=False)                   # (bs, c, (num_kp+1)*d, h, w)
+        sparse_deformed = sparse_deformed.view(bs, c, self.num_kp+1, d, h, w).transpose(1, 2)           # (bs, num_kp+1, c, d, h, w)
 
         return sparse_deformed
 
-    def create_heatmap_representations(self, feature, kp_driving, kp_source):
+    def create_heatmap_representations(self, feature, kp_driving, kp_source, gaussian_source=None):
         spatial_size = feature.shape[3:]  # (d=16, h=64, w=64)
-        gaussian_driving = kp2gaussian(kp_driving, spatial_size=spatial_size, kp_variance=0.01)  # (bs, num_kp, d, h, w)
-        gaussian_source = kp2gaussian(kp_source, spatial_size=spatial_size, kp_variance=0.01)  # (bs, num_kp, d, h, w)
+        axes = self.get_coordinate_axes(spatial_size, ref=kp_driving)
+        gaussian_driving = kp2gaussian(kp_driving, spatial_size=spatial_size, kp_variance=0.01, axes=axes)  # (bs, num_kp, d, h, w)
+        if gaussian_source is None:
+            gaussian_source = kp2gaussian(kp_source, spatial_size=spatial_size, kp_variance=0.01, axes=axes)  # (bs, num_kp, d, h, w)
         heatmap = gaussian_driving - gaussian_source  # (bs, num_kp, d, h, w)
 
         # adding background feature
@@ -64,13 +81,31 @@ class DenseMotionNetwork(nn.Module):
         heatmap = heatmap.unsqueeze(2)         # (bs, 1+num_kp, 1, d, h, w)
         return heatmap
 
-    def forward(self, feature, kp_driving, kp_source):
-        bs, _, d, h, w = feature.shape  # (bs, 32, 16, 64, 64)
-
+    def prepare_source(self, feature, kp_source):
+        """the source-only part of the forward, computed once for a source and reused by `forward_prepared` for every driving frame"""
         feature = self.compress(feature)  # (bs, 4, 16, 64, 64)
         feature = self.norm(feature)  # (bs, 4, 16, 64, 64)
         feature = F.relu(feature)  # (bs, 4, 16, 64, 64)
 
+        axes = self.get_coordinate_axes(feature.shape[2:], ref=kp_source)
+        gaussian_source = kp2gaussian(kp_source, spatial_size=feature.shape[2:], kp_variance=0.01, axes=axes)  # (bs, num_kp, d, h, w)
+        return {
+            'feature': feature,
+            'kp_source': kp_source,
+            'gaussian_source': gaussian_source,
+        }
+
+    def forward(self, feature, kp_driving, kp_source):
+        return self.forward_prepared(self.prepare_source(feature, kp_source), kp_driving)
+
+    def forward_prepared(self, source_dct, kp_driving):
+        """source_dct: from `prepare_source`, a source of batch size 1 is broadcast over the batch of kp_driving"""
+        feature, kp_source = source_dct['feature'], source_dct['kp_source']
+        bs = kp_driving.shape[0]
+        _, _, d, h, w = feature.shape  # (bs, 4, 16, 64, 64)
+        if feature.shape[0] != bs:
+            feature = feature.expand(bs, -1, -1, -1, -1)
+
         out_dict = dict()
 
         # 1. deform 3d feature
@@ -78,7 +113,7 @@ class DenseMotionNetwork(nn.Module):
         deformed_feature = self.create_deformed_feature(feature, sparse_motion)  # (bs, 1+num_kp, c=4, d=16, h=64, w=64)
 
         # 2. (bs, 1+num_kp, d, h, w)
-        heatmap = self.create_heatmap_representations(deformed_feature, kp_driving, kp_source)  # (bs, 1+num_kp, 1, d, h, w)
+        heatmap = self.create_heatmap_representations(deformed_feature, kp_driving, kp_source, gaussian_source=source_dct['gaussian_source'])  # (bs, 1+num_kp, 1, d, h, w)
 
         input = torch.cat([heatmap, deformed_feature], dim=2)  # (bs, 1+num_kp, c=5, d=16, h=64, w=64)
         input = input.view(bs, -1, d, h, w)  # (bs, (1+num_kp)*c=105, d=16, h=64, w=64)
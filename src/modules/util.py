@@ -14,31 +14,27 @@ import warnings
 import collections.abc
 from itertools import repeat
 
-def kp2gaussian(kp, spatial_size, kp_variance):
+def kp2gaussian(kp, spatial_size, kp_variance, axes=None):
     """
     Transform a keypoint into gaussian like representation
+    the squared distances are broadcast from the three axes of the grid, so neither the grid nor the differences are repeated per keypoint
+    axes: the z, y, x axes of the grid, made from spatial_size if not given
     """
-    mean = kp
+    mean = kp  # (..., 3), x y z
+    z, y, x = make_coordinate_axes(spatial_size, mean) if axes is None else axes
 
-    coordinate_grid = make_coordinate_grid(spatial_size, mean)
-    number_of_leading_dimensions = len(mean.shape) - 1
-    shape = (1,) * number_of_leading_dimensions + coordinate_grid.shape
-    coordinate_grid = coordinate_grid.view(*shape)
-    repeats = mean.shape[:number_of_leading_dimensions] + (1, 1, 1, 1)
-    coordinate_grid = coordinate_grid.repeat(*repeats)
+    dx = (x - mean[..., 0:1]) ** 2  # (..., w)
+    dy = (y - mean[..., 1:2]) ** 2  # (..., h)
+    dz = (z - mean[..., 2:3]) ** 2  # (..., d)
+    dist = dx[..., None, None, :] + dy[..., None, :, None] + dz[..., :, None, None]  # (..., d, h, w)
 
-    # Preprocess kp shape
-    shape = mean.shape[:number_of_leading_dimensions] + (1, 1, 1, 3)
-    mean = mean.view(*shape)
-
-    mean_sub = (coordinate_grid - mean)
-
-    out = torch.exp(-0.5 * (mean_sub ** 2).sum(-1) / kp_variance)
+    out = torch.exp(-0.5 * dist / kp_variance)
 
     return out
 
 
-def make_coordinate_grid(spatial_size, ref, **kwargs):
+def make_coordinate_axes(spatial_size, ref):
+    """the z, y, x axes of the coordinate grid in [-1, 1], in the dtype and on the device of ref"""
     d, h, w = spatial_size
     x = torch.arange(w).type(ref.dtype).to(ref.device)
     y = torch.arange(h).type(ref.dtype).to(ref.device)
@@ -48,6 +44,13 @@ def make_coordinate_grid(spatial_size, ref, **kwargs):
     x = (2 * (x / (w - 1)) - 1)  # the x axis faces to the right
     y = (2 * (y / (h - 1)) - 1)  # the y axis faces to the bottom
     z = (2 * (z / (d - 1)) - 1)  # the z axis faces to the inner
+    return z, y, x
+
+
+def make_coordinate_grid(spatial_size, ref, **kwargs):
+    """the identity grid (d, h, w, 3) in x y z order, in the dtype and on the device of ref"""
+    d, h, w = spatial_size
+    z, y, x = make_coordinate_axes(spatial_size, ref)
 
     yy = y.view(1, -1, 1).repeat(d, 1, w)
     xx = x.view(1, 1, -1).repeat(d, h, 1)
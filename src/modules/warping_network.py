@@ -46,18 +46,30 @@ class WarpingNetwork(nn.Module):
     def deform_input(self, inp, deformation):
         return F.grid_sample(inp, deformation, align_corners=False)
 
+    def prepare_source(self, feature_3d, kp_source):
+        """cache the intermediates depending on the source only, e.g., f_s and x_s of an image, see `forward_prepared`"""
+        return {
+            'feature_3d': feature_3d,
+            'dense_motion': self.dense_motion_network.prepare_source(feature_3d, kp_source) if self.dense_motion_network is not None else None,
+        }
+
     def forward(self, feature_3d, kp_driving, kp_source):
+        return self.forward_prepared(self.prepare_source(feature_3d, kp_source), kp_driving)
+
+    def forward_prepared(self, source_dct, kp_driving):
+        """the per-frame forward, source_dct is from `prepare_source`, a source of batch size 1 is broadcast over the batch of kp_driving"""
+        feature_3d = source_dct['feature_3d']
         if self.dense_motion_network is not None:
             # Feature warper, Transforming feature representation according to deformation and occlusion
-            dense_motion = self.dense_motion_network(
-                feature=feature_3d, kp_driving=kp_driving, kp_source=kp_source
-            )
+            dense_motion = self.dense_motion_network.forward_prepared(source_dct['dense_motion'], kp_driving)
             if 'occlusion_map' in dense_motion:
                 occlusion_map = dense_motion['occlusion_map']  # Bx1x64x64
             else:
                 occlusion_map = None
 
             deformation = dense_motion['deformation']  # Bx16x64x64x3
+            if feature_3d.shape[0] != deformation.shape[0]:
+                feature_3d = feature_3d.expand(deformation.shape[0], -1, -1, -1, -1)
             out = self.deform_input(feature_3d, deformation)  # Bx32x16x64x64
 
             bs, c, d, h, w = out.shape  # Bx32x16x64x64
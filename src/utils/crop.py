@@ -7,6 +7,8 @@ cropping function and the related preprocess functions for cropping
 import numpy as np
 import os.path as osp
 from math import sin, cos, acos, degrees
+import torch
+import torch.nn.functional as F
 import cv2; cv2.setNumThreads(0); cv2.ocl.setUseOpenCL(False) # NOTE: enforce single thread
 from .rprint import rprint as print
 
@@ -376,12 +378,14 @@ def _estimate_similar_transform_from_pts(
 def crop_image(img, pts: np.ndarray, **kwargs):
     dsize = kwargs.get('dsize', 224)
     scale = kwargs.get('scale', 1.5)  # 1.5 | 1.6
+    vx_ratio = kwargs.get('vx_ratio', 0)
     vy_ratio = kwargs.get('vy_ratio', -0.1)  # -0.0625 | -0.1
 
     M_INV, _ = _estimate_similar_transform_from_pts(
         pts,
         dsize=dsize,
         scale=scale,
+        vx_ratio=vx_ratio,
         vy_ratio=vy_ratio,
         flag_do_rot=kwargs.get('flag_do_rot', True),
     )
@@ -401,6 +405,80 @@ def crop_image(img, pts: np.ndarray, **kwargs):
 
     return ret_dct
 
+def crop_image_by_matrix(img, pts: np.ndarray, M_o2c: np.ndarray, dsize=224):
+    """the same as `crop_image`, but by a given 3x3 transform from the original image to the cropped image, e.g., a smoothed one"""
+    M_o2c = M_o2c.astype(DTYPE)
+    img_crop = _transform_img(img, M_o2c[:2], dsize)
+    pt_crop = _transform_pts(pts, M_o2c[:2])
+
+    return {
+        'M_o2c': M_o2c,
+        'M_c2o': np.linalg.inv(M_o2c),
+        'img_crop': img_crop,
+        'pt_crop': pt_crop,
+    }
+
+
+def parse_rect_lst_from_landmark(lmk_lst, **kwargs):
+    """ the crop rects of a landmark trajectory, Nx4 of center x, center y, size, angle (radian)
+    the angles are unwrapped, so that they can be smoothed across the -pi / pi boundary
+    kwargs: see `parse_rect_from_landmark`
+    """
+    rect_lst = []
+    for lmk in lmk_lst:
+        center, size, angle = parse_rect_from_landmark(lmk, **kwargs)
+        rect_lst.append((center[0], center[1], size[0], angle))
+    rect_arr = np.array(rect_lst, dtype=np.float64)
+    rect_arr[:, 3] = np.unwrap(rect_arr[:, 3])
+    return rect_arr
+
+
+def estimate_similar_transform_lst(rect_arr, dsize, flag_do_rot=True):
+    """ vectorized `_estimate_similar_transform_from_pts` of a trajectory
+    rect_arr: Nx4 of center x, center y, size, angle, see `parse_rect_lst_from_landmark`
+    return M_o2c: Nx3x3, from the original image to the cropped image
+    """
+    cx, cy, size, angle = rect_arr.T
+    s = dsize / size
+    tc = dsize / 2
+    if flag_do_rot:
+        costheta, sintheta = np.cos(angle), np.sin(angle)
+    else:
+        costheta, sintheta = np.ones_like(angle), np.zeros_like(angle)
+
+    M_o2c = np.zeros((len(rect_arr), 3, 3), dtype=DTYPE)
+    M_o2c[:, 0, 0] = s * costheta
+    M_o2c[:, 0, 1] = s * sintheta
+    M_o2c[:, 0, 2] = tc - s * (costheta * cx + sintheta * cy)
+    M_o2c[:, 1, 0] = -s * sintheta
+    M_o2c[:, 1, 1] = s * costheta
+    M_o2c[:, 1, 2] = tc - s * (-sintheta * cx + costheta * cy)
+    M_o2c[:, 2, 2] = 1
+    return M_o2c
+
+
+def savgol_smooth(x, window, polyorder=2):
+    """ Savitzky-Golay smoothing of a trajectory along the first axis, all the channels at once
+    x: N or NxC, window: number of frames, an even one is decreased by one, and it is shrunk to the length of the trajectory
+    the two ends are padded by the point reflection, so that a linear motion is kept at the ends
+    """
+    x = np.asarray(x, dtype=np.float64)
+    n = x.shape[0]
+    window = min(window, n)
+    window -= 1 - window % 2  # odd
+    if window < 3 or window <= polyorder:
+        return x.copy()
+
+    half = window // 2
+    offsets = np.arange(-half, half + 1, dtype=np.float64)
+    vander = offsets[:, None] ** np.arange(polyorder + 1)[None, :]  # window x (polyorder + 1)
+    coeffs = np.linalg.pinv(vander)[0]  # the least square fit evaluated at the center of the window
+
+    x_pad = np.concatenate([2 * x[:1] - x[half:0:-1], x, 2 * x[-1:] - x[-2:-half - 2:-1]], axis=0)
+    windows = np.lib.stride_tricks.sliding_window_view(x_pad, window, axis=0)  # N x ... x window
+    return windows @ coeffs
+
+
 def average_bbox_lst(bbox_lst):
     if len(bbox_lst) == 0:
         return None
@@ -421,3 +499,53 @@ def paste_back(img_crop, M_c2o, img_ori, mask_ori):
     result = _transform_img(img_crop, M_c2o, dsize=dsize)
     result = np.clip(mask_ori * result + (1 - mask_ori) * img_ori, 0, 255).astype(np.uint8)
     return result
+
+
+def _normalize_grid(grid, h, w):
+    """pixel coordinates -> [-1, 1] of grid_sample with align_corners=True, i.e., -1 and 1 are the centers of the corner pixels
+    """
+    scale = torch.tensor([2. / max(w - 1, 1), 2. / max(h - 1, 1)], dtype=grid.dtype, device=grid.device)
+    return grid * scale - 1
+
+
+def _warp_to_ori(img_crop, grid):
+    """the device version of _transform_img(img_crop, M_c2o, dsize), bilinear with zero border
+    img_crop: Bx3xhxw float
+    grid: 1xHxWx2, the pixel coordinates in the crop of each pixel of the original image
+    """
+    h, w = img_crop.shape[2:]
+    return F.grid_sample(img_crop, _normalize_grid(grid, h, w).expand(img_crop.shape[0], -1, -1, -1), mode='bilinear', padding_mode='zeros', align_corners=True)
+
+
+def prepare_paste_back_torch(mask_crop, crop_M_c2o, img_ori, device):
+    """the device version of prepare_paste_back, the sampling grid and the original image are kept on the device for paste_back_torch
+    img_ori: HxWx3, uint8
+    return: a dict of 'grid' (1xHxWx2), 'mask_ori' (1x3xHxW, 0~1) and 'img_ori' (1x3xHxW, 0~255)
+    """
+    h, w = img_ori.shape[:2]
+    M_o2c = np.linalg.inv(np.vstack([np.asarray(crop_M_c2o, dtype=np.float64)[:2], [0, 0, 1]]))[:2]
+    M_o2c = torch.from_numpy(M_o2c.astype(np.float32)).to(device)
+
+    ys, xs = torch.meshgrid(torch.arange(h, dtype=torch.float32, device=device), torch.arange(w, dtype=torch.float32, device=device), indexing='ij')
+    pts = torch.stack([xs, ys, torch.ones_like(xs)], dim=-1)  # HxWx3
+    grid = (pts @ M_o2c.T)[None]  # 1xHxWx2
+
+    mask_crop = torch.from_numpy(np.ascontiguousarray(mask_crop)).to(device).permute(2, 0, 1)[None].float()
+    mask_ori = torch.round(_warp_to_ori(mask_crop, grid)) / 255.  # rounded to uint8 like cv2.warpAffine
+    img_ori = torch.from_numpy(np.ascontiguousarray(img_ori)).to(device).permute(2, 0, 1)[None].float()
+
+    return {'grid': grid, 'mask_ori': mask_ori, 'img_ori': img_ori}
+
+
+def paste_back_torch(img_crop, pstbk_dct):
+    """the device version of paste_back, the result is copied to the host only at the end
+    img_crop: Bx3xhxw tensor in 0~1, e.g., the output of the decoder, it is quantized as parse_output does
+    pstbk_dct: the return of prepare_paste_back_torch
+    return: BxHxWx3, uint8
+    """
+    with torch.no_grad():
+        img_crop = torch.floor(img_crop.float().clamp(0, 1) * 255)
+        result = _warp_to_ori(img_crop, pstbk_dct['grid']).round().clamp(0, 255)  # rounded to uint8 like cv2.warpAffine
+        mask_ori = pstbk_dct['mask_ori']
+        result = (mask_ori * result + (1 - mask_ori) * pstbk_dct['img_ori']).clamp(0, 255).to(torch.uint8)
+        return result.permute(0, 2, 3, 1).cpu().numpy()
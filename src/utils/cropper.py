@@ -6,6 +6,7 @@ import numpy as np
 import cv2; cv2.setNumThreads(0); cv2.ocl.setUseOpenCL(False)
 
 from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Tuple, Union
 from dataclasses import dataclass, field
 
@@ -14,17 +15,103 @@ from .crop import (
     average_bbox_lst,
     crop_image,
     crop_image_by_bbox,
+    crop_image_by_matrix,
+    estimate_similar_transform_lst,
     parse_bbox_from_landmark,
+    parse_rect_lst_from_landmark,
+    savgol_smooth,
 )
 from .io import contiguous
+from .video import FrameWorkerPool, bb_intersection_over_union
 from .rprint import rlog as log
 from .face_analysis_diy import FaceAnalysisDIY
 from .human_landmark_runner import LandmarkRunner as HumanLandmark
+from .onnx_session import get_session
 
 def make_abs_path(fn):
     return osp.join(osp.dirname(osp.realpath(__file__)), fn)
 
 
+def _lmk_bbox(lmk):
+    """the bounding box x0, y0, x1, y1 of the landmarks"""
+    return [*np.min(lmk, axis=0), *np.max(lmk, axis=0)]
+
+
+def _fill_missing_lmk(tracked_iter, max_interp_frames):
+    """ fill the landmarks of the frames with no face
+    tracked_iter: yields (idx, frame_rgb, lmk), lmk is None if no face
+    a run of at most max_interp_frames frames between two frames with a face is linearly interpolated and marked valid,
+    the other frames borrow the nearest landmarks and are marked invalid
+    yield (idx, frame_rgb, lmk, valid), lmk is None only if there is no face in any frame
+    """
+    lmk_prev = None
+    pending = []  # (idx, frame_rgb) of the current run of frames with no face
+    n_missing = 0
+    for idx, frame_rgb, lmk in tracked_iter:
+        if lmk is None:
+            n_missing += 1
+            pending.append((idx, frame_rgb))
+            if lmk_prev is not None and n_missing > max_interp_frames:
+                # too long to be interpolated
+                for i, frame in pending:
+                    yield i, frame, lmk_prev, False
+                pending = []
+            continue
+
+        if lmk_prev is None or n_missing > max_interp_frames:
+            for i, frame in pending:
+                yield i, frame, lmk, False
+        else:
+            for k, (i, frame) in enumerate(pending, start=1):
+                w = k / (n_missing + 1)
+                yield i, frame, (1 - w) * lmk_prev + w * lmk, True
+        pending = []
+        n_missing = 0
+        lmk_prev = lmk
+        yield idx, frame_rgb, lmk, True
+
+    for i, frame in pending:
+        yield i, frame, lmk_prev, False
+
+
+def _crop_source_frame(frame_rgb, lmk, crop_cfg: CropConfig, M_o2c=None):
+    # crop the face, by the smoothed transform if given
+    if M_o2c is not None:
+        ret_dct = crop_image_by_matrix(frame_rgb, lmk, M_o2c, dsize=crop_cfg.dsize)
+    else:
+        ret_dct = crop_image(
+            frame_rgb,  # ndarray
+            lmk,  # 106x2 or Nx2
+            dsize=crop_cfg.dsize,
+            scale=crop_cfg.scale,
+            vx_ratio=crop_cfg.vx_ratio,
+            vy_ratio=crop_cfg.vy_ratio,
+            flag_do_rot=crop_cfg.flag_do_rot,
+        )
+    # the tracked landmarks are already refined on this frame, no need to run the landmark model again
+    ret_dct["lmk_crop"] = lmk
+
+    # update a 256x256 version for network input
+    ret_dct["img_crop_256x256"] = cv2.resize(ret_dct["img_crop"], (256, 256), interpolation=cv2.INTER_AREA)
+    ret_dct["lmk_crop_256x256"] = ret_dct["lmk_crop"] * 256 / crop_cfg.dsize
+    return ret_dct
+
+
+def _crop_driving_frame(frame_rgb, lmk, bbox, dsize, dsize_resize=None):
+    ret_dct = crop_image_by_bbox(
+        frame_rgb,
+        bbox,
+        lmk=lmk,
+        dsize=dsize,
+        flag_rot=False,
+        borderValue=(0, 0, 0),
+    )
+    if dsize_resize is not None:
+        ret_dct["img_crop"] = cv2.resize(ret_dct["img_crop"], (dsize_resize, dsize_resize))
+        ret_dct["lmk_crop"] = ret_dct["lmk_crop"] * dsize_resize / dsize
+    return ret_dct
+
+
 @dataclass
 class Trajectory:
     start: int = -1  # start frame
@@ -36,6 +123,7 @@ class Trajectory:
     frame_rgb_lst: Union[Tuple, List, np.ndarray] = field(default_factory=list)  # frame list
     lmk_crop_lst: Union[Tuple, List, np.ndarray] = field(default_factory=list)  # lmk list
     frame_rgb_crop_lst: Union[Tuple, List, np.ndarray] = field(default_factory=list)  # frame crop list
+    valid_lst: Union[Tuple, List, np.ndarray] = field(default_factory=list)  # whether the face of the frame is tracked or interpolated
 
 
 class Cropper(object):
@@ -60,10 +148,17 @@ class Cropper(object):
             except:
                     device = "cuda"
                     face_analysis_wrapper_provider = ["CUDAExecutionProvider"]
+        # the onnx sessions are shared by all the croppers in the process
+        session_kwargs = {
+            'intra_op_num_threads': self.crop_cfg.onnx_intra_op_num_threads,
+            'graph_optimization_level': self.crop_cfg.onnx_graph_optimization_level,
+            'optimized_model_dir': self.crop_cfg.onnx_optimized_model_dir,
+        }
         self.face_analysis_wrapper = FaceAnalysisDIY(
                     name="buffalo_l",
                     root=self.crop_cfg.insightface_root,
                     providers=face_analysis_wrapper_provider,
+                    session_factory=lambda model_path, providers, provider_options=None: get_session(model_path, providers, provider_options, **session_kwargs),
                 )
         self.face_analysis_wrapper.prepare(ctx_id=device_id, det_size=(512, 512), det_thresh=self.crop_cfg.det_thresh)
         self.face_analysis_wrapper.warmup()
@@ -72,6 +167,8 @@ class Cropper(object):
             ckpt_path=self.crop_cfg.landmark_ckpt_path,
             onnx_provider=device,
             device_id=device_id,
+            session_kwargs=session_kwargs,
+            score_output=self.crop_cfg.landmark_score_output,
         )
         self.human_landmark_runner.warmup()
 
@@ -93,14 +190,15 @@ class Cropper(object):
     def crop_source_image(self, img_rgb_: np.ndarray, crop_cfg: CropConfig):
         # crop a source image and get neccessary information
         img_rgb = img_rgb_.copy()  # copy it
-        img_bgr = cv2.cvtColor(img_rgb, cv2.COLOR_RGB2BGR)
 
         if self.image_type == "human_face":
             src_face = self.face_analysis_wrapper.get(
-                img_bgr,
+                img_rgb,  # the detector takes RGB directly
+                flag_rgb=True,
                 flag_do_landmark_2d_106=True,
                 direction=crop_cfg.direction,
                 max_face_num=crop_cfg.max_face_num,
+                det_max_dim=crop_cfg.det_max_dim,
             )
 
             if len(src_face) == 0:
@@ -153,9 +251,11 @@ class Cropper(object):
     def calc_lmk_from_cropped_image(self, img_rgb_, **kwargs):
         direction = kwargs.get("direction", "large-small")
         src_face = self.face_analysis_wrapper.get(
-            contiguous(img_rgb_[..., ::-1]),  # convert to BGR
+            contiguous(img_rgb_),
+            flag_rgb=True,
             flag_do_landmark_2d_106=True,
             direction=direction,
+            det_max_dim=self.crop_cfg.det_max_dim,
         )
         if len(src_face) == 0:
             log("No face detected in the source image.")
@@ -168,87 +268,218 @@ class Cropper(object):
 
         return lmk
 
-    # TODO: support skipping frame with NO FACE
-    def crop_source_video(self, source_rgb_lst, crop_cfg: CropConfig, **kwargs):
-        """Tracking based landmarks/alignment and cropping"""
-        trajectory = Trajectory()
-        direction = kwargs.get("direction", "large-small")
-        for idx, frame_rgb in enumerate(source_rgb_lst):
-            if idx == 0 or trajectory.start == -1:
-                src_face = self.face_analysis_wrapper.get(
-                    contiguous(frame_rgb[..., ::-1]),
-                    flag_do_landmark_2d_106=True,
-                    direction=crop_cfg.direction,
-                    max_face_num=crop_cfg.max_face_num,
-                )
-                if len(src_face) == 0:
-                    log(f"No face detected in the frame #{idx}")
+    def _detect_lmk(self, frame_rgb, idx, name, **kwargs):
+        """ detect the face of one frame and refine its landmarks, None if no face is detected
+        kwargs: the options of the face detector, e.g., direction
+        """
+        kwargs.setdefault('det_max_dim', self.crop_cfg.det_max_dim)
+        src_face = self.face_analysis_wrapper.get(
+            contiguous(frame_rgb),
+            flag_rgb=True,
+            flag_do_landmark_2d_106=True,
+            **kwargs,
+        )
+        if len(src_face) == 0:
+            log(f"No face detected in the frame #{idx}")
+            return None
+        elif len(src_face) > 1:
+            log(f"More than one face detected in the {name} frame_{idx}, only pick one face by rule {kwargs.get('direction', 'large-small')}.")
+        src_face = src_face[0]
+        lmk = src_face.landmark_2d_106
+        return self.human_landmark_runner.run(frame_rgb, lmk)
+
+    def _redetect_lmk(self, frame_rgb, lmk_tracked, **kwargs):
+        """detect the faces of a tracked frame, return the 106 landmarks of the face overlapping the tracked one most and their IoU"""
+        kwargs.setdefault('det_max_dim', self.crop_cfg.det_max_dim)
+        src_face = self.face_analysis_wrapper.get(
+            contiguous(frame_rgb),
+            flag_rgb=True,
+            flag_do_landmark_2d_106=True,
+            **kwargs,
+        )
+        if len(src_face) == 0:
+            return None, 0.
+        bbox_tracked = _lmk_bbox(lmk_tracked)
+        iou_lst = [bb_intersection_over_union(_lmk_bbox(face.landmark_2d_106), bbox_tracked) for face in src_face]
+        i = int(np.argmax(iou_lst))
+        return src_face[i].landmark_2d_106, iou_lst[i]
+
+    def _track_lmk(self, frame_rgb_lst, detect_fn, crop_cfg: CropConfig, **kwargs):
+        """ yield (idx, frame_rgb, lmk) of each frame in order, the frames after a detected face are tracked by the landmarks of the previous ones
+        lmk is None for the frames with no face, i.e., before the first detected face or after the tracked face is lost
+        detect_fn: (idx, frame_rgb) -> lmk or None
+        kwargs: the options of the face detector for the re-detection
+
+        the tracked frames are passed to the landmark model crop_cfg.landmark_batch_size at a time, each cropped around its landmarks predicted
+        from the last two tracked frames at a constant velocity, the models with a fixed batch axis track frame by frame.
+        the face detector runs in a background thread every crop_cfg.redetect_interval frames, or when the tracked face box jumps or its landmark score drops,
+        and the frames tracked from the re-detected one on are held until it returns: they are re-tracked from the detected face if the tracking
+        has drifted away from it, or yielded as lost if no face is found, then the following frames are detected again frame by frame.
+        """
+        batch_size = max(crop_cfg.landmark_batch_size, 1)
+        if batch_size > 1 and not self.human_landmark_runner.flag_dynamic_batch:
+            if not getattr(self, '_flag_warned_batch', False):
+                log(f"The landmark model has a fixed batch axis, landmark_batch_size={batch_size} falls back to tracking frame by frame.")
+                self._flag_warned_batch = True
+            batch_size = 1
+        redetect_interval, iou_thresh, reseed_thresh = crop_cfg.redetect_interval, crop_cfg.redetect_iou_thresh, crop_cfg.reseed_iou_thresh
+        score_thresh = crop_cfg.landmark_score_thresh if self.human_landmark_runner.score_index is not None else 0
+        if crop_cfg.landmark_score_thresh > 0 and score_thresh == 0 and not getattr(self, '_flag_warned_score', False):
+            log("The landmark model has no score output, landmark_score_thresh is ignored.")
+            self._flag_warned_score = True
+        det_executor = ThreadPoolExecutor(max_workers=1) if redetect_interval > 0 or iou_thresh > 0 or score_thresh > 0 else None
+        max_held = max(2 * batch_size, 16)  # wait for the re-detection once this many frames are held
+        det_pending = None  # (idx, future) of the background re-detection
+        idx_det = -1  # the last frame which the detector runs on
+        lmk_prev, lmk_prev2 = None, None  # the landmarks of the last two tracked frames
+        buffer = []  # (idx, frame_rgb) to track
+        held = []  # (idx, frame_rgb, lmk) tracked since the pending re-detection
+
+        def run_landmark(frames, lmk_seed, lmk_seed2):
+            """the landmarks and the scores of the frames following the two seeds"""
+            flag_velocity = lmk_seed2 is not None and lmk_seed2.shape == lmk_seed.shape
+            velocity = lmk_seed - lmk_seed2 if flag_velocity else 0
+            lmk_pred_lst = [lmk_seed + k * velocity for k in range(1, len(frames) + 1)]
+            return self.human_landmark_runner.run_batch(frames, lmk_pred_lst, flag_return_score=True)
+
+        def track():
+            """track the buffered frames, return the ones which are not held"""
+            nonlocal lmk_prev, lmk_prev2, det_pending, idx_det
+            lmk_lst, score_lst = run_landmark([frame for _, frame in buffer], lmk_prev, lmk_prev2)
+            ret = []
+            for (i, frame), lmk, score in zip(buffer, lmk_lst, score_lst):
+                if det_executor is not None and det_pending is None:
+                    flag_interval = redetect_interval > 0 and i - idx_det >= redetect_interval
+                    flag_jump = iou_thresh > 0 and bb_intersection_over_union(_lmk_bbox(lmk), _lmk_bbox(lmk_prev)) < iou_thresh
+                    flag_score = score_thresh > 0 and score < score_thresh
+                    if flag_interval or flag_jump or flag_score:
+                        det_pending = (i, det_executor.submit(self._redetect_lmk, frame, lmk, **kwargs))
+                        idx_det = i
+                (ret if det_pending is None else held).append((i, frame, lmk))
+                lmk_prev, lmk_prev2 = lmk, lmk_prev
+            return ret
+
+        def resolve(wait):
+            """return the held frames once the re-detection is done"""
+            nonlocal lmk_prev, lmk_prev2, det_pending, held
+            if det_pending is None or not (wait or det_pending[1].done()):
+                return []
+            i, future = det_pending
+            det_pending = None
+            ret, held = held, []
+            lmk_det, iou = future.result()
+            if lmk_det is None:
+                log(f"No face detected in the frame #{i} when re-detecting, the tracked face is lost.")
+                lmk_prev, lmk_prev2 = None, None
+                return [(j, frame, None) for j, frame, _ in ret]
+            if iou < reseed_thresh:
+                log(f"The tracking drifts at the frame #{i} (IoU {iou:.2f}), re-track it from the detected face.")
+                lmk_prev, lmk_prev2 = lmk_det, None
+                for k in range(0, len(ret), batch_size):
+                    chunk = ret[k:k + batch_size]
+                    lmk_lst, _ = run_landmark([frame for _, frame, _ in chunk], lmk_prev, lmk_prev2)
+                    ret[k:k + batch_size] = [(j, frame, lmk) for (j, frame, _), lmk in zip(chunk, lmk_lst)]
+                    lmk_prev, lmk_prev2 = lmk_lst[-1], (lmk_lst[-2] if len(lmk_lst) > 1 else None)
+            return ret
+
+        try:
+            for idx, frame_rgb in enumerate(frame_rgb_lst):
+                if lmk_prev is None:
+                    lmk_prev, lmk_prev2 = detect_fn(idx, frame_rgb), None
+                    if lmk_prev is not None:
+                        idx_det = idx
+                    yield idx, frame_rgb, lmk_prev
                     continue
-                elif len(src_face) > 1:
-                    log(f"More than one face detected in the source frame_{idx}, only pick one face by rule {direction}.")
-                src_face = src_face[0]
-                lmk = src_face.landmark_2d_106
-                lmk = self.human_landmark_runner.run(frame_rgb, lmk)
-                trajectory.start, trajectory.end = idx, idx
-            else:
-                # TODO: add IOU check for tracking
-                lmk = self.human_landmark_runner.run(frame_rgb, trajectory.lmk_lst[-1])
-                trajectory.end = idx
 
-            trajectory.lmk_lst.append(lmk)
+                buffer.append((idx, frame_rgb))
+                if len(buffer) < batch_size:
+                    continue
+                yield from track()
+                buffer = []
+                yield from resolve(wait=len(held) >= max_held)
 
-            # crop the face
-            ret_dct = crop_image(
-                frame_rgb,  # ndarray
-                lmk,  # 106x2 or Nx2
-                dsize=crop_cfg.dsize,
-                scale=crop_cfg.scale,
-                vx_ratio=crop_cfg.vx_ratio,
-                vy_ratio=crop_cfg.vy_ratio,
-                flag_do_rot=crop_cfg.flag_do_rot,
-            )
-            lmk = self.human_landmark_runner.run(frame_rgb, lmk)
-            ret_dct["lmk_crop"] = lmk
+            if len(buffer) > 0:
+                yield from track()
+            yield from resolve(wait=True)
+        finally:
+            if det_executor is not None:
+                det_executor.shutdown(wait=True, cancel_futures=True)
 
-            # update a 256x256 version for network input
-            ret_dct["img_crop_256x256"] = cv2.resize(ret_dct["img_crop"], (256, 256), interpolation=cv2.INTER_AREA)
-            ret_dct["lmk_crop_256x256"] = ret_dct["lmk_crop"] * 256 / crop_cfg.dsize
+    def crop_source_video(self, source_rgb_lst, crop_cfg: CropConfig, **kwargs):
+        """Tracking based landmarks/alignment and cropping
+        every frame is cropped, the frames with no face are cropped by the interpolated or the nearest landmarks, see `valid_lst`
+        if crop_cfg.crop_smooth_window > 2, the crop rects of the whole trajectory are smoothed before cropping,
+        then source_rgb_lst is iterated twice, i.e., it should be a list of frames or a re-iterable frame source, which a VideoReader decodes twice
+        """
+        flag_smooth = crop_cfg.crop_smooth_window > 2
+        trajectory = Trajectory()
 
+        def detect_fn(idx, frame_rgb):
+            return self._detect_lmk(frame_rgb, idx, "source", direction=crop_cfg.direction, max_face_num=crop_cfg.max_face_num)
+
+        def collect(ret_dct):
             trajectory.frame_rgb_crop_lst.append(ret_dct["img_crop_256x256"])
             trajectory.lmk_crop_lst.append(ret_dct["lmk_crop_256x256"])
             trajectory.M_c2o_lst.append(ret_dct['M_c2o'])
 
+        # the tracker is the producer, the crops and the resizes of the tracked frames run in the worker threads
+        crop_pool = FrameWorkerPool(crop_cfg.crop_num_workers, collect)
+        try:
+            tracked_iter = self._track_lmk(source_rgb_lst, detect_fn, crop_cfg, direction=crop_cfg.direction, max_face_num=crop_cfg.max_face_num)
+            for idx, frame_rgb, lmk, valid in _fill_missing_lmk(tracked_iter, crop_cfg.max_interp_frames):
+                if lmk is None:
+                    raise Exception("No face detected in the source video.")
+                if valid:
+                    if trajectory.start == -1:
+                        trajectory.start = idx
+                    trajectory.end = idx
+                trajectory.lmk_lst.append(lmk)
+                trajectory.valid_lst.append(valid)
+                if not flag_smooth:
+                    crop_pool.submit(idx, _crop_source_frame, frame_rgb, lmk, crop_cfg)
+
+            if flag_smooth:
+                # smooth the center, size and angle of the crop rects over the whole trajectory at once, then crop in the second pass
+                rect_arr = parse_rect_lst_from_landmark(trajectory.lmk_lst, scale=crop_cfg.scale, vx_ratio=crop_cfg.vx_ratio, vy_ratio=crop_cfg.vy_ratio)
+                rect_arr = savgol_smooth(rect_arr, crop_cfg.crop_smooth_window, crop_cfg.crop_smooth_polyorder)
+                M_o2c_arr = estimate_similar_transform_lst(rect_arr, crop_cfg.dsize, flag_do_rot=crop_cfg.flag_do_rot)
+                for idx, (frame_rgb, lmk) in enumerate(zip(source_rgb_lst, trajectory.lmk_lst)):
+                    crop_pool.submit(idx, _crop_source_frame, frame_rgb, lmk, crop_cfg, M_o2c_arr[idx])
+        finally:
+            crop_pool.close()
+
         return {
             "frame_crop_lst": trajectory.frame_rgb_crop_lst,
             "lmk_crop_lst": trajectory.lmk_crop_lst,
             "M_c2o_lst": trajectory.M_c2o_lst,
+            "valid_lst": trajectory.valid_lst,
         }
 
     def crop_driving_video(self, driving_rgb_lst, **kwargs):
-        """Tracking based landmarks/alignment and cropping"""
+        """Tracking based landmarks/alignment and cropping
+        driving_rgb_lst: a list of frames or a re-iterable frame source, e.g., VideoReader, which is iterated twice so that the original frames are not held
+        dsize_resize: if given, the crops (and the landmarks) are resized to it to save memory
+        each frame is cropped by its own smoothed box if crop_cfg.flag_crop_driving_video_follow, otherwise by the average box of the frames with a face
+        every frame is cropped, the landmarks of the frames with no face are interpolated or borrowed from the nearest frames, see `valid_lst`
+        """
         trajectory = Trajectory()
         direction = kwargs.get("direction", "large-small")
-        for idx, frame_rgb in enumerate(driving_rgb_lst):
-            if idx == 0 or trajectory.start == -1:
-                src_face = self.face_analysis_wrapper.get(
-                    contiguous(frame_rgb[..., ::-1]),
-                    flag_do_landmark_2d_106=True,
-                    direction=direction,
-                )
-                if len(src_face) == 0:
-                    log(f"No face detected in the frame #{idx}")
-                    continue
-                elif len(src_face) > 1:
-                    log(f"More than one face detected in the driving frame_{idx}, only pick one face by rule {direction}.")
-                src_face = src_face[0]
-                lmk = src_face.landmark_2d_106
-                lmk = self.human_landmark_runner.run(frame_rgb, lmk)
-                trajectory.start, trajectory.end = idx, idx
-            else:
-                lmk = self.human_landmark_runner.run(frame_rgb, trajectory.lmk_lst[-1])
-                trajectory.end = idx
 
+        def detect_fn(idx, frame_rgb):
+            return self._detect_lmk(frame_rgb, idx, "driving", direction=direction)
+
+        tracked_iter = self._track_lmk(driving_rgb_lst, detect_fn, self.crop_cfg, direction=direction)
+        for idx, frame_rgb, lmk, valid in _fill_missing_lmk(tracked_iter, self.crop_cfg.max_interp_frames):
+            if lmk is None:
+                raise Exception("No face detected in the driving video.")
             trajectory.lmk_lst.append(lmk)
+            trajectory.valid_lst.append(valid)
+            if not valid:
+                continue
+            if trajectory.start == -1:
+                trajectory.start = idx
+            trajectory.end = idx
+
             ret_bbox = parse_bbox_from_landmark(
                 lmk,
                 scale=self.crop_cfg.scale_crop_driving_video,
@@ -262,52 +493,67 @@ class Cropper(object):
                 ret_bbox[2, 1],
             ]  # 4,
             trajectory.bbox_lst.append(bbox)  # bbox
-            trajectory.frame_rgb_lst.append(frame_rgb)
-
-        global_bbox = average_bbox_lst(trajectory.bbox_lst)
-
-        for idx, (frame_rgb, lmk) in enumerate(zip(trajectory.frame_rgb_lst, trajectory.lmk_lst)):
-            ret_dct = crop_image_by_bbox(
-                frame_rgb,
-                global_bbox,
-                lmk=lmk,
-                dsize=kwargs.get("dsize", 512),
-                flag_rot=False,
-                borderValue=(0, 0, 0),
+
+        if self.crop_cfg.flag_crop_driving_video_follow:
+            # the boxes follow the face, smoothed over the whole trajectory at once
+            rect_arr = parse_rect_lst_from_landmark(
+                trajectory.lmk_lst,
+                scale=self.crop_cfg.scale_crop_driving_video,
+                vx_ratio_crop_driving_video=self.crop_cfg.vx_ratio_crop_driving_video,
+                vy_ratio=self.crop_cfg.vy_ratio_crop_driving_video,
             )
+            rect_arr = savgol_smooth(rect_arr, self.crop_cfg.crop_driving_smooth_window, self.crop_cfg.crop_smooth_polyorder)
+            cx, cy, size = rect_arr[:, 0], rect_arr[:, 1], rect_arr[:, 2]
+            bbox_lst = np.stack([cx - size / 2, cy - size / 2, cx + size / 2, cy + size / 2], axis=1).tolist()
+        else:
+            global_bbox = average_bbox_lst(trajectory.bbox_lst)
+            bbox_lst = [global_bbox] * len(trajectory.lmk_lst)
+
+        # the second pass crops every frame by its bbox
+        dsize = kwargs.get("dsize", 512)
+        dsize_resize = kwargs.get("dsize_resize", None)
+
+        def collect(ret_dct):
             trajectory.frame_rgb_crop_lst.append(ret_dct["img_crop"])
             trajectory.lmk_crop_lst.append(ret_dct["lmk_crop"])
 
+        # the decoding is the producer, the crops and the resizes run in the worker threads
+        crop_pool = FrameWorkerPool(self.crop_cfg.crop_num_workers, collect)
+        try:
+            for idx, (frame_rgb, lmk) in enumerate(zip(driving_rgb_lst, trajectory.lmk_lst)):
+                crop_pool.submit(idx, _crop_driving_frame, frame_rgb, lmk, bbox_lst[idx], dsize, dsize_resize)
+        finally:
+            crop_pool.close()
+
         return {
             "frame_crop_lst": trajectory.frame_rgb_crop_lst,
             "lmk_crop_lst": trajectory.lmk_crop_lst,
+            "valid_lst": trajectory.valid_lst,
         }
 
 
     def calc_lmks_from_cropped_video(self, driving_rgb_crop_lst, **kwargs):
-        """Tracking based landmarks/alignment"""
+        """Tracking based landmarks/alignment
+        the landmarks of the frames with no face are interpolated or borrowed from the nearest frames, see `valid_lst`
+        """
         trajectory = Trajectory()
         direction = kwargs.get("direction", "large-small")
 
-        for idx, frame_rgb_crop in enumerate(driving_rgb_crop_lst):
-            if idx == 0 or trajectory.start == -1:
-                src_face = self.face_analysis_wrapper.get(
-                    contiguous(frame_rgb_crop[..., ::-1]),  # convert to BGR
-                    flag_do_landmark_2d_106=True,
-                    direction=direction,
-                )
-                if len(src_face) == 0:
-                    log(f"No face detected in the frame #{idx}")
-                    raise Exception(f"No face detected in the frame #{idx}")
-                elif len(src_face) > 1:
-                    log(f"More than one face detected in the driving frame_{idx}, only pick one face by rule {direction}.")
-                src_face = src_face[0]
-                lmk = src_face.landmark_2d_106
-                lmk = self.human_landmark_runner.run(frame_rgb_crop, lmk)
-                trajectory.start, trajectory.end = idx, idx
-            else:
-                lmk = self.human_landmark_runner.run(frame_rgb_crop, trajectory.lmk_lst[-1])
-                trajectory.end = idx
+        def detect_fn(idx, frame_rgb_crop):
+            return self._detect_lmk(frame_rgb_crop, idx, "driving", direction=direction)
 
+        tracked_iter = self._track_lmk(driving_rgb_crop_lst, detect_fn, self.crop_cfg, direction=direction)
+        for idx, _, lmk, valid in _fill_missing_lmk(tracked_iter, self.crop_cfg.max_interp_frames):
+            if lmk is None:
+                raise Exception("No face detected in the video.")
+            if valid:
+                if trajectory.start == -1:
+                    trajectory.start = idx
+                trajectory.end = idx
             trajectory.lmk_lst.append(lmk)
-        return trajectory.lmk_lst
+            trajectory.valid_lst.append(valid)
+
+        return {
+            "lmk_crop_lst": trajectory.lmk_lst,
+            "valid_lst": trajectory.valid_lst,
+        }
@@ -77,7 +77,8 @@ class Landmark:
         if ctx_id<0:
             self.session.set_providers(['CPUExecutionProvider'])
 
-    def get(self, img, face):
+    def get(self, img, face, swap_rb=True):
+        # swap_rb: the img is BGR, set it to False if the img is already RGB
         bbox = face.bbox
         w, h = (bbox[2] - bbox[0]), (bbox[3] - bbox[1])
         center = (bbox[2] + bbox[0]) / 2, (bbox[3] + bbox[1]) / 2
@@ -87,7 +88,7 @@ class Landmark:
         aimg, M = face_align.transform(img, center, self.input_size[0], _scale, rotate)
         input_size = tuple(aimg.shape[0:2][::-1])
         #assert input_size==self.input_size
-        blob = cv2.dnn.blobFromImage(aimg, 1.0/self.input_std, input_size, (self.input_mean, self.input_mean, self.input_mean), swapRB=True)
+        blob = cv2.dnn.blobFromImage(aimg, 1.0/self.input_std, input_size, (self.input_mean, self.input_mean, self.input_mean), swapRB=swap_rb)
         pred = self.session.run(self.output_names, {self.input_name : blob})[0][0]
         if pred.shape[0] >= 3000:
             pred = pred.reshape((-1, 3))
@@ -37,7 +37,11 @@ class ModelRouter:
         self.onnx_file = onnx_file
 
     def get_model(self, **kwargs):
-        session = PickableInferenceSession(self.onnx_file, **kwargs)
+        session_factory = kwargs.pop('session_factory', None)  # e.g., a registry sharing the sessions
+        if session_factory is not None:
+            session = session_factory(self.onnx_file, kwargs.get('providers'), kwargs.get('provider_options'))
+        else:
+            session = PickableInferenceSession(self.onnx_file, **kwargs)
         # print(f'Applied providers: {session._providers}, with options: {session._provider_options}')
         inputs = session.get_inputs()
         input_cfg = inputs[0]
@@ -93,5 +97,5 @@ def get_model(name, **kwargs):
     router = ModelRouter(model_file)
     providers = kwargs.get('providers', get_default_providers())
     provider_options = kwargs.get('provider_options', get_default_provider_options())
-    model = router.get_model(providers=providers, provider_options=provider_options)
+    model = router.get_model(providers=providers, provider_options=provider_options, session_factory=kwargs.get('session_factory'))
     return model
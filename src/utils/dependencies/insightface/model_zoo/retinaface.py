@@ -143,12 +143,12 @@ class RetinaFace:
             else:
                 self.input_size = input_size
 
-    def forward(self, img, threshold):
+    def forward(self, img, threshold, swap_rb=True):
         scores_list = []
         bboxes_list = []
         kpss_list = []
         input_size = tuple(img.shape[0:2][::-1])
-        blob = cv2.dnn.blobFromImage(img, 1.0/self.input_std, input_size, (self.input_mean, self.input_mean, self.input_mean), swapRB=True)
+        blob = cv2.dnn.blobFromImage(img, 1.0/self.input_std, input_size, (self.input_mean, self.input_mean, self.input_mean), swapRB=swap_rb)
         net_outs = self.session.run(self.output_names, {self.input_name : blob})
 
         input_height = blob.shape[2]
@@ -204,7 +204,8 @@ class RetinaFace:
                 kpss_list.append(pos_kpss)
         return scores_list, bboxes_list, kpss_list
 
-    def detect(self, img, input_size = None, max_num=0, metric='default'):
+    def detect(self, img, input_size = None, max_num=0, metric='default', swap_rb=True):
+        # swap_rb: the img is BGR, set it to False if the img is already RGB
         assert input_size is not None or self.input_size is not None
         input_size = self.input_size if input_size is None else input_size
             
@@ -221,7 +222,7 @@ class RetinaFace:
         det_img = np.zeros( (input_size[1], input_size[0], 3), dtype=np.uint8 )
         det_img[:new_height, :new_width, :] = resized_img
 
-        scores_list, bboxes_list, kpss_list = self.forward(det_img, self.det_thresh)
+        scores_list, bboxes_list, kpss_list = self.forward(det_img, self.det_thresh, swap_rb=swap_rb)
 
         scores = np.vstack(scores_list)
         scores_ravel = scores.ravel()
@@ -5,6 +5,7 @@ face detectoin and alignment using InsightFace
 """
 
 import numpy as np
+import cv2
 from .rprint import rlog as log
 from .dependencies.insightface.app import FaceAnalysis
 from .dependencies.insightface.app.common import Face
@@ -38,15 +39,29 @@ class FaceAnalysisDIY(FaceAnalysis):
 
         self.timer = Timer()
 
-    def get(self, img_bgr, **kwargs):
+    def get(self, img, **kwargs):
+        """
+        img: HxWx3 uint8, BGR, or RGB if flag_rgb is True, so that the caller needs no BGR copy
+        det_max_dim: if > 0, the detector and the 106-point landmark model run on a copy of img halved by cv2.pyrDown until its max dim is not larger than it,
+            and the boxes and the points are scaled back to img
+        """
         max_num = kwargs.get('max_face_num', 0)  # the number of the detected faces, 0 means no limit
         flag_do_landmark_2d_106 = kwargs.get('flag_do_landmark_2d_106', True)  # whether to do 106-point detection
         direction = kwargs.get('direction', 'large-small')  # sorting direction
+        flag_rgb = kwargs.get('flag_rgb', False)
+        det_max_dim = kwargs.get('det_max_dim', 0)
         face_center = None
 
-        bboxes, kpss = self.det_model.detect(img_bgr, max_num=max_num, metric='default')
+        img_det = img
+        if det_max_dim > 0:
+            while max(img_det.shape[:2]) > det_max_dim:
+                img_det = cv2.pyrDown(img_det)
+        scale_x, scale_y = img.shape[1] / img_det.shape[1], img.shape[0] / img_det.shape[0]
+
+        bboxes, kpss = self.det_model.detect(img_det, max_num=max_num, metric='default', swap_rb=not flag_rgb)
         if bboxes.shape[0] == 0:
             return []
+        img_det_bgr = None  # only made if a model other than the landmark ones needs it
         ret = []
         for i in range(bboxes.shape[0]):
             bbox = bboxes[i, 0:4]
@@ -63,7 +78,22 @@ class FaceAnalysisDIY(FaceAnalysis):
                     continue
 
                 # print(f'taskname: {taskname}')
-                model.get(img_bgr, face)
+                if taskname.startswith('landmark'):
+                    model.get(img_det, face, swap_rb=not flag_rgb)
+                else:
+                    if img_det_bgr is None:
+                        img_det_bgr = np.ascontiguousarray(img_det[..., ::-1]) if flag_rgb else img_det
+                    model.get(img_det_bgr, face)
+
+            if img_det is not img:
+                # scale the boxes and the points back to the full resolution
+                face['bbox'] = face['bbox'] * np.array([scale_x, scale_y, scale_x, scale_y], dtype=np.float32)
+                for key in ('kps', 'landmark_2d_106', 'landmark_3d_68'):
+                    if face.get(key) is not None:
+                        pts = face[key].copy()
+                        pts[:, 0] *= scale_x
+                        pts[:, 1] *= scale_y
+                        face[key] = pts
             ret.append(face)
 
         ret = sort_by_direction(ret, direction, face_center)
@@ -0,0 +1,118 @@
+# coding: utf-8
+
+"""
+LRU cache of the features of the source images, so that animating one portrait repeatedly does not re-run the cropping and the feature extraction
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from .rprint import rlog as log
+
+
+# the fields of CropConfig which change the crop, the landmarks and so the features of a source image
+CROP_KEY_FIELDS = ('det_thresh', 'direction', 'max_face_num', 'det_max_dim', 'dsize', 'scale', 'vx_ratio', 'vy_ratio', 'flag_do_rot', 'animal_face_type')
+
+
+def _hash_array(arr: np.ndarray) -> str:
+    return hashlib.sha1(np.ascontiguousarray(arr).data).hexdigest()
+
+
+def _nbytes(obj) -> int:
+    if isinstance(obj, torch.Tensor):
+        return obj.element_size() * obj.numel()
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(_nbytes(v) for v in obj.values())
+    return 0
+
+
+def _to_host(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_host(v) for k, v in obj.items()}
+    return obj
+
+
+def _to_device(obj, device):
+    # always copy, the caller may modify the returned tensors and arrays in place
+    if isinstance(obj, torch.Tensor):
+        return obj.to(device, copy=True)
+    if isinstance(obj, np.ndarray):
+        return obj.copy()
+    if isinstance(obj, dict):
+        return {k: _to_device(v, device) for k, v in obj.items()}
+    return obj
+
+
+class SourceFeatureCache(object):
+    """ the entries are dicts of tensors / ndarrays kept in host memory, and evicted in the LRU order once the total size exceeds max_bytes
+    flag_fp16: store the appearance feature f_s (32x16x64x64) in float16 to halve its size
+    """
+
+    def __init__(self, max_bytes: int, flag_fp16: bool = False):
+        self.max_bytes = max_bytes
+        self.flag_fp16 = flag_fp16
+        self.entries = OrderedDict()  # key -> (entry, nbytes, dtype of f_s)
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(img_rgb: np.ndarray, crop_cfg, **kwargs) -> tuple:
+        """ the hash of the image bytes, plus the crop options read by `Cropper.crop_source_image` and any extra options, e.g., flag_do_crop
+        the ndarray options, e.g., the paste-back mask, are hashed by their bytes
+        """
+        crop_key = tuple((name, getattr(crop_cfg, name, None)) for name in CROP_KEY_FIELDS)
+        extra_key = tuple((k, (_hash_array(v), v.shape) if isinstance(v, np.ndarray) else v) for k, v in sorted(kwargs.items()))
+        return (_hash_array(img_rgb), img_rgb.shape, crop_key, extra_key)
+
+    def get(self, key, device):
+        if self.max_bytes <= 0:
+            return None
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                return None
+            self.entries.move_to_end(key)
+        entry, _, f_s_dtype = item
+
+        entry = _to_device(entry, device)
+        if 'f_s' in entry and f_s_dtype is not None:
+            entry['f_s'] = entry['f_s'].to(f_s_dtype)
+        return entry
+
+    def put(self, key, entry: dict):
+        if self.max_bytes <= 0:
+            return
+        entry = _to_host(entry)
+        f_s_dtype = None
+        if self.flag_fp16 and isinstance(entry.get('f_s'), torch.Tensor):
+            f_s_dtype = entry['f_s'].dtype
+            entry['f_s'] = entry['f_s'].half()
+        nbytes = _nbytes(entry)
+        if nbytes > self.max_bytes:
+            log(f"The source feature ({nbytes} bytes) is larger than the cache ({self.max_bytes} bytes), skip caching it.")
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (entry, nbytes, f_s_dtype)
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes:
+                _, (_, nbytes_evicted, _) = self.entries.popitem(last=False)
+                self.total_bytes -= nbytes_evicted
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
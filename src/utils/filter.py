@@ -1,19 +1,109 @@
 # coding: utf-8
 
+"""
+temporal smoothing of the motion trajectories, e.g., the expressions and the rotations of v2v
+"""
+
 import torch
 import numpy as np
-from pykalman import KalmanFilter
-
-
-def smooth(x_d_lst, shape, device, observation_variance=3e-7, process_variance=1e-5):
-    x_d_lst_reshape = [x.reshape(-1) for x in x_d_lst]
-    x_d_stacked = np.vstack(x_d_lst_reshape)
-    kf = KalmanFilter(
-        initial_state_mean=x_d_stacked[0],
-        n_dim_obs=x_d_stacked.shape[1],
-        transition_covariance=process_variance * np.eye(x_d_stacked.shape[1]),
-        observation_covariance=observation_variance * np.eye(x_d_stacked.shape[1])
-    )
-    smoothed_state_means, _ = kf.smooth(x_d_stacked)
-    x_d_lst_smooth = [torch.tensor(state_mean.reshape(shape[-2:]), dtype=torch.float32, device=device) for state_mean in smoothed_state_means]
-    return x_d_lst_smooth
+from collections import deque
+
+
+def kalman_smooth(x, observation_variance=3e-7, process_variance=1e-5, initial_variance=1., flag_causal=False):
+    """ Kalman smoothing of a random walk observed with noise, all the dimensions at once
+    it is the same as pykalman's KalmanFilter(initial_state_mean=x[0], transition_covariance=process_variance * I, observation_covariance=observation_variance * I).smooth(x),
+    as the covariances are isotropic, every dimension is an independent scalar filter with the same gains, so the gains are computed once for all the dimensions
+    x: TxD
+    flag_causal: return the forward filtered means only, each frame depends on the previous frames only
+    return: TxD float64
+    """
+    x = np.asarray(x, dtype=np.float64)
+    n = x.shape[0]
+
+    # the variances and the gains, shared by all the dimensions
+    var_pred = np.empty(n)
+    var_filt = np.empty(n)
+    gain = np.empty(n)
+    var = initial_variance
+    for t in range(n):
+        if t > 0:
+            var = var_filt[t - 1] + process_variance
+        var_pred[t] = var
+        gain[t] = var / (var + observation_variance)
+        var_filt[t] = (1 - gain[t]) * var
+
+    # forward pass
+    mean = np.empty_like(x)
+    mean_prev = x[0]
+    for t in range(n):
+        mean_prev = mean_prev + gain[t] * (x[t] - mean_prev)
+        mean[t] = mean_prev
+    if flag_causal:
+        return mean
+
+    # backward (RTS) pass, mean[t] holds the filtered mean until it is smoothed
+    gain_smooth = var_filt[:-1] / var_pred[1:]
+    for t in range(n - 2, -1, -1):
+        mean[t] += gain_smooth[t] * (mean[t + 1] - mean[t])
+    return mean
+
+
+class OnlineSmoother(object):
+    """ fixed-lag version of `kalman_smooth` for streaming, the frames are pushed one by one,
+    and the smoothed frame i is returned once the frame i + lag is pushed, i.e., it only looks `lag` frames ahead
+    lag=0 is the forward filter, and lag >= T - 1 gives the same result as `kalman_smooth` on the whole sequence after `flush`
+    """
+
+    def __init__(self, observation_variance=3e-7, process_variance=1e-5, lag=0, initial_variance=1.):
+        self.observation_variance = observation_variance
+        self.process_variance = process_variance
+        self.lag = max(lag, 0)
+        self.initial_variance = initial_variance
+        # the filtered means and variances, and the predicted variances, of the last lag + 1 frames
+        self.means = deque(maxlen=self.lag + 1)
+        self.vars_filt = deque(maxlen=self.lag + 1)
+        self.vars_pred = deque(maxlen=self.lag + 1)
+        self.n_pushed = 0
+        self.n_emitted = 0
+
+    def _smooth_window(self):
+        """the backward pass over the window, from the newest frame to the oldest one"""
+        mean_smooth = [self.means[-1]]
+        for j in range(len(self.means) - 2, -1, -1):
+            gain_smooth = self.vars_filt[j] / self.vars_pred[j + 1]
+            mean_smooth.append(self.means[j] + gain_smooth * (mean_smooth[-1] - self.means[j]))
+        return mean_smooth[::-1]
+
+    def push(self, x):
+        """push the next frame, return the smoothed frame #n_emitted, or None if it still waits for the following frames"""
+        x = np.asarray(x, dtype=np.float64)
+        if self.n_pushed == 0:
+            mean_prev, var = x, self.initial_variance
+        else:
+            mean_prev, var = self.means[-1], self.vars_filt[-1] + self.process_variance
+        gain = var / (var + self.observation_variance)
+        self.means.append(mean_prev + gain * (x - mean_prev))
+        self.vars_filt.append((1 - gain) * var)
+        self.vars_pred.append(var)
+        self.n_pushed += 1
+
+        if self.n_pushed - self.n_emitted <= self.lag:
+            return None
+        self.n_emitted += 1
+        return self._smooth_window()[0] if self.lag > 0 else self.means[-1]
+
+    def flush(self):
+        """the end of the sequence, return the smoothed frames not returned yet"""
+        n_left = self.n_pushed - self.n_emitted
+        if n_left == 0:
+            return []
+        self.n_emitted = self.n_pushed
+        return self._smooth_window()[-n_left:]
+
+
+def smooth(x_d_lst, shape, device, observation_variance=3e-7, process_variance=1e-5, flag_causal=False):
+    """smooth a list of arrays of the same shape over time, return a list of float32 tensors of shape[-2:] on the device"""
+    x_d_stacked = np.stack([np.asarray(x).reshape(-1) for x in x_d_lst])
+    x_d_smooth = kalman_smooth(x_d_stacked, observation_variance, process_variance, flag_causal=flag_causal)
+    x_d_smooth = torch.tensor(x_d_smooth.reshape(-1, *shape[-2:]), dtype=torch.float32, device=device)
+    return list(x_d_smooth.unbind(0))
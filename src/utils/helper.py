@@ -12,7 +12,9 @@ import numpy as np
 from scipy.spatial import ConvexHull # pylint: disable=E0401,E0611
 from typing import Union
 import cv2
+from rich.progress import track
 
+from .camera import get_rotation_matrix
 from ..modules.spade_generator import SPADEDecoder
 from ..modules.warping_network import WarpingNetwork
 from ..modules.motion_extractor import MotionExtractor
@@ -26,6 +28,14 @@ def tensor_to_numpy(data: Union[np.ndarray, torch.Tensor]) -> np.ndarray:
         return data.data.cpu().numpy()
     return data
 
+
+def batch_tensors_to_numpy(tensor_lst) -> list:
+    """transform a list of Bx... torch.Tensor into float32 numpy.ndarray with a single device-to-host copy"""
+    bs = tensor_lst[0].shape[0]
+    flat = torch.cat([tensor.reshape(bs, -1).float() for tensor in tensor_lst], dim=1).cpu().numpy()
+    sections = np.cumsum([tensor[0].numel() for tensor in tensor_lst])[:-1]
+    return [arr.reshape(tensor.shape) for arr, tensor in zip(np.split(flat, sections, axis=1), tensor_lst)]
+
 def calc_motion_multiplier(
     kp_source: Union[np.ndarray, torch.Tensor],
     kp_driving_initial: Union[np.ndarray, torch.Tensor]
@@ -79,7 +89,10 @@ def is_video(file_path):
 
 
 def is_template(file_path):
-    if file_path.endswith(".pkl"):
+    if file_path.endswith((".pkl", ".npz")):
+        return True
+    if osp.isdir(file_path) and osp.exists(osp.join(file_path, "n_frames.npy")):
+        # the columnar template stored as a directory of .npy files
         return True
     return False
 
@@ -104,6 +117,47 @@ def dct2device(dct: dict, device):
     return dct
 
 
+def make_motion_template(wrapper, I_lst, batch_size, flag_keypoints=True, **kwargs):
+    """ the motion template, a dict of contiguous Nx... float32 columns, see `load_motion_template`
+    I_lst: Tx1x3xHxW tensor, or a list of T HxWx3 uint8 frames moved to the device batch by batch
+    flag_keypoints: also keep the 'kp' and 'x_s' columns
+    valid_lst: whether each frame has a face, all True if not given
+    """
+    n_frames = len(I_lst)
+    keys = ('scale', 'R', 'exp', 't', 'kp', 'x_s') if flag_keypoints else ('scale', 'R', 'exp', 't')
+    motion_lst = {key: [] for key in keys}
+
+    for i_start in track(range(0, n_frames, batch_size), description=kwargs.get('description', 'Making motion templates...'), total=(n_frames + batch_size - 1) // batch_size):
+        if isinstance(I_lst, torch.Tensor):
+            I_batch = I_lst[i_start:i_start + batch_size, 0]  # Bx3xHxW
+        else:
+            I_batch = wrapper.prepare_videos(I_lst[i_start:i_start + batch_size])[:, 0]
+        x_i_info = wrapper.get_kp_info(I_batch)
+        R_i = get_rotation_matrix(x_i_info['pitch'], x_i_info['yaw'], x_i_info['roll'])
+        tensor_lst = [x_i_info['scale'], R_i, x_i_info['exp'], x_i_info['t']]
+        if flag_keypoints:
+            tensor_lst += [x_i_info['kp'], wrapper.transform_keypoint(x_i_info)]
+
+        # one device-to-host copy for the whole batch
+        for key, value in zip(keys, batch_tensors_to_numpy(tensor_lst)):
+            motion_lst[key].append(value)
+
+    template_dct = {
+        'n_frames': n_frames,
+        'output_fps': kwargs.get('output_fps', 25),
+    }
+    for key, value_lst in motion_lst.items():
+        template_dct[key] = np.concatenate(value_lst, axis=0)
+    valid_lst = kwargs.get('valid_lst')
+    template_dct['valid'] = np.ones(n_frames, dtype=bool) if valid_lst is None else np.asarray(valid_lst[:n_frames], dtype=bool)
+    return template_dct
+
+
+def motion2device(template_dct: dict, device, n_frames=None, keys=('scale', 'R', 'exp', 't', 'kp', 'x_s')):
+    """move the motion columns of a template to the device, one copy for each column"""
+    return {key: torch.tensor(np.asarray(template_dct[key][:n_frames])).to(device) for key in keys if key in template_dct}
+
+
 def concat_feat(kp_source: torch.Tensor, kp_driving: torch.Tensor) -> torch.Tensor:
     """
     kp_source: (bs, k, 3)
@@ -4,7 +4,7 @@ import os.path as osp
 import cv2; cv2.setNumThreads(0); cv2.ocl.setUseOpenCL(False)
 import torch
 import numpy as np
-import onnxruntime
+from .onnx_session import get_session, run_session
 from .timer import Timer
 from .rprint import rlog
 from .crop import crop_image, _transform_pts
@@ -32,32 +32,34 @@ class LandmarkRunner(object):
         device_id = kwargs.get('device_id', 0)
         self.dsize = kwargs.get('dsize', 224)
         self.timer = Timer()
+        # the options of the shared session, see `get_session`
+        session_kwargs = kwargs.get('session_kwargs', {'intra_op_num_threads': 4})  # 默认线程数为 4
 
         if onnx_provider.lower() == 'cuda':
-            self.session = onnxruntime.InferenceSession(
-                ckpt_path, providers=[
-                    ('CUDAExecutionProvider', {'device_id': device_id})
-                ]
-            )
+            providers = [('CUDAExecutionProvider', {'device_id': device_id})]
         elif onnx_provider.lower() == 'mps':
-            self.session = onnxruntime.InferenceSession(
-                ckpt_path, providers=[
-                    'CoreMLExecutionProvider'
-                ]
-            )
+            providers = ['CoreMLExecutionProvider']
         else:
-            opts = onnxruntime.SessionOptions()
-            opts.intra_op_num_threads = 4  # 默认线程数为 4
-            self.session = onnxruntime.InferenceSession(
-                ckpt_path, providers=['CPUExecutionProvider'],
-                sess_options=opts
-            )
+            providers = ['CPUExecutionProvider']
+        self.session = get_session(ckpt_path, providers, **session_kwargs)
+
+        # the exported model may have a fixed batch axis of 1, in which case run_batch runs frame by frame
+        batch_dim = self.session.get_inputs()[0].shape[0]
+        self.flag_dynamic_batch = not isinstance(batch_dim, int) or batch_dim != 1
+
+        # the per-frame confidence output, given by its name or looked up by "score", None if the model has no such output
+        score_output = kwargs.get('score_output', '')
+        self.score_index = None
+        for i, node in enumerate(self.session.get_outputs()):
+            if node.name == score_output or (not score_output and 'score' in node.name.lower()):
+                self.score_index = i
+                break
 
     def _run(self, inp):
-        out = self.session.run(None, {'input': inp})
+        out = run_session(self.session, {'input': inp})  # the crops are made on the host, so IO binding saves no copy
         return out
 
-    def run(self, img_rgb: np.ndarray, lmk=None):
+    def _crop(self, img_rgb: np.ndarray, lmk=None):
         if lmk is not None:
             crop_dct = crop_image(img_rgb, lmk, dsize=self.dsize, scale=1.5, vy_ratio=-0.1)
             img_crop_rgb = crop_dct['img_crop']
@@ -72,17 +74,51 @@ class LandmarkRunner(object):
                     [0., 0., 1.],
                 ], dtype=np.float32),
             }
+        return img_crop_rgb, crop_dct['M_c2o']
+
+    def _postprocess(self, out_pts, M_c2o):
+        # 2d landmarks 203 points
+        lmk = to_ndarray(out_pts).reshape(-1, 2) * self.dsize  # scale to 0-224
+        lmk = _transform_pts(lmk, M=M_c2o)
+        return lmk
+
+    def run(self, img_rgb: np.ndarray, lmk=None):
+        img_crop_rgb, M_c2o = self._crop(img_rgb, lmk)
 
         inp = (img_crop_rgb.astype(np.float32) / 255.).transpose(2, 0, 1)[None, ...]  # HxWx3 (BGR) -> 1x3xHxW (RGB!)
 
         out_lst = self._run(inp)
         out_pts = out_lst[2]
 
-        # 2d landmarks 203 points
-        lmk = to_ndarray(out_pts[0]).reshape(-1, 2) * self.dsize  # scale to 0-224
-        lmk = _transform_pts(lmk, M=crop_dct['M_c2o'])
-
-        return lmk
+        return self._postprocess(out_pts[0], M_c2o)
+
+    def run_batch(self, img_rgb_lst, lmk_lst, flag_return_score=False):
+        """ run N frames with one session call, each frame is cropped around its own landmarks and mapped back with its own M_c2o
+        img_rgb_lst: N frames, HxWx3
+        lmk_lst: N landmarks, or None for each frame
+        return: a list of N 203x2 landmarks, and the list of their raw scores if flag_return_score, None each if the model has no score output
+        """
+        crop_lst = [self._crop(img_rgb, lmk) for img_rgb, lmk in zip(img_rgb_lst, lmk_lst)]
+        if self.flag_dynamic_batch:
+            chunk_lst = [crop_lst]
+        else:
+            chunk_lst = [[crop] for crop in crop_lst]
+
+        pts_lst, score_lst = [], []
+        for chunk in chunk_lst:
+            inp = np.stack([img_crop_rgb for img_crop_rgb, _ in chunk]).astype(np.float32) / 255.
+            inp = np.ascontiguousarray(inp.transpose(0, 3, 1, 2))  # NxHxWx3 -> Nx3xHxW
+            out_lst = self._run(inp)
+            pts_lst.extend(out_lst[2])
+            if self.score_index is not None:
+                score_lst.extend(to_ndarray(out_lst[self.score_index]).reshape(len(chunk), -1)[:, 0].tolist())
+            else:
+                score_lst.extend([None] * len(chunk))
+
+        lmk_lst = [self._postprocess(out_pts, M_c2o) for out_pts, (_, M_c2o) in zip(pts_lst, crop_lst)]
+        if flag_return_score:
+            return lmk_lst, score_lst
+        return lmk_lst
 
     def warmup(self):
         self.timer.tic()
@@ -1,12 +1,15 @@
 # coding: utf-8
 
+import os
 import os.path as osp
+import queue
+import threading
 import imageio
 import numpy as np
 import pickle
 import cv2; cv2.setNumThreads(0); cv2.ocl.setUseOpenCL(False)
 
-from .helper import mkdir, suffix
+from .helper import mkdir, suffix, prefix
 
 
 def load_image_rgb(image_path: str):
@@ -16,17 +19,91 @@ def load_image_rgb(image_path: str):
     return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
 
-def load_video(video_info, n_frames=-1):
-    reader = imageio.get_reader(video_info, "ffmpeg")
+class VideoReader(object):
+    """ a re-iterable video source, the frames are decoded lazily instead of being loaded into memory at once
+    each iteration decodes the video from the beginning in a background thread, which stays at most `lookahead` frames ahead of the consumer
+    """
+    _END = object()
+
+    def __init__(self, video_info, n_frames=-1, transform=None, lookahead=8, n_frames_total=None):
+        self.video_info = video_info
+        self.n_frames = n_frames  # -1 means all the frames
+        self.transform = transform  # applied to each decoded frame, e.g., resize_to_limit
+        self.lookahead = max(lookahead, 1)
+        self._n_frames_total = n_frames_total  # the frame count of the whole video, counted once and shared by the sliced readers
+
+    def _count_frames(self):
+        """ the frame count of the whole video, the packets are counted by ffmpeg without decoding
+        the container metadata is not used, it may undercount and the last frames would be dropped
+        """
+        reader = imageio.get_reader(self.video_info, "ffmpeg")
+        try:
+            return reader.count_frames()
+        finally:
+            reader.close()
+
+    def __len__(self):
+        if self._n_frames_total is None:
+            self._n_frames_total = self._count_frames()
+        return min(self._n_frames_total, self.n_frames) if self.n_frames > 0 else self._n_frames_total
+
+    def __getitem__(self, index):
+        # only the prefix slicing `reader[:n]` is supported, which returns a reader of the first n frames
+        if isinstance(index, slice) and index.start in (None, 0) and index.step in (None, 1) and index.stop is not None:
+            n_frames = index.stop if self.n_frames <= 0 else min(index.stop, self.n_frames)
+            return VideoReader(self.video_info, n_frames=n_frames, transform=self.transform, lookahead=self.lookahead, n_frames_total=self._n_frames_total)
+        raise TypeError(f"VideoReader only supports the prefix slicing, got: {index}")
+
+    def _decode(self, frame_queue, stop_event):
+        def _put(item):
+            while not stop_event.is_set():
+                try:
+                    frame_queue.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        reader = None
+        try:
+            reader = imageio.get_reader(self.video_info, "ffmpeg")
+            for idx, frame_rgb in enumerate(reader):
+                if (self.n_frames > 0 and idx >= self.n_frames) or stop_event.is_set():
+                    break
+                if self.transform is not None:
+                    frame_rgb = self.transform(frame_rgb)
+                _put(frame_rgb)
+        except Exception as e:
+            _put(e)  # re-raised in the consumer
+        finally:
+            if reader is not None:
+                reader.close()
+            _put(self._END)
+
+    def __iter__(self):
+        frame_queue = queue.Queue(maxsize=self.lookahead)
+        stop_event = threading.Event()
+        worker = threading.Thread(target=self._decode, args=(frame_queue, stop_event), daemon=True)
+        worker.start()
+        n_yielded = 0
+        try:
+            while True:
+                item = frame_queue.get()
+                if item is self._END:
+                    if self.n_frames <= 0 or n_yielded < self.n_frames:
+                        self._n_frames_total = n_yielded  # the whole video is decoded, its count is exact
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                n_yielded += 1
+                yield item
+        finally:
+            # the consumer may stop early, e.g., break or exception
+            stop_event.set()
+            worker.join()
 
-    ret = []
-    for idx, frame_rgb in enumerate(reader):
-        if n_frames > 0 and idx >= n_frames:
-            break
-        ret.append(frame_rgb)
 
-    reader.close()
-    return ret
+def load_video(video_info, n_frames=-1):
+    return list(VideoReader(video_info, n_frames=n_frames))
 
 
 def contiguous(obj):
@@ -92,15 +169,22 @@ def load_img_online(obj, mode="bgr", **kwargs):
         raise Exception(f"Unknown mode {mode}")
 
 
-def load(fp):
+def load(fp, mmap_mode=None):
+    if osp.isdir(fp):
+        # a directory of .npy columns, e.g., the columnar motion template
+        return {prefix(fn): np.load(osp.join(fp, fn), mmap_mode=mmap_mode) for fn in sorted(os.listdir(fp)) if suffix(fn) == "npy"}
+
     suffix_ = suffix(fp)
 
     if suffix_ == "npy":
-        return np.load(fp)
+        return np.load(fp, mmap_mode=mmap_mode)
+    elif suffix_ == "npz":
+        with np.load(fp) as data:
+            return {key: data[key] for key in data.files}
     elif suffix_ == "pkl":
         return pickle.load(open(fp, "rb"))
     else:
-        raise Exception(f"Unknown type: {suffix}")
+        raise Exception(f"Unknown type: {suffix_}")
 
 
 def dump(wfp, obj):
@@ -111,7 +195,60 @@ def dump(wfp, obj):
     _suffix = suffix(wfp)
     if _suffix == "npy":
         np.save(wfp, obj)
+    elif _suffix == "npz":
+        np.savez(wfp, **obj)  # uncompressed, so that each column is stored contiguously
     elif _suffix == "pkl":
         pickle.dump(obj, open(wfp, "wb"))
     else:
         raise Exception("Unknown type: {}".format(_suffix))
+
+
+def convert_legacy_motion_template(template_dct: dict) -> dict:
+    """convert a pickled template holding per-frame dicts into the columnar layout
+    """
+    ret = {
+        'n_frames': template_dct['n_frames'],
+    }
+    if 'output_fps' in template_dct:
+        ret['output_fps'] = template_dct['output_fps']
+
+    motion_lst = template_dct['motion']
+    for key in motion_lst[0].keys():
+        key_new = 'R' if key == 'R_d' else key  # compatible with previous keys
+        ret[key_new] = np.concatenate([motion[key] for motion in motion_lst], axis=0).astype(np.float32)
+
+    for key_new, keys in (('c_eyes', ('c_eyes_lst', 'c_d_eyes_lst')), ('c_lip', ('c_lip_lst', 'c_d_lip_lst'))):
+        for key in keys:
+            if key in template_dct:
+                ret[key_new] = np.concatenate([np.reshape(c, (1, -1)) for c in template_dct[key]], axis=0).astype(np.float32)
+                break
+
+    return ret
+
+
+def load_motion_template(fp, mmap_mode='r') -> dict:
+    """load a motion template, which is a dict of contiguous Nx... float32 arrays
+    keys: 'scale', 'R', 'exp', 't', 'kp', 'x_s', 'c_eyes', 'c_lip' (the animal template has only the first four), plus the header 'n_frames' and 'output_fps'
+    'valid': whether each frame has a face, absent in the legacy templates
+    fp: a single .npz file, a directory of .npy columns (memory-mapped by mmap_mode), or a legacy .pkl file
+    """
+    template_dct = load(fp, mmap_mode=mmap_mode) if osp.isdir(fp) else load(fp)
+
+    if 'motion' in template_dct:  # legacy template of per-frame dicts
+        return convert_legacy_motion_template(template_dct)
+
+    for key in ('n_frames', 'output_fps'):
+        if key in template_dct:
+            template_dct[key] = int(template_dct[key])
+    return template_dct
+
+
+def dump_motion_template(wfp, template_dct: dict):
+    """dump a columnar motion template to a single .npz file, or to a directory of .npy columns if wfp has no suffix
+    """
+    if suffix(osp.basename(wfp)) == "":
+        mkdir(wfp)
+        for key, value in template_dct.items():
+            np.save(osp.join(wfp, f"{key}.npy"), np.asarray(value))
+    else:
+        dump(wfp, template_dct)
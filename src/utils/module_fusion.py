@@ -0,0 +1,96 @@
+# coding: utf-8
+
+"""
+An opt-in inference pass over the 2D modules of F, W and G, applied after `load_model`:
+the spectral norm and BatchNorm are folded into the convs, the activations run in place, and the 2D parts run in channels_last,
+which is the native layout of oneDNN on the cpu and of cudnn's tensor cores.
+The inputs and the outputs of each 2D part keep the default layout, so the callers and the 3D parts are unchanged.
+"""
+
+import torch
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from ..modules.util import SameBlock2d, DownBlock2d
+from .rprint import rlog as log
+
+
+def _map_4d(fn, x):
+    """apply fn to the 4D tensors of x, a tensor, or a tuple / list / dict of them"""
+    if isinstance(x, torch.Tensor):
+        return fn(x) if x.ndim == 4 else x
+    if isinstance(x, (tuple, list)):
+        return type(x)(_map_4d(fn, v) for v in x)
+    if isinstance(x, dict):
+        return {k: _map_4d(fn, v) for k, v in x.items()}
+    return x
+
+
+def _to_channels_last_hook(module, args, kwargs):
+    fn = lambda t: t.contiguous(memory_format=torch.channels_last)
+    return _map_4d(fn, args), _map_4d(fn, kwargs)
+
+
+def _to_contiguous_hook(module, args, output):
+    return _map_4d(lambda t: t.contiguous(), output)
+
+
+def run_channels_last(modules, first, last):
+    """ convert the 4D weights of modules to channels_last, the input of first is converted to channels_last, and the output of last back to the default layout
+    first / last: the entry and the exit of the 2D part, e.g., the same module
+    """
+    for module in modules:
+        module.to(memory_format=torch.channels_last)
+    first.register_forward_pre_hook(_to_channels_last_hook, with_kwargs=True)
+    last.register_forward_hook(_to_contiguous_hook)
+
+
+def remove_spectral_norm(model: nn.Module) -> int:
+    """bake the weights of the spectral normalized modules, which are recomputed from u and v at each call otherwise, return the number of them"""
+    n = 0
+    for module in model.modules():
+        if hasattr(module, 'weight_orig'):
+            torch.nn.utils.remove_spectral_norm(module)
+            n += 1
+    return n
+
+
+def fuse_conv_norm_act(model: nn.Module) -> int:
+    """ fold the BatchNorm of SameBlock2d and DownBlock2d into the preceding conv, with the running statistics, and run the activation of SameBlock2d in place
+    return: the number of the folded blocks
+    """
+    n = 0
+    for module in model.modules():
+        if isinstance(module, (SameBlock2d, DownBlock2d)) and isinstance(module.norm, nn.BatchNorm2d):
+            module.conv = fuse_conv_bn_eval(module.conv, module.norm)
+            module.norm = nn.Identity()
+            if isinstance(module, SameBlock2d):
+                module.ac.inplace = True  # the conv output is not read elsewhere
+            n += 1
+    return n
+
+
+@torch.no_grad()
+def optimize_2d_modules(model: nn.Module, model_type: str) -> nn.Module:
+    """ the inference pass of the 2D modules of F, W and G, the model must be in eval mode, the other models are returned unchanged
+    F: the 2D encoder `first` -> `down_blocks` -> `second`, before the reshape to the 3D feature volume
+    W: the 2D decoder `third` -> `fourth`, after the reshape of the warped feature volume
+    G: the whole decoder
+    """
+    if model_type not in ('appearance_feature_extractor', 'warping_module', 'spade_generator'):
+        return model
+    if model.training:
+        raise ValueError(f'{model_type} must be in eval mode to fold the normalization')
+
+    n_spectral = remove_spectral_norm(model)
+    n_fused = fuse_conv_norm_act(model)
+
+    if model_type == 'appearance_feature_extractor':
+        run_channels_last([model.first, model.down_blocks, model.second], model.first, model.second)
+    elif model_type == 'warping_module':
+        run_channels_last([model.third, model.fourth], model.third, model.fourth)
+    else:
+        run_channels_last([model], model, model)
+
+    log(f'Optimize {model_type}: {n_fused} conv-norm-activation blocks fused, {n_spectral} spectral norms removed, channels_last')
+    return model
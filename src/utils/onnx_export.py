@@ -0,0 +1,87 @@
+# coding: utf-8
+
+"""
+export the LivePortrait networks to ONNX, with the batch axes dynamic, so that they can run on ONNX Runtime, see `load_onnx_model`
+"""
+
+import torch
+from torch import nn
+
+from .helper import load_model, mkdir
+from .onnx_session import RETARGETING_KEYS, onnx_model_path
+from .rprint import rlog as log
+
+# model type -> (input names, output names), the input names are the same as the arguments the wrapper calls the torch modules with
+ONNX_MODEL_SPECS = {
+    'appearance_feature_extractor': (['x'], ['feature_3d']),
+    'motion_extractor': (['x'], ['pitch', 'yaw', 'roll', 't', 'exp', 'scale', 'kp']),
+    'warping_module': (['feature_3d', 'kp_driving', 'kp_source'], ['occlusion_map', 'deformation', 'out']),
+    'spade_generator': (['feature'], ['out']),
+    'stitching_retargeting_module': (['x'], ['delta']),
+}
+
+
+class _ExportWrapper(nn.Module):
+    """flatten the dict output of a module into a tuple in the order of the output names"""
+
+    def __init__(self, model, output_names):
+        super(_ExportWrapper, self).__init__()
+        self.model = model
+        self.output_names = output_names
+
+    def forward(self, *args):
+        out = self.model(*args)
+        if isinstance(out, dict):
+            return tuple(out[k] for k in self.output_names)
+        return out
+
+
+def export_onnx(model, args, wfp, model_type, opset_version=20):
+    """ export one module, args: the example inputs in the order of the input names
+    opset 20 is the first one whose GridSample supports the 5-D input of the warping module
+    """
+    input_names, output_names = ONNX_MODEL_SPECS[model_type]
+    dynamic_axes = {name: {0: 'batch'} for name in input_names + output_names}
+    with torch.no_grad():
+        torch.onnx.export(
+            _ExportWrapper(model, output_names).eval(),
+            tuple(args),
+            wfp,
+            input_names=input_names,
+            output_names=output_names,
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+            do_constant_folding=True,
+        )
+    log(f'Export {model_type} to {wfp}')
+    return wfp
+
+
+def export_models(model_config, checkpoint_dct: dict, onnx_dir, opset_version=20, device='cpu'):
+    """ export all the networks in float32
+    checkpoint_dct: model type -> checkpoint path
+    the example inputs are chained through the networks, so that the shapes follow the model config
+    """
+    mkdir(onnx_dir)
+    models = {model_type: load_model(ckpt_path, model_config, device, model_type) for model_type, ckpt_path in checkpoint_dct.items()}
+
+    x = torch.rand(1, 3, 256, 256, device=device)
+    with torch.no_grad():
+        feature_3d = models['appearance_feature_extractor'](x)
+        kp_info = models['motion_extractor'](x)
+        kp_source = kp_info['kp'].reshape(1, -1, 3)
+        kp_driving = kp_source + 0.01 * torch.randn_like(kp_source)
+        feature = models['warping_module'](feature_3d, kp_driving, kp_source)['out']
+
+    export_onnx(models['appearance_feature_extractor'], [x], onnx_model_path(onnx_dir, 'appearance_feature_extractor'), 'appearance_feature_extractor', opset_version)
+    export_onnx(models['motion_extractor'], [x], onnx_model_path(onnx_dir, 'motion_extractor'), 'motion_extractor', opset_version)
+    export_onnx(models['warping_module'], [feature_3d, kp_driving, kp_source], onnx_model_path(onnx_dir, 'warping_module'), 'warping_module', opset_version)
+    export_onnx(models['spade_generator'], [feature], onnx_model_path(onnx_dir, 'spade_generator'), 'spade_generator', opset_version)
+
+    if 'stitching_retargeting_module' in models:
+        config = model_config['model_params']['stitching_retargeting_module_params']
+        for key in RETARGETING_KEYS:
+            feat = torch.randn(1, config[key]['input_size'], device=device)
+            export_onnx(models['stitching_retargeting_module'][key], [feat], onnx_model_path(onnx_dir, 'stitching_retargeting_module', key), 'stitching_retargeting_module', opset_version)
+
+    return onnx_dir
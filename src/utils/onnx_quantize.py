@@ -0,0 +1,169 @@
+# coding: utf-8
+
+"""
+INT8 post-training static quantization (QDQ) of the exported onnx models with ONNX Runtime,
+and the quality report of the quantized models against the float32 ones on the example pairs
+"""
+
+import os
+import time
+import numpy as np
+import torch
+from onnxruntime.quantization import CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType, quant_pre_process, quantize_static
+from skimage.metrics import peak_signal_noise_ratio, structural_similarity
+
+from .onnx_session import load_onnx_model, onnx_model_path
+from .rprint import rlog as log
+
+QUANTIZABLE_MODELS = ('motion_extractor', 'spade_generator')
+
+_CALIBRATE_METHOD = {
+    'minmax': CalibrationMethod.MinMax,
+    'entropy': CalibrationMethod.Entropy,
+    'percentile': CalibrationMethod.Percentile,
+}
+
+
+class _FeedsReader(CalibrationDataReader):
+    def __init__(self, feeds_lst):
+        self.feeds_iter = iter(feeds_lst)
+
+    def get_next(self):
+        return next(self.feeds_iter, None)
+
+
+def quantize_model(onnx_dir, model_type, feeds_lst, **kwargs):
+    """ quantize the weights to int8 per channel and the activations to uint8 by the ranges calibrated on feeds_lst, write the model as the 'int8' variant
+    feeds_lst: list of dicts, input name -> 1x... float32 np.ndarray
+    calibrate_method: 'minmax', 'entropy' or 'percentile'
+    max_intermediate_outputs: the calibrator keeps the activations of this many samples in memory at most, the activations of the generator are large
+    """
+    calibrate_method = kwargs.get('calibrate_method', 'minmax')
+    if calibrate_method not in _CALIBRATE_METHOD:
+        raise Exception(f"Unknown calibrate method: {calibrate_method}, expect one of {list(_CALIBRATE_METHOD.keys())}")
+
+    model_input = onnx_model_path(onnx_dir, model_type)
+    model_output = onnx_model_path(onnx_dir, model_type, variant='int8')
+    model_preprocessed = onnx_model_path(onnx_dir, model_type, variant='preprocessed')
+    # shape inference and graph optimization, recommended before quantization, the symbolic shape inference of ORT fails on the dynamic batch axes
+    quant_pre_process(model_input, model_preprocessed, skip_symbolic_shape=True)
+    try:
+        quantize_static(
+            model_preprocessed,
+            model_output,
+            _FeedsReader(feeds_lst),
+            quant_format=QuantFormat.QDQ,
+            per_channel=kwargs.get('per_channel', True),
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            calibrate_method=_CALIBRATE_METHOD[calibrate_method],
+            extra_options={'CalibMaxIntermediateOutputs': kwargs.get('max_intermediate_outputs', 1)},
+        )
+    finally:
+        os.remove(model_preprocessed)
+    log(f'Quantize {model_type} to {model_output} with {len(feeds_lst)} calibration samples')
+    return model_output
+
+
+@torch.no_grad()
+def animate_pair(wrapper, I_s: torch.Tensor, I_d: torch.Tensor) -> np.ndarray:
+    """animate the source by the pose and the expression of the driving frame, with whatever models the wrapper holds, return HxWx3 uint8"""
+    f_s = wrapper.extract_feature_3d(I_s)
+    kp_s = wrapper.get_kp_info(I_s, flag_refine_info=False)
+    kp_d = wrapper.get_kp_info(I_d, flag_refine_info=False)
+    x_s = wrapper.transform_keypoint(kp_s)
+    x_d = wrapper.transform_keypoint({**kp_d, 'kp': kp_s['kp']})  # the canonical keypoints of the source
+    out = wrapper.warp_decode(f_s, x_s, x_d)
+    return wrapper.parse_output(out['out'])[0]
+
+
+@torch.no_grad()
+def collect_calibration_feeds(wrapper, pairs, models=QUANTIZABLE_MODELS):
+    """ the inputs of the models met when animating the example pairs, computed by the float32 models of the wrapper
+    pairs: list of (I_s, I_d), 1x3x256x256 tensors normalized to 0~1
+    return: model type -> list of feeds
+    """
+    feeds_dct = {model_type: [] for model_type in models}
+    for I_s, I_d in pairs:
+        if 'motion_extractor' in feeds_dct:
+            feeds_dct['motion_extractor'] += [{'x': I_s.cpu().numpy()}, {'x': I_d.cpu().numpy()}]
+        if 'spade_generator' in feeds_dct:
+            f_s = wrapper.extract_feature_3d(I_s)
+            kp_s = wrapper.get_kp_info(I_s, flag_refine_info=False)
+            kp_d = wrapper.get_kp_info(I_d, flag_refine_info=False)
+            x_s = wrapper.transform_keypoint(kp_s)
+            x_d = wrapper.transform_keypoint({**kp_d, 'kp': kp_s['kp']})
+            feature = wrapper.warping_module(f_s, kp_source=x_s, kp_driving=x_d)['out']
+            feeds_dct['spade_generator'].append({'feature': feature.float().cpu().numpy()})
+    return feeds_dct
+
+
+def _latency_ms(module, feeds_lst, n_repeat=3):
+    feeds_lst = [{k: torch.from_numpy(v) for k, v in feeds.items()} for feeds in feeds_lst]
+    module(**feeds_lst[0])  # warm up
+    start = time.time()
+    for _ in range(n_repeat):
+        for feeds in feeds_lst:
+            module(**feeds)
+    return (time.time() - start) * 1000 / (n_repeat * len(feeds_lst))
+
+
+def make_lpips(net='alex'):
+    """the LPIPS distance of two HxWx3 uint8 images on the cpu, it needs the optional lpips package"""
+    try:
+        import lpips
+    except ImportError:
+        raise Exception("The LPIPS metric needs the lpips package, install it by `pip install lpips`, or report PSNR and SSIM only")
+    model = lpips.LPIPS(net=net, verbose=False).eval()
+
+    def to_tensor(img):
+        return torch.from_numpy(np.ascontiguousarray(img)).permute(2, 0, 1)[None].float() / 127.5 - 1  # 1x3xHxW in [-1, 1]
+
+    @torch.no_grad()
+    def distance(img0, img1):
+        return float(model(to_tensor(img0), to_tensor(img1)))
+    return distance
+
+
+def quality_report(wrapper, onnx_dir, pairs, feeds_dct, flag_lpips=False, **kwargs):
+    """ compare the animated pairs and the latency of the int8 models against the float32 ones, each model alone and all together
+    wrapper: with the float32 onnx models, its models are swapped temporarily
+    feeds_dct: from `collect_calibration_feeds`, used to time the models
+    flag_lpips: also report the LPIPS distance, see `make_lpips`
+    kwargs: see `get_session`
+    return: list of dicts with keys 'variant', 'psnr', 'ssim', 'latency_fp32_ms', 'latency_int8_ms', and 'lpips' if flag_lpips
+    """
+    lpips_distance = make_lpips() if flag_lpips else None
+    models = list(feeds_dct.keys())
+    reference = [animate_pair(wrapper, I_s, I_d) for I_s, I_d in pairs]
+    modules_fp32 = {model_type: getattr(wrapper, model_type) for model_type in models}
+    modules_int8 = {model_type: load_onnx_model(onnx_dir, model_type, wrapper.device, variant='int8', **kwargs) for model_type in models}
+
+    variants = [(model_type,) for model_type in models]
+    if len(models) > 1:
+        variants.append(tuple(models))
+
+    rows = []
+    for variant in variants:
+        try:
+            for model_type in variant:
+                setattr(wrapper, model_type, modules_int8[model_type])
+            animated = [animate_pair(wrapper, I_s, I_d) for I_s, I_d in pairs]
+        finally:
+            for model_type in variant:
+                setattr(wrapper, model_type, modules_fp32[model_type])
+
+        row = {
+            'variant': ' + '.join(variant) + ' int8',
+            'psnr': float(np.mean([peak_signal_noise_ratio(ref, img, data_range=255) for ref, img in zip(reference, animated)])),
+            'ssim': float(np.mean([structural_similarity(ref, img, channel_axis=2, data_range=255) for ref, img in zip(reference, animated)])),
+            'latency_fp32_ms': sum(_latency_ms(modules_fp32[model_type], feeds_dct[model_type]) for model_type in variant),
+            'latency_int8_ms': sum(_latency_ms(modules_int8[model_type], feeds_dct[model_type]) for model_type in variant),
+        }
+        if lpips_distance is not None:
+            row['lpips'] = float(np.mean([lpips_distance(ref, img) for ref, img in zip(reference, animated)]))
+        lpips_info = f", LPIPS {row['lpips']:.4f}" if 'lpips' in row else ''
+        log(f"{row['variant']}: PSNR {row['psnr']:.2f} dB, SSIM {row['ssim']:.4f}{lpips_info} against float32, "
+            f"latency {row['latency_fp32_ms']:.1f} ms -> {row['latency_int8_ms']:.1f} ms (x{row['latency_fp32_ms'] / row['latency_int8_ms']:.2f})")
+        rows.append(row)
+    return rows
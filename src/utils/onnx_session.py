@@ -0,0 +1,209 @@
+# coding: utf-8
+
+"""
+process-wide registry of the ONNX Runtime sessions, keyed by the model path, the providers and the session options,
+so that the croppers of the gradio workers and the batch jobs in one process share the same sessions,
+and the ONNX Runtime backend of the LivePortrait networks
+"""
+
+import os.path as osp
+import threading
+
+import numpy as np
+import onnxruntime
+import torch
+
+from .helper import basename, mkdir
+from .rprint import rlog as log
+
+_GRAPH_OPTIMIZATION_LEVEL = {
+    'disable': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+_TORCH2NP_DTYPE = {
+    torch.float32: np.float32,
+    torch.float16: np.float16,
+    torch.int64: np.int64,
+    torch.int32: np.int32,
+    torch.uint8: np.uint8,
+}
+
+_ORT2TORCH_DTYPE = {
+    'tensor(float)': torch.float32,
+    'tensor(float16)': torch.float16,
+    'tensor(int64)': torch.int64,
+    'tensor(int32)': torch.int32,
+    'tensor(uint8)': torch.uint8,
+}
+
+RETARGETING_KEYS = ('stitching', 'lip', 'eye')
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+def make_session_options(**kwargs) -> onnxruntime.SessionOptions:
+    """
+    intra_op_num_threads / inter_op_num_threads: 0 means the default of ONNX Runtime
+    graph_optimization_level: 'disable', 'basic', 'extended' or 'all'
+    flag_mem_arena: whether to enable the cpu memory arena
+    """
+    opts = onnxruntime.SessionOptions()
+    opts.intra_op_num_threads = kwargs.get('intra_op_num_threads', 0)
+    opts.inter_op_num_threads = kwargs.get('inter_op_num_threads', 0)
+    graph_optimization_level = kwargs.get('graph_optimization_level', 'all')
+    if graph_optimization_level not in _GRAPH_OPTIMIZATION_LEVEL:
+        raise Exception(f"Unknown graph optimization level: {graph_optimization_level}, expect one of {list(_GRAPH_OPTIMIZATION_LEVEL.keys())}")
+    opts.graph_optimization_level = _GRAPH_OPTIMIZATION_LEVEL[graph_optimization_level]
+    opts.enable_cpu_mem_arena = kwargs.get('flag_mem_arena', True)
+    return opts
+
+
+def _provider_name(providers) -> str:
+    provider = providers[0] if len(providers) > 0 else 'CPUExecutionProvider'
+    return (provider[0] if isinstance(provider, (tuple, list)) else provider).replace('ExecutionProvider', '').lower()
+
+
+def get_session(model_path, providers, provider_options=None, **kwargs) -> onnxruntime.InferenceSession:
+    """ get the shared session of a model, it is created on the first call
+    providers / provider_options: the same as onnxruntime.InferenceSession
+    optimized_model_dir: if given, the optimized model is serialized there on the first run, and loaded directly on the next startup
+    kwargs: see `make_session_options`
+    """
+    optimized_model_dir = kwargs.get('optimized_model_dir') or None
+    option_keys = ('intra_op_num_threads', 'inter_op_num_threads', 'graph_optimization_level', 'flag_mem_arena')
+    key = (osp.realpath(model_path), repr(providers), repr(provider_options), optimized_model_dir, tuple((k, kwargs.get(k)) for k in option_keys))
+
+    with _lock:
+        session = _sessions.get(key)
+        if session is not None:
+            return session
+
+        opts = make_session_options(**kwargs)
+        model_path_load = model_path
+        if optimized_model_dir is not None:
+            # the optimized model may contain provider specific nodes, so it is kept per provider
+            optimized_model_path = osp.join(mkdir(optimized_model_dir), f'{basename(model_path)}.{_provider_name(providers)}.{kwargs.get("graph_optimization_level", "all")}.onnx')
+            if osp.exists(optimized_model_path):
+                model_path_load = optimized_model_path
+                opts.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL  # already optimized
+            else:
+                opts.optimized_model_filepath = optimized_model_path
+                log(f'Serialize the optimized model of {model_path} to {optimized_model_path}')
+
+        session = onnxruntime.InferenceSession(model_path_load, sess_options=opts, providers=providers, provider_options=provider_options)
+        _sessions[key] = session
+        return session
+
+
+def clear_sessions():
+    with _lock:
+        _sessions.clear()
+
+
+def _output_shape(node, batch_size):
+    """the shape of an output whose only dynamic axis is the batch axis, or None"""
+    shape = []
+    for i, dim in enumerate(node.shape):
+        if isinstance(dim, int):
+            shape.append(dim)
+        elif i == 0:
+            shape.append(batch_size)
+        else:
+            return None
+    return shape
+
+
+def run_session(session: onnxruntime.InferenceSession, feeds: dict, device_type='cpu', device_id=0):
+    """ run the session
+    feeds: input name -> np.ndarray or torch.Tensor
+    device_type: if 'cuda' and all the feeds are torch tensors on the cuda device, the inputs and the outputs are bound on the device with IO binding,
+        so that nothing is copied through the host, otherwise it is the same as session.run
+    return: the outputs as torch tensors on the device with IO binding, or as numpy arrays otherwise
+    """
+    if device_type != 'cuda' or not all(isinstance(value, torch.Tensor) and value.is_cuda for value in feeds.values()):
+        feeds = {name: value.cpu().numpy() if isinstance(value, torch.Tensor) else value for name, value in feeds.items()}
+        return session.run(None, feeds)
+
+    device = torch.device('cuda', device_id)
+    binding = session.io_binding()
+    feeds = {name: value.contiguous() for name, value in feeds.items()}  # kept alive until the run ends
+    for name, value in feeds.items():
+        binding.bind_input(name, 'cuda', device_id, _TORCH2NP_DTYPE[value.dtype], list(value.shape), value.data_ptr())
+
+    # the outputs are allocated by torch on the device, the batch axis follows the first input
+    batch_size = next(iter(feeds.values())).shape[0]
+    outputs = []
+    for node in session.get_outputs():
+        shape = _output_shape(node, batch_size)
+        if shape is None:
+            binding.bind_output(node.name, 'cuda', device_id)  # allocated by ONNX Runtime, copied to torch after the run
+            outputs.append(None)
+            continue
+        output = torch.empty(shape, dtype=_ORT2TORCH_DTYPE[node.type], device=device)
+        binding.bind_output(node.name, 'cuda', device_id, _TORCH2NP_DTYPE[output.dtype], shape, output.data_ptr())
+        outputs.append(output)
+
+    # ONNX Runtime runs on its own stream, so the kernels of torch writing the inputs must finish first
+    torch.cuda.current_stream(device).synchronize()
+    session.run_with_iobinding(binding)
+    binding.synchronize_outputs()
+    if any(output is None for output in outputs):
+        ort_outputs = binding.get_outputs()
+        outputs = [torch.from_numpy(ort_outputs[i].numpy()).to(device) if output is None else output for i, output in enumerate(outputs)]
+    return outputs
+
+
+def onnx_model_path(onnx_dir, model_type, key=None, variant=None):
+    """ a/b/warping_module.onnx, or a/b/stitching_retargeting_module_lip.onnx for the retargeting MLPs
+    variant: e.g., 'int8' for the quantized model a/b/spade_generator.int8.onnx
+    """
+    name = model_type if key is None else f'{model_type}_{key}'
+    return osp.join(onnx_dir, f'{name}.onnx' if variant is None else f'{name}.{variant}.onnx')
+
+
+class OnnxModule(object):
+    """ an exported network running on ONNX Runtime, called like the torch module it is exported from
+    the inputs are fed by position or by name in float32, the outputs are torch tensors on the device, a dict if there are several
+    on cuda, the inputs and the outputs stay on the device through IO binding, see `run_session`
+    """
+
+    def __init__(self, session: onnxruntime.InferenceSession, device):
+        self.session = session
+        self.device = torch.device(device)
+        self.input_names = [node.name for node in session.get_inputs()]
+        self.output_names = [node.name for node in session.get_outputs()]
+
+    def __call__(self, *args, **kwargs):
+        feeds = dict(zip(self.input_names, args))
+        feeds.update(kwargs)
+        if self.device.type == 'cuda':
+            # the inputs on the host are moved to the device, so that the whole run is bound on the device
+            feeds = {name: feeds[name].to(self.device).float().contiguous() for name in self.input_names}
+        else:
+            feeds = {name: feeds[name].float().contiguous() for name in self.input_names}
+        outputs = run_session(self.session, feeds, device_type=self.device.type, device_id=self.device.index or 0)
+        if self.device.type != 'cuda':
+            outputs = [torch.from_numpy(output).to(self.device) for output in outputs]
+        if len(outputs) > 1:
+            return dict(zip(self.output_names, outputs))
+        return outputs[0]
+
+
+def load_onnx_model(onnx_dir, model_type, device, variant=None, **kwargs):
+    """ the counterpart of `load_model` for the models exported by `export_models`, the sessions are shared in the process
+    variant: e.g., 'int8' for the model quantized by `quantize_model`
+    kwargs: see `get_session`
+    """
+    if str(device).startswith('cuda'):
+        providers = ['CUDAExecutionProvider', 'CPUExecutionProvider']
+        provider_options = [{'device_id': torch.device(device).index or 0}, {}]
+    else:
+        providers, provider_options = ['CPUExecutionProvider'], None
+
+    if model_type == 'stitching_retargeting_module':
+        return {key: OnnxModule(get_session(onnx_model_path(onnx_dir, model_type, key), providers, provider_options, **kwargs), device) for key in RETARGETING_KEYS}
+    return OnnxModule(get_session(onnx_model_path(onnx_dir, model_type, variant=variant), providers, provider_options, **kwargs), device)
@@ -8,7 +8,11 @@ ATTENTION: you need to install ffmpeg and ffprobe in your env!
 
 import os.path as osp
 import numpy as np
+import queue
 import subprocess
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import imageio
 import cv2
 from rich.progress import track
@@ -81,6 +85,20 @@ def blend(img: np.ndarray, mask: np.ndarray, background_color=(255, 255, 255)):
     return img
 
 
+def concat_frame(driving_image, source_image, I_p):
+    """driving frame | source frame | generation, or source frame | generation if driving_image is None"""
+    h, w, _ = I_p.shape
+    if source_image.shape[:2] != (h, w):
+        source_image = cv2.resize(source_image, (w, h))
+
+    if driving_image is None:
+        return np.hstack((source_image, I_p))
+
+    if driving_image.shape[:2] != (h, w):
+        driving_image = cv2.resize(driving_image, (w, h))
+    return np.hstack((driving_image, source_image, I_p))
+
+
 def concat_frames(driving_image_lst, source_image_lst, I_p_lst):
     # TODO: add more concat style, e.g., left-down corner driving
     out_lst = []
@@ -88,17 +106,9 @@ def concat_frames(driving_image_lst, source_image_lst, I_p_lst):
     source_image_resized_lst = [cv2.resize(img, (w, h)) for img in source_image_lst]
 
     for idx, _ in track(enumerate(I_p_lst), total=len(I_p_lst), description='Concatenating result...'):
-        I_p = I_p_lst[idx]
         source_image_resized = source_image_resized_lst[idx] if len(source_image_lst) > 1 else source_image_resized_lst[0]
-
-        if driving_image_lst is None:
-            out = np.hstack((source_image_resized, I_p))
-        else:
-            driving_image = driving_image_lst[idx]
-            driving_image_resized = cv2.resize(driving_image, (w, h))
-            out = np.hstack((driving_image_resized, source_image_resized, I_p))
-
-        out_lst.append(out)
+        driving_image = None if driving_image_lst is None else driving_image_lst[idx]
+        out_lst.append(concat_frame(driving_image, source_image_resized, I_p_lst[idx]))
     return out_lst
 
 
@@ -111,12 +121,13 @@ class VideoWriter:
         self.quality = kwargs.get('quality')
         self.pixelformat = kwargs.get('pixelformat', 'yuv420p')
         self.image_mode = kwargs.get('image_mode', 'rgb')
-        self.ffmpeg_params = kwargs.get('ffmpeg_params')
+        self.macro_block_size = kwargs.get('macro_block_size', 2)
+        self.ffmpeg_params = kwargs.get('ffmpeg_params', ['-crf', str(kwargs.get('crf', 18))])  # the same defaults as images2video
 
         self.writer = imageio.get_writer(
             self.wfp, fps=self.fps, format=self.video_format,
             codec=self.codec, quality=self.quality,
-            ffmpeg_params=self.ffmpeg_params, pixelformat=self.pixelformat
+            ffmpeg_params=self.ffmpeg_params, pixelformat=self.pixelformat, macro_block_size=self.macro_block_size
         )
 
     def write(self, image):
@@ -130,6 +141,82 @@ class VideoWriter:
             self.writer.close()
 
 
+class VideoSink(object):
+    """ receive the frames as they are produced and encode them by a VideoWriter in a background thread
+    at most `max_queue_size` frames are buffered, so the memory use does not grow with the video length
+    """
+    def __init__(self, max_queue_size=16, **kwargs):
+        self.writer = VideoWriter(**kwargs)
+        self.wfp = self.writer.wfp
+        self.frame_queue = queue.Queue(maxsize=max(max_queue_size, 1))
+        self.exception = None
+        self.worker = threading.Thread(target=self._encode, daemon=True)
+        self.worker.start()
+
+    def _encode(self):
+        while True:
+            image = self.frame_queue.get()
+            if image is None:
+                break
+            if self.exception is not None:
+                continue  # keep draining the queue so that the producer is never blocked
+            try:
+                self.writer.write(image)
+            except Exception as e:
+                self.exception = e
+
+    def write(self, image):
+        if self.exception is not None:
+            raise self.exception
+        self.frame_queue.put(image)
+
+    def close(self):
+        if self.worker.is_alive():
+            self.frame_queue.put(None)
+            self.worker.join()
+        self.writer.close()
+        if self.exception is not None:
+            raise self.exception
+
+
+class FrameWorkerPool(object):
+    """ run the per-frame post-processing, e.g., paste back and concatenation, in a thread pool
+    at most `max_pending` frames are in flight, and the results are handed to `callback` in the order of the frame index
+    n_workers <= 0 runs the post-processing in the calling thread
+    """
+    def __init__(self, n_workers, callback, max_pending=None):
+        self.callback = callback
+        self.executor = ThreadPoolExecutor(max_workers=n_workers) if n_workers > 0 else None
+        self.max_pending = max(max_pending if max_pending is not None else 2 * n_workers, 1)
+        self.pending = deque()  # (idx, future), in the order of submission
+        self.next_idx = None
+
+    def submit(self, idx, fn, *args, **kwargs):
+        if self.executor is None:
+            self.callback(fn(*args, **kwargs))
+            return
+
+        if self.next_idx is not None and idx != self.next_idx:
+            raise ValueError(f"Frames must be submitted in order, expect #{self.next_idx}, got #{idx}")
+        self.next_idx = idx + 1
+
+        self.pending.append((idx, self.executor.submit(fn, *args, **kwargs)))
+        while len(self.pending) >= self.max_pending:
+            self._pop()
+
+    def _pop(self):
+        _, future = self.pending.popleft()
+        self.callback(future.result())
+
+    def close(self):
+        try:
+            while len(self.pending) > 0:
+                self._pop()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True, cancel_futures=True)
+
+
 def change_video_fps(input_file, output_file, fps=20, codec='libx264', crf=12):
     cmd = f'ffmpeg -i "{input_file}" -c:v {codec} -crf {crf} -r {fps} "{output_file}" -y'
     exec_cmd(cmd)
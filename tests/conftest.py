@@ -0,0 +1,7 @@
+# coding: utf-8
+
+import os.path as osp
+import sys
+
+# the tests import the modules as `src.*`, the same as the entry scripts
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
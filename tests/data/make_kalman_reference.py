@@ -0,0 +1,50 @@
+# coding: utf-8
+
+"""
+generate kalman_reference.npz, the pykalman results which `kalman_smooth` is tested against, it needs pykalman:
+    pip install pykalman
+    python tests/data/make_kalman_reference.py
+"""
+
+import os.path as osp
+import numpy as np
+from pykalman import KalmanFilter
+
+OBSERVATION_VARIANCE = 3e-7
+PROCESS_VARIANCE = 1e-5
+
+
+def make_inputs(n_frames=40, seed=0):
+    """a noisy random walk of the expressions, T x 63, and the flattened rotation matrices of a turning head, T x 9"""
+    rng = np.random.default_rng(seed)
+    x_exp = np.cumsum(rng.normal(0, 3e-3, (n_frames, 63)), axis=0) + rng.normal(0, 1e-3, (n_frames, 63))
+
+    yaw = np.cumsum(rng.normal(0, 0.02, n_frames))
+    pitch = 0.1 * np.sin(np.linspace(0, np.pi, n_frames)) + rng.normal(0, 0.005, n_frames)
+    cy, sy, cp, sp = np.cos(yaw), np.sin(yaw), np.cos(pitch), np.sin(pitch)
+    zeros, ones = np.zeros(n_frames), np.ones(n_frames)
+    R_yaw = np.stack([cy, zeros, sy, zeros, ones, zeros, -sy, zeros, cy], axis=1).reshape(-1, 3, 3)
+    R_pitch = np.stack([ones, zeros, zeros, zeros, cp, -sp, zeros, sp, cp], axis=1).reshape(-1, 3, 3)
+    x_r = (R_pitch @ R_yaw).reshape(n_frames, 9)
+    return x_exp, x_r
+
+
+def pykalman_reference(x):
+    """the smoothed and the filtered means, set up as the smoothing of LivePortrait with pykalman"""
+    n_dim = x.shape[1]
+    kf = KalmanFilter(
+        initial_state_mean=x[0],
+        n_dim_obs=n_dim,
+        transition_covariance=PROCESS_VARIANCE * np.eye(n_dim),
+        observation_covariance=OBSERVATION_VARIANCE * np.eye(n_dim),
+    )
+    return kf.smooth(x)[0], kf.filter(x)[0]
+
+
+if __name__ == '__main__':
+    x_exp, x_r = make_inputs()
+    smooth_exp, filter_exp = pykalman_reference(x_exp)
+    smooth_r, filter_r = pykalman_reference(x_r)
+    wfp = osp.join(osp.dirname(osp.abspath(__file__)), 'kalman_reference.npz')
+    np.savez(wfp, x_exp=x_exp, smooth_exp=smooth_exp, filter_exp=filter_exp, x_r=x_r, smooth_r=smooth_r, filter_r=filter_r)
+    print(f'Dump the pykalman reference to {wfp}')
@@ -0,0 +1,145 @@
+# coding: utf-8
+
+"""
+smoke tests of the video tracking of Cropper, with a stubbed face detector and landmark model
+"""
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("cv2")
+pytest.importorskip("torch")
+pytest.importorskip("onnxruntime")
+
+from src.config.crop_config import CropConfig
+from src.utils.cropper import Cropper
+
+
+def _make_lmk(n, x0=40, y0=40, size=48, seed=0):
+    """n landmarks in a face box, the eyes of the 203 points above the lip"""
+    rng = np.random.default_rng(seed)
+    lmk = rng.uniform(0, size, (n, 2)).astype(np.float32) + (x0, y0)
+    if n == 203:
+        lmk[[0, 6, 12, 18]] = (x0 + size * 0.3, y0 + size * 0.35)  # left eye
+        lmk[[24, 30, 36, 42]] = (x0 + size * 0.7, y0 + size * 0.35)  # right eye
+        lmk[[48, 66]] = (x0 + size * 0.5, y0 + size * 0.8)  # lip
+    return lmk
+
+
+class _Face:
+    def __init__(self, lmk):
+        self.landmark_2d_106 = lmk
+
+
+class _FaceAnalysis:
+    """one face in the frames which are not black"""
+    def __init__(self):
+        self.kwargs_lst = []
+
+    def get(self, img, **kwargs):
+        self.kwargs_lst.append(kwargs)
+        if img.max() == 0:
+            return []
+        return [_Face(_make_lmk(106))]
+
+
+class _LandmarkRunner:
+    """the face moves right by one pixel per pixel value of the frame"""
+    score_index = None
+
+    def __init__(self, flag_dynamic_batch=True):
+        self.flag_dynamic_batch = flag_dynamic_batch
+        self.batch_lst = []  # (the landmarks which the frames are cropped around, the refined ones) of each batch
+
+    def run(self, img_rgb, lmk=None):
+        return _make_lmk(203) + (float(img_rgb[0, 0, 0]), 0)
+
+    def run_batch(self, img_rgb_lst, lmk_lst, flag_return_score=False):
+        ret = [self.run(img_rgb, lmk) for img_rgb, lmk in zip(img_rgb_lst, lmk_lst)]
+        self.batch_lst.append((lmk_lst, ret))
+        if flag_return_score:
+            return ret, [None] * len(ret)
+        return ret
+
+
+def _make_cropper(**kwargs):
+    cropper = Cropper.__new__(Cropper)  # skip loading the onnx models
+    cropper.crop_cfg = CropConfig(**kwargs)
+    cropper.image_type = 'human_face'
+    cropper.face_analysis_wrapper = _FaceAnalysis()
+    cropper.human_landmark_runner = _LandmarkRunner()
+    return cropper
+
+
+def _make_frames(n, black=()):
+    return [np.zeros((128, 128, 3), np.uint8) if i in black else np.full((128, 128, 3), 64 + i, np.uint8) for i in range(n)]
+
+
+def test_track_lmk():
+    cropper = _make_cropper(redetect_interval=2)
+    frames = _make_frames(6, black=(0,))
+    detect_fn = lambda idx, frame_rgb: cropper._detect_lmk(frame_rgb, idx, "source", direction="large-small")
+    ret = list(cropper._track_lmk(frames, detect_fn, cropper.crop_cfg, direction="large-small"))
+
+    assert [idx for idx, _, _ in ret] == list(range(6))
+    assert ret[0][2] is None
+    assert all(lmk.shape == (203, 2) for _, _, lmk in ret[1:])
+    assert all(kwargs["direction"] == "large-small" for kwargs in cropper.face_analysis_wrapper.kwargs_lst)
+
+
+def test_track_lmk_lost():
+    # the face leaves at the frame #4, where the re-detection runs, the frames tracked meanwhile are yielded as lost
+    cropper = _make_cropper(landmark_batch_size=1, redetect_interval=4, redetect_iou_thresh=0)
+    frames = _make_frames(10, black=range(4, 10))
+    detect_fn = lambda idx, frame_rgb: cropper._detect_lmk(frame_rgb, idx, "source")
+    ret = list(cropper._track_lmk(frames, detect_fn, cropper.crop_cfg))
+
+    assert [idx for idx, _, _ in ret] == list(range(10))
+    assert all(lmk is not None for _, _, lmk in ret[:4])
+    assert all(lmk is None for _, _, lmk in ret[4:])
+
+
+def test_track_lmk_batch_prediction():
+    cropper = _make_cropper(landmark_batch_size=4, redetect_interval=0, redetect_iou_thresh=0)
+    frames = _make_frames(9)
+    detect_fn = lambda idx, frame_rgb: cropper._detect_lmk(frame_rgb, idx, "source")
+    ret = list(cropper._track_lmk(frames, detect_fn, cropper.crop_cfg))
+
+    assert [idx for idx, _, _ in ret] == list(range(9))
+    batch_lst = cropper.human_landmark_runner.batch_lst
+    assert [len(lmk_lst) for lmk_lst, _ in batch_lst] == [4, 4]
+    # the first batch has one tracked frame before it, the second batch is extrapolated from the last two frames of the first one
+    for lmk_pred in batch_lst[0][0]:
+        np.testing.assert_allclose(lmk_pred, ret[0][2])
+    for lmk_pred, lmk in zip(*batch_lst[1]):
+        np.testing.assert_allclose(lmk_pred, lmk, atol=1e-4)
+
+
+def test_track_lmk_fixed_batch():
+    cropper = _make_cropper(landmark_batch_size=4)
+    cropper.human_landmark_runner = _LandmarkRunner(flag_dynamic_batch=False)
+    frames = _make_frames(5)
+    detect_fn = lambda idx, frame_rgb: cropper._detect_lmk(frame_rgb, idx, "source")
+    list(cropper._track_lmk(frames, detect_fn, cropper.crop_cfg))
+
+    assert all(len(lmk_lst) == 1 for lmk_lst, _ in cropper.human_landmark_runner.batch_lst)
+
+
+@pytest.mark.parametrize("crop_smooth_window", [0, 5])
+def test_crop_source_video(crop_smooth_window):
+    cropper = _make_cropper(crop_smooth_window=crop_smooth_window)
+    frames = _make_frames(8, black=(0,))
+    ret = cropper.crop_source_video(frames, cropper.crop_cfg)
+
+    assert len(ret["frame_crop_lst"]) == len(ret["lmk_crop_lst"]) == len(ret["M_c2o_lst"]) == 8
+    assert all(img.shape == (256, 256, 3) for img in ret["frame_crop_lst"])
+    assert ret["valid_lst"] == [False] + [True] * 7  # the frame before the first face is passed through
+
+
+def test_crop_driving_video():
+    cropper = _make_cropper()
+    frames = _make_frames(4)
+    ret = cropper.crop_driving_video(frames, direction="large-small")
+
+    assert len(ret["frame_crop_lst"]) == len(ret["lmk_crop_lst"]) == 4
+    assert all(ret["valid_lst"])
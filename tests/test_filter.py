@@ -0,0 +1,35 @@
+# coding: utf-8
+
+"""
+tests of the temporal smoothing against the pykalman reference, see data/make_kalman_reference.py
+"""
+
+import os.path as osp
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("torch")
+
+from src.utils.filter import kalman_smooth, OnlineSmoother
+
+
+@pytest.fixture(scope='module')
+def reference():
+    return np.load(osp.join(osp.dirname(osp.abspath(__file__)), 'data', 'kalman_reference.npz'))
+
+
+@pytest.mark.parametrize('name', ['exp', 'r'])
+def test_kalman_smooth(reference, name):
+    x = reference[f'x_{name}']
+    np.testing.assert_allclose(kalman_smooth(x), reference[f'smooth_{name}'], rtol=1e-7, atol=1e-10)
+    np.testing.assert_allclose(kalman_smooth(x, flag_causal=True), reference[f'filter_{name}'], rtol=1e-7, atol=1e-10)
+
+
+@pytest.mark.parametrize('name', ['exp', 'r'])
+def test_online_smoother(reference, name):
+    x = reference[f'x_{name}']
+    for lag, y_ref in [(0, reference[f'filter_{name}']), (len(x) - 1, reference[f'smooth_{name}'])]:
+        smoother = OnlineSmoother(lag=lag)
+        y = [smoother.push(x_t) for x_t in x]
+        y = [y_t for y_t in y if y_t is not None] + smoother.flush()
+        np.testing.assert_allclose(np.stack(y), y_ref, rtol=1e-7, atol=1e-10)
@@ -0,0 +1,40 @@
+# coding: utf-8
+
+"""
+tests of the lazy video reader
+"""
+
+import pytest
+
+np = pytest.importorskip("numpy")
+imageio = pytest.importorskip("imageio")
+pytest.importorskip("imageio_ffmpeg")
+pytest.importorskip("cv2")
+
+from src.utils.io import VideoReader
+
+
+@pytest.fixture
+def video_path(tmp_path):
+    wfp = str(tmp_path / "video.mp4")
+    writer = imageio.get_writer(wfp, fps=25, codec='libx264', macro_block_size=2)
+    for i in range(7):
+        writer.append_data(np.full((64, 64, 3), i * 30, np.uint8))
+    writer.close()
+    return wfp
+
+
+def test_video_reader_len(video_path):
+    reader = VideoReader(video_path)
+    assert len(reader) == 7
+    assert len(list(reader)) == 7
+    assert len(list(reader)) == 7  # re-iterable
+
+
+def test_video_reader_slice(video_path):
+    reader = VideoReader(video_path, transform=lambda img: img[:32])
+    reader_prefix = reader[:3]
+    frames = list(reader_prefix)
+    assert len(reader_prefix) == len(frames) == 3
+    assert all(frame.shape == (32, 64, 3) for frame in frames)
+    assert len(reader[:100]) == 7
@@ -0,0 +1,101 @@
+# coding: utf-8
+
+"""
+tests of the batched inference of the pipeline against the per-frame one, on the cpu with small randomly initialized networks
+"""
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("cv2")
+pytest.importorskip("onnxruntime")
+
+from src.config.inference_config import InferenceConfig
+from src.live_portrait_pipeline import LivePortraitPipeline
+from src.live_portrait_wrapper import LivePortraitWrapper
+from src.modules.spade_generator import SPADEDecoder
+from src.modules.stitching_retargeting_network import StitchingRetargetingNetwork
+from src.modules.warping_network import WarpingNetwork
+from src.utils.helper import calc_motion_multiplier
+
+NUM_KP = 21
+
+
+def _make_wrapper(**kwargs):
+    torch.manual_seed(0)
+    wrapper = LivePortraitWrapper.__new__(LivePortraitWrapper)  # skip loading the checkpoints
+    wrapper.inference_cfg = InferenceConfig(flag_use_half_precision=False, flag_force_cpu=True, **kwargs)
+    wrapper.device = 'cpu'
+    wrapper.compile = False
+    wrapper.warping_module = WarpingNetwork(
+        num_kp=NUM_KP, block_expansion=4, max_features=16, num_down_blocks=2, reshape_channel=4, estimate_occlusion_map=True,
+        dense_motion_params={'block_expansion': 4, 'max_features': 16, 'num_blocks': 2, 'reshape_depth': 4, 'compress': 2},
+    ).eval()
+    wrapper.spade_generator = SPADEDecoder(upscale=1, max_features=16, block_expansion=4, out_channels=4, num_down_blocks=2).eval()
+    wrapper.stitching_retargeting_module = {'stitching': StitchingRetargetingNetwork(NUM_KP * 3 * 2, [16, 16], NUM_KP * 3 + 2).eval()}
+    return wrapper
+
+
+def _make_motion(n_frames):
+    R = torch.linalg.qr(torch.randn(n_frames, 3, 3))[0]
+    return {
+        'kp': torch.rand(n_frames, NUM_KP, 3) * 2 - 1,
+        'R': R,
+        'exp': torch.randn(n_frames, NUM_KP, 3) * 0.02,
+        'scale': 1 + torch.rand(n_frames, 1) * 0.2,
+        't': torch.randn(n_frames, 3) * 0.05,
+        'x_s': torch.rand(n_frames, NUM_KP, 3) * 2 - 1,
+    }
+
+
+def _make_driving_keypoints_per_frame(wrapper, source_motion, driving_motion, n_frames):
+    """the per-frame loop of the relative motion of a source image, with the stitching"""
+    inf_cfg = wrapper.inference_cfg
+    x_c_s, R_s, x_s = source_motion['kp'], source_motion['R'], source_motion['x_s']
+    x_d_0_info = {k: v[0:1] for k, v in driving_motion.items()}
+    x_d_new_lst = []
+    for i in range(n_frames):
+        x_d_i_info = {k: v[i:i + 1] for k, v in driving_motion.items()}
+        R_new = (x_d_i_info['R'] @ x_d_0_info['R'].permute(0, 2, 1)) @ R_s
+        delta_new = source_motion['exp'] + (x_d_i_info['exp'] - x_d_0_info['exp'])
+        scale_new = source_motion['scale'] * (x_d_i_info['scale'] / x_d_0_info['scale'])
+        t_new = source_motion['t'] + (x_d_i_info['t'] - x_d_0_info['t'])
+        t_new[..., 2].fill_(0)  # zero tz
+        x_d_i_new = scale_new * (x_c_s @ R_new + delta_new) + t_new
+
+        if inf_cfg.driving_option == "expression-friendly":
+            if i == 0:
+                x_d_0_new = x_d_i_new
+                motion_multiplier = calc_motion_multiplier(x_s, x_d_0_new)
+            x_d_i_new = (x_d_i_new - x_d_0_new) * motion_multiplier + x_s
+
+        x_d_i_new = wrapper.stitching(x_s, x_d_i_new)
+        x_d_i_new = x_s + (x_d_i_new - x_s) * inf_cfg.driving_multiplier
+        x_d_new_lst.append(x_d_i_new)
+    return torch.cat(x_d_new_lst)
+
+
+@pytest.mark.parametrize('driving_option', ['pose-friendly', 'expression-friendly'])
+def test_make_driving_keypoints(driving_option):
+    wrapper = _make_wrapper(driving_option=driving_option, driving_multiplier=1.2)
+    pipeline = LivePortraitPipeline.__new__(LivePortraitPipeline)
+    pipeline.live_portrait_wrapper = wrapper
+    n_frames = 5
+    source_motion, driving_motion = _make_motion(1), _make_motion(n_frames)
+
+    x_d_new = pipeline.make_driving_keypoints(source_motion, driving_motion, n_frames, None)
+    torch.testing.assert_close(x_d_new, _make_driving_keypoints_per_frame(wrapper, source_motion, driving_motion, n_frames))
+
+
+def test_warp_decode_prepared():
+    wrapper = _make_wrapper()
+    f_s = torch.randn(1, 4, 4, 16, 16)
+    x_s = torch.rand(1, NUM_KP, 3) * 2 - 1
+    x_d = x_s + torch.randn(3, NUM_KP, 3) * 0.05
+
+    warp_source = wrapper.prepare_warp_source(f_s, x_s)
+    out = wrapper.warp_decode(f_s.expand(3, -1, -1, -1, -1), x_s.expand(3, -1, -1), x_d, warp_source=warp_source)
+    for i in range(3):
+        out_i = wrapper.warp_decode(f_s, x_s, x_d[i:i + 1])
+        for key in ('out', 'occlusion_map', 'deformation'):
+            torch.testing.assert_close(out[key][i:i + 1], out_i[key])
@@ -0,0 +1,65 @@
+# coding: utf-8
+
+"""
+tests of the network modules on the cpu, with small randomly initialized networks
+"""
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import torch.nn.functional as F
+
+from src.modules.dense_motion import DenseMotionNetwork
+from src.modules.util import make_coordinate_grid
+
+
+def _make_dense_motion(num_kp=3):
+    torch.manual_seed(0)
+    return DenseMotionNetwork(block_expansion=4, num_blocks=2, max_features=16, num_kp=num_kp, feature_channel=4, reshape_depth=4, compress=2).eval()
+
+
+def test_identity_grid_buffer():
+    net = _make_dense_motion()
+    assert 'identity_grid' not in net.state_dict()
+
+    kp = torch.rand(1, 3, 3)
+    with torch.inference_mode():
+        grid = net.get_identity_grid((4, 8, 8), ref=kp)
+    torch.testing.assert_close(grid, make_coordinate_grid((4, 8, 8), ref=kp))
+    assert not grid.is_inference()  # usable by autograd out of the inference mode
+    assert net.get_identity_grid((4, 8, 8), ref=kp) is grid
+
+    z, y, x = net.get_coordinate_axes((4, 8, 8), ref=kp)
+    assert (z.shape, y.shape, x.shape) == ((4,), (8,), (8,))
+
+    grid_double = net.get_identity_grid((4, 8, 8), ref=kp.double())
+    assert grid_double.dtype == torch.float64
+
+
+def test_create_deformed_feature():
+    # one grid_sample over the stacked motions is the same as repeating the feature for each motion
+    net = _make_dense_motion()
+    bs, c, d, h, w = 2, 4, 4, 8, 8
+    feature = torch.randn(bs, c, d, h, w)
+    sparse_motions = torch.rand(bs, net.num_kp + 1, d, h, w, 3) * 2 - 1
+
+    feature_repeat = feature.unsqueeze(1).unsqueeze(1).repeat(1, net.num_kp + 1, 1, 1, 1, 1, 1)  # (bs, num_kp+1, 1, c, d, h, w)
+    feature_repeat = feature_repeat.view(bs * (net.num_kp + 1), -1, d, h, w)
+    sparse_deformed = F.grid_sample(feature_repeat, sparse_motions.view(bs * (net.num_kp + 1), d, h, w, -1), align_corners=False)
+    sparse_deformed = sparse_deformed.view(bs, net.num_kp + 1, -1, d, h, w)
+
+    torch.testing.assert_close(net.create_deformed_feature(feature, sparse_motions), sparse_deformed)
+
+
+def test_dense_motion_prepared():
+    net = _make_dense_motion()
+    feature = torch.randn(1, 4, 4, 8, 8)
+    kp_source = torch.rand(1, 3, 3) * 2 - 1
+    kp_driving = torch.rand(2, 3, 3) * 2 - 1
+    with torch.no_grad():
+        out_prepared = net.forward_prepared(net.prepare_source(feature, kp_source), kp_driving)
+        for i in range(2):
+            out = net(feature, kp_driving[i:i + 1], kp_source)
+            for key in ('mask', 'deformation', 'occlusion_map'):
+                torch.testing.assert_close(out_prepared[key][i:i + 1], out[key])